@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\x04\x63hat\"C\n\x18ReplicateMutationRequest\x12\x16\n\x0eoperation_type\x18\x01 \x01(\t\x12\x0f\n\x07payload\x18\x02 \x01(\t\"=\n\x19ReplicateMutationResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"2\n\x0cLoginRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"G\n\rLoginResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x14\n\x0cunread_count\x18\x03 \x01(\x05\":\n\x14\x43reateAccountRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"9\n\x15\x43reateAccountResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"!\n\rLogOffRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"2\n\x0eLogOffResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"(\n\x14\x44\x65leteAccountRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"9\n\x15\x44\x65leteAccountResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"H\n\x12SendMessageRequest\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x11\n\trecipient\x18\x02 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x03 \x01(\t\"7\n\x13SendMessageResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"6\n\x13ReadMessagesRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\r\n\x05limit\x18\x02 \x01(\x05\";\n\x14ReadMessagesResponse\x12#\n\x08messages\x18\x01 \x03(\x0b\x32\x11.chat.ChatMessage\">\n\x15\x44\x65leteMessagesRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x13\n\x0bmessage_ids\x18\x02 \x03(\x05\":\n\x16\x44\x65leteMessagesResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"?\n\x17ViewConversationRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x12\n\nother_user\x18\x02 \x01(\t\"?\n\x18ViewConversationResponse\x12#\n\x08messages\x18\x01 \x03(\x0b\x32\x11.chat.ChatMessage\"9\n\x13ListAccountsRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08wildcard\x18\x02 \x01(\t\")\n\x14ListAccountsResponse\x12\x11\n\tusernames\x18\x01 \x03(\t\"$\n\x10SubscribeRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"M\n\x0b\x43hatMessage\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0e\n\x06sender\x18\x02 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x03 \x01(\t\x12\x11\n\ttimestamp\x18\x04 \x01(\t2\xa8\x06\n\x0b\x43hatService\x12\x32\n\x05Login\x12\x12.chat.LoginRequest\x1a\x13.chat.LoginResponse\"\x00\x12J\n\rCreateAccount\x12\x1a.chat.CreateAccountRequest\x1a\x1b.chat.CreateAccountResponse\"\x00\x12\x35\n\x06LogOff\x12\x13.chat.LogOffRequest\x1a\x14.chat.LogOffResponse\"\x00\x12J\n\rDeleteAccount\x12\x1a.chat.DeleteAccountRequest\x1a\x1b.chat.DeleteAccountResponse\"\x00\x12\x44\n\x0bSendMessage\x12\x18.chat.SendMessageRequest\x1a\x19.chat.SendMessageResponse\"\x00\x12G\n\x0cReadMessages\x12\x19.chat.ReadMessagesRequest\x1a\x1a.chat.ReadMessagesResponse\"\x00\x12M\n\x0e\x44\x65leteMessages\x12\x1b.chat.DeleteMessagesRequest\x1a\x1c.chat.DeleteMessagesResponse\"\x00\x12S\n\x10ViewConversation\x12\x1d.chat.ViewConversationRequest\x1a\x1e.chat.ViewConversationResponse\"\x00\x12G\n\x0cListAccounts\x12\x19.chat.ListAccountsRequest\x1a\x1a.chat.ListAccountsResponse\"\x00\x12\x44\n\x13SubscribeToMessages\x12\x16.chat.SubscribeRequest\x1a\x11.chat.ChatMessage\"\x00\x30\x01\x12T\n\x11ReplicateMutation\x12\x1e.chat.ReplicateMutationRequest\x1a\x1f.chat.ReplicateMutationResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\x04\x63hat\"i\n\x18ReplicateMutationRequest\x12\x16\n\x0eoperation_type\x18\x01 \x01(\t\x12\x0f\n\x07payload\x18\x02 \x01(\t\x12$\n\x06record\x18\x03 \x01(\x0b\x32\x14.chat.MutationRecord\"=\n\x19ReplicateMutationResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"@\n\x15\x43reateAccountMutation\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x15\n\rpassword_hash\x18\x02 \x01(\t\"\x89\x01\n\x13SendMessageMutation\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x11\n\trecipient\x18\x02 \x01(\t\x12\"\n\x07message\x18\x03 \x01(\x0b\x32\x11.chat.ChatMessage\x12\x18\n\x10remote_recipient\x18\x04 \x01(\x08\x12\x11\n\tdelivered\x18\x05 \x01(\x08\"b\n\x16\x44\x65liverMessageMutation\x12\x11\n\trecipient\x18\x01 \x01(\t\x12\"\n\x07message\x18\x02 \x01(\x0b\x32\x11.chat.ChatMessage\x12\x11\n\tdelivered\x18\x03 \x01(\x08\")\n\x15\x44\x65leteAccountMutation\x12\x10\n\x08username\x18\x01 \x01(\t\"9\n\x10MarkReadMutation\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x13\n\x0bmessage_ids\x18\x02 \x03(\x05\"?\n\x16\x44\x65leteMessagesMutation\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x13\n\x0bmessage_ids\x18\x02 \x03(\x05\"\x85\x03\n\x0eMutationRecord\x12\r\n\x05index\x18\x01 \x01(\x03\x12\x0c\n\x04term\x18\n \x01(\x03\x12\x35\n\x0e\x63reate_account\x18\x04 \x01(\x0b\x32\x1b.chat.CreateAccountMutationH\x00\x12\x31\n\x0csend_message\x18\x05 \x01(\x0b\x32\x19.chat.SendMessageMutationH\x00\x12\x35\n\x0e\x64\x65lete_account\x18\x06 \x01(\x0b\x32\x1b.chat.DeleteAccountMutationH\x00\x12+\n\tmark_read\x18\x07 \x01(\x0b\x32\x16.chat.MarkReadMutationH\x00\x12\x37\n\x0f\x64\x65lete_messages\x18\x08 \x01(\x0b\x32\x1c.chat.DeleteMessagesMutationH\x00\x12\x37\n\x0f\x64\x65liver_message\x18\t \x01(\x0b\x32\x1c.chat.DeliverMessageMutationH\x00\x42\n\n\x08mutationJ\x04\x08\x02\x10\x03J\x04\x08\x03\x10\x04\"\xa5\x01\n\x10ReplicationBatch\x12%\n\x07records\x18\x01 \x03(\x0b\x32\x14.chat.MutationRecord\x12\x0c\n\x04term\x18\x02 \x01(\x03\x12\x11\n\tleader_id\x18\x03 \x01(\x05\x12\x18\n\x10term_start_index\x18\x04 \x01(\x03\x12\x16\n\x0epacked_records\x18\x05 \x01(\x0c\x12\x17\n\x0fterm_start_term\x18\x06 \x01(\x03\":\n\x0f\x46\x65tchLogRequest\x12\x13\n\x0b\x61\x66ter_index\x18\x01 \x01(\x03\x12\x12\n\nafter_term\x18\x02 \x01(\x03\"\x18\n\x16InstallSnapshotRequest\"1\n\rSnapshotChunk\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\x12\x12\n\ntotal_size\x18\x02 \x01(\x03\"W\n\x0eReplicationAck\x12\x15\n\rapplied_index\x18\x01 \x01(\x03\x12\x0f\n\x07success\x18\x02 \x01(\x08\x12\x0f\n\x07message\x18\x03 \x01(\t\x12\x0c\n\x04term\x18\x04 \x01(\x03\"j\n\x0bVoteRequest\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x14\n\x0c\x63\x61ndidate_id\x18\x02 \x01(\x05\x12\x12\n\nlast_index\x18\x03 \x01(\x03\x12\x11\n\tlast_term\x18\x04 \x01(\x03\x12\x10\n\x08pre_vote\x18\x05 \x01(\x08\"2\n\x0cVoteResponse\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x14\n\x0cvote_granted\x18\x02 \x01(\x08\"z\n\x10HeartbeatRequest\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x11\n\tleader_id\x18\x02 \x01(\x05\x12\x18\n\x10term_start_index\x18\x03 \x01(\x03\x12\x12\n\nlast_index\x18\x04 \x01(\x03\x12\x17\n\x0fterm_start_term\x18\x05 \x01(\x03\"2\n\x11HeartbeatResponse\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x0f\n\x07success\x18\x02 \x01(\x08\"-\n\x0fHashTreeRequest\x12\x0c\n\x04tree\x18\x01 \x01(\t\x12\x0c\n\x04path\x18\x02 \x01(\t\"(\n\x08HashNode\x12\x0c\n\x04path\x18\x01 \x01(\t\x12\x0e\n\x06\x64igest\x18\x02 \x01(\x0c\"[\n\x10HashTreeResponse\x12\x0e\n\x06\x64igest\x18\x01 \x01(\x0c\x12 \n\x08\x63hildren\x18\x02 \x03(\x0b\x32\x0e.chat.HashNode\x12\x15\n\rapplied_index\x18\x03 \x01(\x03\"?\n\x13\x46\x65tchEntriesRequest\x12\x11\n\tusernames\x18\x01 \x03(\t\x12\x15\n\rconversations\x18\x02 \x03(\t\"F\n\x12\x43onversationRecord\x12\x0b\n\x03key\x18\x01 \x01(\t\x12#\n\x08messages\x18\x02 \x03(\x0b\x32\x11.chat.ChatMessage\"\x7f\n\x14\x46\x65tchEntriesResponse\x12\x1f\n\x05users\x18\x01 \x03(\x0b\x32\x10.chat.UserRecord\x12/\n\rconversations\x18\x02 \x03(\x0b\x32\x18.chat.ConversationRecord\x12\x15\n\rapplied_index\x18\x03 \x01(\x03\"g\n\x0cLoginRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\x12\x19\n\x11min_applied_index\x18\x03 \x01(\x03\x12\x18\n\x10max_staleness_ms\x18\x04 \x01(\x03\"^\n\rLoginResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x14\n\x0cunread_count\x18\x03 \x01(\x05\x12\x15\n\rapplied_index\x18\x04 \x01(\x03\":\n\x14\x43reateAccountRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"L\n\x15\x43reateAccountResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x11\n\tlog_index\x18\x03 \x01(\x03\"!\n\rLogOffRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"2\n\x0eLogOffResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"(\n\x14\x44\x65leteAccountRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"L\n\x15\x44\x65leteAccountResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x11\n\tlog_index\x18\x03 \x01(\x03\"H\n\x12SendMessageRequest\x12\x0e\n\x06sender\x18\x01 \x01(\t\x12\x11\n\trecipient\x18\x02 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x03 \x01(\t\"J\n\x13SendMessageResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x11\n\tlog_index\x18\x03 \x01(\x03\"6\n\x13ReadMessagesRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\r\n\x05limit\x18\x02 \x01(\x05\"N\n\x14ReadMessagesResponse\x12#\n\x08messages\x18\x01 \x03(\x0b\x32\x11.chat.ChatMessage\x12\x11\n\tlog_index\x18\x02 \x01(\x03\">\n\x15\x44\x65leteMessagesRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x13\n\x0bmessage_ids\x18\x02 \x03(\x05\"M\n\x16\x44\x65leteMessagesResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x11\n\tlog_index\x18\x03 \x01(\x03\"\xa8\x01\n\x17ViewConversationRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x12\n\nother_user\x18\x02 \x01(\t\x12\x11\n\tbefore_id\x18\x03 \x01(\x05\x12\x10\n\x08\x61\x66ter_id\x18\x04 \x01(\x05\x12\r\n\x05limit\x18\x05 \x01(\x05\x12\x19\n\x11min_applied_index\x18\x06 \x01(\x03\x12\x18\n\x10max_staleness_ms\x18\x07 \x01(\x03\"k\n\x18ViewConversationResponse\x12#\n\x08messages\x18\x01 \x03(\x0b\x32\x11.chat.ChatMessage\x12\x13\n\x0bnext_cursor\x18\x02 \x01(\x05\x12\x15\n\rapplied_index\x18\x03 \x01(\x03\"\x95\x01\n\x13ListAccountsRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08wildcard\x18\x02 \x01(\t\x12\x11\n\tpage_size\x18\x03 \x01(\x05\x12\x12\n\npage_token\x18\x04 \x01(\t\x12\x19\n\x11min_applied_index\x18\x05 \x01(\x03\x12\x18\n\x10max_staleness_ms\x18\x06 \x01(\x03\"Y\n\x14ListAccountsResponse\x12\x11\n\tusernames\x18\x01 \x03(\t\x12\x17\n\x0fnext_page_token\x18\x02 \x01(\t\x12\x15\n\rapplied_index\x18\x03 \x01(\x03\"$\n\x10SubscribeRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"M\n\x0b\x43hatMessage\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0e\n\x06sender\x18\x02 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x03 \x01(\t\x12\x11\n\ttimestamp\x18\x04 \x01(\t\"L\n\x0eSnapshotHeader\x12\x13\n\x0bnext_msg_id\x18\x01 \x01(\x05\x12\x12\n\nlast_index\x18\x02 \x01(\x03\x12\x11\n\tlast_term\x18\x03 \x01(\x03\"X\n\nUserRecord\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x15\n\rpassword_hash\x18\x02 \x01(\t\x12!\n\x06unread\x18\x03 \x03(\x0b\x32\x11.chat.ChatMessage\"d\n\x16\x43onversationIndexEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\x0e\n\x06offset\x18\x02 \x01(\x04\x12\x0e\n\x06length\x18\x03 \x01(\x04\x12\r\n\x05\x63ount\x18\x04 \x01(\r\x12\x0e\n\x06\x64igest\x18\x05 \x01(\x0c\"x\n\rSnapshotIndex\x12\x33\n\rconversations\x18\x01 \x03(\x0b\x32\x1c.chat.ConversationIndexEntry\x12\x13\n\x0bmessage_ids\x18\x02 \x01(\x0c\x12\x1d\n\x15message_conversations\x18\x03 \x01(\x0c\"\x8a\x01\n\x0eSnapshotRecord\x12&\n\x06header\x18\x01 \x01(\x0b\x32\x14.chat.SnapshotHeaderH\x00\x12 \n\x04user\x18\x02 \x01(\x0b\x32\x10.chat.UserRecordH\x00\x12$\n\x05index\x18\x03 \x01(\x0b\x32\x13.chat.SnapshotIndexH\x00\x42\x08\n\x06record\"N\n\x15\x44\x65liverMessageRequest\x12\x11\n\trecipient\x18\x01 \x01(\t\x12\"\n\x07message\x18\x02 \x01(\x0b\x32\x11.chat.ChatMessage\"M\n\x16\x44\x65liverMessageResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x11\n\tlog_index\x18\x03 \x01(\x03\"^\n\x13MarkPageReadRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x12\n\nother_user\x18\x02 \x01(\t\x12\x10\n\x08\x66irst_id\x18\x03 \x01(\x05\x12\x0f\n\x07last_id\x18\x04 \x01(\x05\")\n\x14MarkPageReadResponse\x12\x11\n\tlog_index\x18\x01 \x01(\x03\x32\x83\x0b\n\x0b\x43hatService\x12\x32\n\x05Login\x12\x12.chat.LoginRequest\x1a\x13.chat.LoginResponse\"\x00\x12J\n\rCreateAccount\x12\x1a.chat.CreateAccountRequest\x1a\x1b.chat.CreateAccountResponse\"\x00\x12\x35\n\x06LogOff\x12\x13.chat.LogOffRequest\x1a\x14.chat.LogOffResponse\"\x00\x12J\n\rDeleteAccount\x12\x1a.chat.DeleteAccountRequest\x1a\x1b.chat.DeleteAccountResponse\"\x00\x12\x44\n\x0bSendMessage\x12\x18.chat.SendMessageRequest\x1a\x19.chat.SendMessageResponse\"\x00\x12G\n\x0cReadMessages\x12\x19.chat.ReadMessagesRequest\x1a\x1a.chat.ReadMessagesResponse\"\x00\x12M\n\x0e\x44\x65leteMessages\x12\x1b.chat.DeleteMessagesRequest\x1a\x1c.chat.DeleteMessagesResponse\"\x00\x12S\n\x10ViewConversation\x12\x1d.chat.ViewConversationRequest\x1a\x1e.chat.ViewConversationResponse\"\x00\x12G\n\x0cListAccounts\x12\x19.chat.ListAccountsRequest\x1a\x1a.chat.ListAccountsResponse\"\x00\x12\x44\n\x13SubscribeToMessages\x12\x16.chat.SubscribeRequest\x1a\x11.chat.ChatMessage\"\x00\x30\x01\x12T\n\x11ReplicateMutation\x12\x1e.chat.ReplicateMutationRequest\x1a\x1f.chat.ReplicateMutationResponse\x12\x43\n\x0fStreamMutations\x12\x16.chat.ReplicationBatch\x1a\x14.chat.ReplicationAck(\x01\x30\x01\x12;\n\x08\x46\x65tchLog\x12\x15.chat.FetchLogRequest\x1a\x16.chat.ReplicationBatch0\x01\x12\x46\n\x0fInstallSnapshot\x12\x1c.chat.InstallSnapshotRequest\x1a\x13.chat.SnapshotChunk0\x01\x12\x34\n\x0bRequestVote\x12\x11.chat.VoteRequest\x1a\x12.chat.VoteResponse\x12<\n\tHeartbeat\x12\x16.chat.HeartbeatRequest\x1a\x17.chat.HeartbeatResponse\x12@\n\x0f\x43ompareHashTree\x12\x15.chat.HashTreeRequest\x1a\x16.chat.HashTreeResponse\x12\x45\n\x0c\x46\x65tchEntries\x12\x19.chat.FetchEntriesRequest\x1a\x1a.chat.FetchEntriesResponse\x12K\n\x0e\x44\x65liverMessage\x12\x1b.chat.DeliverMessageRequest\x1a\x1c.chat.DeliverMessageResponse\x12\x45\n\x0cMarkPageRead\x12\x19.chat.MarkPageReadRequest\x1a\x1a.chat.MarkPageReadResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,49 +32,111 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chat_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_REPLICATEMUTATIONREQUEST']._serialized_start=20
-  _globals['_REPLICATEMUTATIONREQUEST']._serialized_end=87
-  _globals['_REPLICATEMUTATIONRESPONSE']._serialized_start=89
-  _globals['_REPLICATEMUTATIONRESPONSE']._serialized_end=150
-  _globals['_LOGINREQUEST']._serialized_start=152
-  _globals['_LOGINREQUEST']._serialized_end=202
-  _globals['_LOGINRESPONSE']._serialized_start=204
-  _globals['_LOGINRESPONSE']._serialized_end=275
-  _globals['_CREATEACCOUNTREQUEST']._serialized_start=277
-  _globals['_CREATEACCOUNTREQUEST']._serialized_end=335
-  _globals['_CREATEACCOUNTRESPONSE']._serialized_start=337
-  _globals['_CREATEACCOUNTRESPONSE']._serialized_end=394
-  _globals['_LOGOFFREQUEST']._serialized_start=396
-  _globals['_LOGOFFREQUEST']._serialized_end=429
-  _globals['_LOGOFFRESPONSE']._serialized_start=431
-  _globals['_LOGOFFRESPONSE']._serialized_end=481
-  _globals['_DELETEACCOUNTREQUEST']._serialized_start=483
-  _globals['_DELETEACCOUNTREQUEST']._serialized_end=523
-  _globals['_DELETEACCOUNTRESPONSE']._serialized_start=525
-  _globals['_DELETEACCOUNTRESPONSE']._serialized_end=582
-  _globals['_SENDMESSAGEREQUEST']._serialized_start=584
-  _globals['_SENDMESSAGEREQUEST']._serialized_end=656
-  _globals['_SENDMESSAGERESPONSE']._serialized_start=658
-  _globals['_SENDMESSAGERESPONSE']._serialized_end=713
-  _globals['_READMESSAGESREQUEST']._serialized_start=715
-  _globals['_READMESSAGESREQUEST']._serialized_end=769
-  _globals['_READMESSAGESRESPONSE']._serialized_start=771
-  _globals['_READMESSAGESRESPONSE']._serialized_end=830
-  _globals['_DELETEMESSAGESREQUEST']._serialized_start=832
-  _globals['_DELETEMESSAGESREQUEST']._serialized_end=894
-  _globals['_DELETEMESSAGESRESPONSE']._serialized_start=896
-  _globals['_DELETEMESSAGESRESPONSE']._serialized_end=954
-  _globals['_VIEWCONVERSATIONREQUEST']._serialized_start=956
-  _globals['_VIEWCONVERSATIONREQUEST']._serialized_end=1019
-  _globals['_VIEWCONVERSATIONRESPONSE']._serialized_start=1021
-  _globals['_VIEWCONVERSATIONRESPONSE']._serialized_end=1084
-  _globals['_LISTACCOUNTSREQUEST']._serialized_start=1086
-  _globals['_LISTACCOUNTSREQUEST']._serialized_end=1143
-  _globals['_LISTACCOUNTSRESPONSE']._serialized_start=1145
-  _globals['_LISTACCOUNTSRESPONSE']._serialized_end=1186
-  _globals['_SUBSCRIBEREQUEST']._serialized_start=1188
-  _globals['_SUBSCRIBEREQUEST']._serialized_end=1224
-  _globals['_CHATMESSAGE']._serialized_start=1226
-  _globals['_CHATMESSAGE']._serialized_end=1303
-  _globals['_CHATSERVICE']._serialized_start=1306
-  _globals['_CHATSERVICE']._serialized_end=2114
+  _globals['_REPLICATEMUTATIONREQUEST']._serialized_end=125
+  _globals['_REPLICATEMUTATIONRESPONSE']._serialized_start=127
+  _globals['_REPLICATEMUTATIONRESPONSE']._serialized_end=188
+  _globals['_CREATEACCOUNTMUTATION']._serialized_start=190
+  _globals['_CREATEACCOUNTMUTATION']._serialized_end=254
+  _globals['_SENDMESSAGEMUTATION']._serialized_start=257
+  _globals['_SENDMESSAGEMUTATION']._serialized_end=394
+  _globals['_DELIVERMESSAGEMUTATION']._serialized_start=396
+  _globals['_DELIVERMESSAGEMUTATION']._serialized_end=494
+  _globals['_DELETEACCOUNTMUTATION']._serialized_start=496
+  _globals['_DELETEACCOUNTMUTATION']._serialized_end=537
+  _globals['_MARKREADMUTATION']._serialized_start=539
+  _globals['_MARKREADMUTATION']._serialized_end=596
+  _globals['_DELETEMESSAGESMUTATION']._serialized_start=598
+  _globals['_DELETEMESSAGESMUTATION']._serialized_end=661
+  _globals['_MUTATIONRECORD']._serialized_start=664
+  _globals['_MUTATIONRECORD']._serialized_end=1053
+  _globals['_REPLICATIONBATCH']._serialized_start=1056
+  _globals['_REPLICATIONBATCH']._serialized_end=1221
+  _globals['_FETCHLOGREQUEST']._serialized_start=1223
+  _globals['_FETCHLOGREQUEST']._serialized_end=1281
+  _globals['_INSTALLSNAPSHOTREQUEST']._serialized_start=1283
+  _globals['_INSTALLSNAPSHOTREQUEST']._serialized_end=1307
+  _globals['_SNAPSHOTCHUNK']._serialized_start=1309
+  _globals['_SNAPSHOTCHUNK']._serialized_end=1358
+  _globals['_REPLICATIONACK']._serialized_start=1360
+  _globals['_REPLICATIONACK']._serialized_end=1447
+  _globals['_VOTEREQUEST']._serialized_start=1449
+  _globals['_VOTEREQUEST']._serialized_end=1555
+  _globals['_VOTERESPONSE']._serialized_start=1557
+  _globals['_VOTERESPONSE']._serialized_end=1607
+  _globals['_HEARTBEATREQUEST']._serialized_start=1609
+  _globals['_HEARTBEATREQUEST']._serialized_end=1731
+  _globals['_HEARTBEATRESPONSE']._serialized_start=1733
+  _globals['_HEARTBEATRESPONSE']._serialized_end=1783
+  _globals['_HASHTREEREQUEST']._serialized_start=1785
+  _globals['_HASHTREEREQUEST']._serialized_end=1830
+  _globals['_HASHNODE']._serialized_start=1832
+  _globals['_HASHNODE']._serialized_end=1872
+  _globals['_HASHTREERESPONSE']._serialized_start=1874
+  _globals['_HASHTREERESPONSE']._serialized_end=1965
+  _globals['_FETCHENTRIESREQUEST']._serialized_start=1967
+  _globals['_FETCHENTRIESREQUEST']._serialized_end=2030
+  _globals['_CONVERSATIONRECORD']._serialized_start=2032
+  _globals['_CONVERSATIONRECORD']._serialized_end=2102
+  _globals['_FETCHENTRIESRESPONSE']._serialized_start=2104
+  _globals['_FETCHENTRIESRESPONSE']._serialized_end=2231
+  _globals['_LOGINREQUEST']._serialized_start=2233
+  _globals['_LOGINREQUEST']._serialized_end=2336
+  _globals['_LOGINRESPONSE']._serialized_start=2338
+  _globals['_LOGINRESPONSE']._serialized_end=2432
+  _globals['_CREATEACCOUNTREQUEST']._serialized_start=2434
+  _globals['_CREATEACCOUNTREQUEST']._serialized_end=2492
+  _globals['_CREATEACCOUNTRESPONSE']._serialized_start=2494
+  _globals['_CREATEACCOUNTRESPONSE']._serialized_end=2570
+  _globals['_LOGOFFREQUEST']._serialized_start=2572
+  _globals['_LOGOFFREQUEST']._serialized_end=2605
+  _globals['_LOGOFFRESPONSE']._serialized_start=2607
+  _globals['_LOGOFFRESPONSE']._serialized_end=2657
+  _globals['_DELETEACCOUNTREQUEST']._serialized_start=2659
+  _globals['_DELETEACCOUNTREQUEST']._serialized_end=2699
+  _globals['_DELETEACCOUNTRESPONSE']._serialized_start=2701
+  _globals['_DELETEACCOUNTRESPONSE']._serialized_end=2777
+  _globals['_SENDMESSAGEREQUEST']._serialized_start=2779
+  _globals['_SENDMESSAGEREQUEST']._serialized_end=2851
+  _globals['_SENDMESSAGERESPONSE']._serialized_start=2853
+  _globals['_SENDMESSAGERESPONSE']._serialized_end=2927
+  _globals['_READMESSAGESREQUEST']._serialized_start=2929
+  _globals['_READMESSAGESREQUEST']._serialized_end=2983
+  _globals['_READMESSAGESRESPONSE']._serialized_start=2985
+  _globals['_READMESSAGESRESPONSE']._serialized_end=3063
+  _globals['_DELETEMESSAGESREQUEST']._serialized_start=3065
+  _globals['_DELETEMESSAGESREQUEST']._serialized_end=3127
+  _globals['_DELETEMESSAGESRESPONSE']._serialized_start=3129
+  _globals['_DELETEMESSAGESRESPONSE']._serialized_end=3206
+  _globals['_VIEWCONVERSATIONREQUEST']._serialized_start=3209
+  _globals['_VIEWCONVERSATIONREQUEST']._serialized_end=3377
+  _globals['_VIEWCONVERSATIONRESPONSE']._serialized_start=3379
+  _globals['_VIEWCONVERSATIONRESPONSE']._serialized_end=3486
+  _globals['_LISTACCOUNTSREQUEST']._serialized_start=3489
+  _globals['_LISTACCOUNTSREQUEST']._serialized_end=3638
+  _globals['_LISTACCOUNTSRESPONSE']._serialized_start=3640
+  _globals['_LISTACCOUNTSRESPONSE']._serialized_end=3729
+  _globals['_SUBSCRIBEREQUEST']._serialized_start=3731
+  _globals['_SUBSCRIBEREQUEST']._serialized_end=3767
+  _globals['_CHATMESSAGE']._serialized_start=3769
+  _globals['_CHATMESSAGE']._serialized_end=3846
+  _globals['_SNAPSHOTHEADER']._serialized_start=3848
+  _globals['_SNAPSHOTHEADER']._serialized_end=3924
+  _globals['_USERRECORD']._serialized_start=3926
+  _globals['_USERRECORD']._serialized_end=4014
+  _globals['_CONVERSATIONINDEXENTRY']._serialized_start=4016
+  _globals['_CONVERSATIONINDEXENTRY']._serialized_end=4116
+  _globals['_SNAPSHOTINDEX']._serialized_start=4118
+  _globals['_SNAPSHOTINDEX']._serialized_end=4238
+  _globals['_SNAPSHOTRECORD']._serialized_start=4241
+  _globals['_SNAPSHOTRECORD']._serialized_end=4379
+  _globals['_DELIVERMESSAGEREQUEST']._serialized_start=4381
+  _globals['_DELIVERMESSAGEREQUEST']._serialized_end=4459
+  _globals['_DELIVERMESSAGERESPONSE']._serialized_start=4461
+  _globals['_DELIVERMESSAGERESPONSE']._serialized_end=4538
+  _globals['_MARKPAGEREADREQUEST']._serialized_start=4540
+  _globals['_MARKPAGEREADREQUEST']._serialized_end=4634
+  _globals['_MARKPAGEREADRESPONSE']._serialized_start=4636
+  _globals['_MARKPAGEREADRESPONSE']._serialized_end=4677
+  _globals['_CHATSERVICE']._serialized_start=4680
+  _globals['_CHATSERVICE']._serialized_end=6091
 # @@protoc_insertion_point(module_scope)
@@ -90,6 +90,51 @@ class ChatServiceStub(object):
                 request_serializer=chat__pb2.ReplicateMutationRequest.SerializeToString,
                 response_deserializer=chat__pb2.ReplicateMutationResponse.FromString,
                 _registered_method=True)
+        self.StreamMutations = channel.stream_stream(
+                '/chat.ChatService/StreamMutations',
+                request_serializer=chat__pb2.ReplicationBatch.SerializeToString,
+                response_deserializer=chat__pb2.ReplicationAck.FromString,
+                _registered_method=True)
+        self.FetchLog = channel.unary_stream(
+                '/chat.ChatService/FetchLog',
+                request_serializer=chat__pb2.FetchLogRequest.SerializeToString,
+                response_deserializer=chat__pb2.ReplicationBatch.FromString,
+                _registered_method=True)
+        self.InstallSnapshot = channel.unary_stream(
+                '/chat.ChatService/InstallSnapshot',
+                request_serializer=chat__pb2.InstallSnapshotRequest.SerializeToString,
+                response_deserializer=chat__pb2.SnapshotChunk.FromString,
+                _registered_method=True)
+        self.RequestVote = channel.unary_unary(
+                '/chat.ChatService/RequestVote',
+                request_serializer=chat__pb2.VoteRequest.SerializeToString,
+                response_deserializer=chat__pb2.VoteResponse.FromString,
+                _registered_method=True)
+        self.Heartbeat = channel.unary_unary(
+                '/chat.ChatService/Heartbeat',
+                request_serializer=chat__pb2.HeartbeatRequest.SerializeToString,
+                response_deserializer=chat__pb2.HeartbeatResponse.FromString,
+                _registered_method=True)
+        self.CompareHashTree = channel.unary_unary(
+                '/chat.ChatService/CompareHashTree',
+                request_serializer=chat__pb2.HashTreeRequest.SerializeToString,
+                response_deserializer=chat__pb2.HashTreeResponse.FromString,
+                _registered_method=True)
+        self.FetchEntries = channel.unary_unary(
+                '/chat.ChatService/FetchEntries',
+                request_serializer=chat__pb2.FetchEntriesRequest.SerializeToString,
+                response_deserializer=chat__pb2.FetchEntriesResponse.FromString,
+                _registered_method=True)
+        self.DeliverMessage = channel.unary_unary(
+                '/chat.ChatService/DeliverMessage',
+                request_serializer=chat__pb2.DeliverMessageRequest.SerializeToString,
+                response_deserializer=chat__pb2.DeliverMessageResponse.FromString,
+                _registered_method=True)
+        self.MarkPageRead = channel.unary_unary(
+                '/chat.ChatService/MarkPageRead',
+                request_serializer=chat__pb2.MarkPageReadRequest.SerializeToString,
+                response_deserializer=chat__pb2.MarkPageReadResponse.FromString,
+                _registered_method=True)
 
 
 class ChatServiceServicer(object):
@@ -167,6 +212,68 @@ class ChatServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def StreamMutations(self, request_iterator, context):
+        """The leader streams its mutation log; the follower acks each batch.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def FetchLog(self, request, context):
+        """A follower catching up pulls the log after its last applied index, or,
+        if that part of the log is gone (OUT_OF_RANGE), the snapshot first.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def InstallSnapshot(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RequestVote(self, request, context):
+        """Leader election
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Heartbeat(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def CompareHashTree(self, request, context):
+        """Anti-entropy: a follower walks the leader's hash trees down to the
+        users and conversations it disagrees on, then fetches those.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def FetchEntries(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def DeliverMessage(self, request, context):
+        """Between shards: the shard holding a conversation hands a new message to
+        the recipient's shard, and marks a viewed page read on the viewer's.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def MarkPageRead(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -225,6 +332,51 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.ReplicateMutationRequest.FromString,
                     response_serializer=chat__pb2.ReplicateMutationResponse.SerializeToString,
             ),
+            'StreamMutations': grpc.stream_stream_rpc_method_handler(
+                    servicer.StreamMutations,
+                    request_deserializer=chat__pb2.ReplicationBatch.FromString,
+                    response_serializer=chat__pb2.ReplicationAck.SerializeToString,
+            ),
+            'FetchLog': grpc.unary_stream_rpc_method_handler(
+                    servicer.FetchLog,
+                    request_deserializer=chat__pb2.FetchLogRequest.FromString,
+                    response_serializer=chat__pb2.ReplicationBatch.SerializeToString,
+            ),
+            'InstallSnapshot': grpc.unary_stream_rpc_method_handler(
+                    servicer.InstallSnapshot,
+                    request_deserializer=chat__pb2.InstallSnapshotRequest.FromString,
+                    response_serializer=chat__pb2.SnapshotChunk.SerializeToString,
+            ),
+            'RequestVote': grpc.unary_unary_rpc_method_handler(
+                    servicer.RequestVote,
+                    request_deserializer=chat__pb2.VoteRequest.FromString,
+                    response_serializer=chat__pb2.VoteResponse.SerializeToString,
+            ),
+            'Heartbeat': grpc.unary_unary_rpc_method_handler(
+                    servicer.Heartbeat,
+                    request_deserializer=chat__pb2.HeartbeatRequest.FromString,
+                    response_serializer=chat__pb2.HeartbeatResponse.SerializeToString,
+            ),
+            'CompareHashTree': grpc.unary_unary_rpc_method_handler(
+                    servicer.CompareHashTree,
+                    request_deserializer=chat__pb2.HashTreeRequest.FromString,
+                    response_serializer=chat__pb2.HashTreeResponse.SerializeToString,
+            ),
+            'FetchEntries': grpc.unary_unary_rpc_method_handler(
+                    servicer.FetchEntries,
+                    request_deserializer=chat__pb2.FetchEntriesRequest.FromString,
+                    response_serializer=chat__pb2.FetchEntriesResponse.SerializeToString,
+            ),
+            'DeliverMessage': grpc.unary_unary_rpc_method_handler(
+                    servicer.DeliverMessage,
+                    request_deserializer=chat__pb2.DeliverMessageRequest.FromString,
+                    response_serializer=chat__pb2.DeliverMessageResponse.SerializeToString,
+            ),
+            'MarkPageRead': grpc.unary_unary_rpc_method_handler(
+                    servicer.MarkPageRead,
+                    request_deserializer=chat__pb2.MarkPageReadRequest.FromString,
+                    response_serializer=chat__pb2.MarkPageReadResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'chat.ChatService', rpc_method_handlers)
@@ -533,3 +685,246 @@ class ChatService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def StreamMutations(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/chat.ChatService/StreamMutations',
+            chat__pb2.ReplicationBatch.SerializeToString,
+            chat__pb2.ReplicationAck.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def FetchLog(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/chat.ChatService/FetchLog',
+            chat__pb2.FetchLogRequest.SerializeToString,
+            chat__pb2.ReplicationBatch.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def InstallSnapshot(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/chat.ChatService/InstallSnapshot',
+            chat__pb2.InstallSnapshotRequest.SerializeToString,
+            chat__pb2.SnapshotChunk.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def RequestVote(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/RequestVote',
+            chat__pb2.VoteRequest.SerializeToString,
+            chat__pb2.VoteResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Heartbeat(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/Heartbeat',
+            chat__pb2.HeartbeatRequest.SerializeToString,
+            chat__pb2.HeartbeatResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def CompareHashTree(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/CompareHashTree',
+            chat__pb2.HashTreeRequest.SerializeToString,
+            chat__pb2.HashTreeResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def FetchEntries(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/FetchEntries',
+            chat__pb2.FetchEntriesRequest.SerializeToString,
+            chat__pb2.FetchEntriesResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def DeliverMessage(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/DeliverMessage',
+            chat__pb2.DeliverMessageRequest.SerializeToString,
+            chat__pb2.DeliverMessageResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def MarkPageRead(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/chat.ChatService/MarkPageRead',
+            chat__pb2.MarkPageReadRequest.SerializeToString,
+            chat__pb2.MarkPageReadResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -13,30 +13,144 @@ import chat_pb2_grpc
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+# Calls that can be sent twice without writing twice; a CreateAccount that
+# did go through the first time is turned away as a duplicate name
+IDEMPOTENT_METHODS = {"Login", "ListAccounts", "ViewConversation", "LogOff", "DeleteMessages", "CreateAccount"}
+
+def never_applied(error):
+    """
+    Whether a call that failed with UNAVAILABLE certainly did not reach the
+    leader: we (or the follower passing it on) could not connect, or a
+    server that is not the leader turned it away with "leader" metadata.
+    """
+    if "leader" in dict(error.trailing_metadata() or ()):
+        return True
+    return (error.details() or "").startswith("failed to connect")
+
+class FailoverStub:
+    """
+    Stands in for a ChatServiceStub over several servers. Every call goes to
+    the server believed to be the leader; when a call fails with UNAVAILABLE
+    it is retried on the leader named in the error's "leader" metadata, or
+    else on the next server, until retry_window seconds have passed. Other
+    writes are only retried when never_applied() says the leader did not
+    get them, so a lost response cannot send a message twice. Reads sent
+    through read() are spread over all the servers instead.
+    """
+
+    def __init__(self, addresses, retry_window=5.0, retry_interval=0.1):
+        self.addresses = list(addresses)
+        self.retry_window = retry_window
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.current = self.addresses[0]
+        self.next_read = 0
+
+    def stub_for(self, address):
+        with self.lock:
+            if address not in self.channels:
+                self.channels[address] = grpc.insecure_channel(address)
+            return chat_pb2_grpc.ChatServiceStub(self.channels[address])
+
+    def drop_channel(self, address):
+        # A server that is down gets a fresh channel next time, so that the
+        # next try reconnects right away instead of waiting out gRPC's backoff.
+        with self.lock:
+            channel = self.channels.pop(address, None)
+        if channel is not None:
+            channel.close()
+
+    def failover(self, address, error):
+        """
+        Move on from `address` after it answered with `error`.
+        """
+        leader = dict(error.trailing_metadata() or ()).get("leader")
+        if not leader:
+            self.drop_channel(address)
+        with self.lock:
+            if self.current != address:
+                return  # another call already moved on
+            if leader and leader != address:
+                if leader not in self.addresses:
+                    self.addresses.append(leader)
+                self.current = leader
+            else:
+                self.current = self.addresses[(self.addresses.index(address) + 1) % len(self.addresses)]
+
+    def read(self, method, request, **kwargs):
+        """
+        Send a read to each server in turn. A follower that is down, or too
+        far behind and turns the read away, leaves it to the leader.
+        """
+        with self.lock:
+            address = self.addresses[self.next_read % len(self.addresses)]
+            self.next_read += 1
+        if address != self.current:
+            try:
+                return getattr(self.stub_for(address), method)(request, **kwargs)
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.UNAVAILABLE:
+                    raise
+                if not dict(e.trailing_metadata() or ()).get("leader"):
+                    self.drop_channel(address)
+        return getattr(self, method)(request, **kwargs)
+
+    def __getattr__(self, method):
+        def call(request, **kwargs):
+            deadline = time.monotonic() + self.retry_window
+            while True:
+                address = self.current
+                try:
+                    return getattr(self.stub_for(address), method)(request, **kwargs)
+                except grpc.RpcError as e:
+                    if e.code() != grpc.StatusCode.UNAVAILABLE or time.monotonic() > deadline:
+                        raise
+                    self.failover(address, e)
+                    if method not in IDEMPOTENT_METHODS and not never_applied(e):
+                        raise
+                time.sleep(self.retry_interval)
+        return call
+
+    def close(self):
+        with self.lock:
+            for channel in self.channels.values():
+                channel.close()
+            self.channels = {}
+
 class ChatClient:
-    def __init__(self, server_host='localhost', server_port=50051):
-        # Initialize connection parameters and gRPC channel
+    # Number of messages fetched per ViewConversation call
+    CONVERSATION_PAGE_SIZE = 20
+
+    def __init__(self, server_host='localhost', server_port=50051, servers=None):
+        # Initialize connection parameters and the gRPC stub; `servers` lists
+        # the other replicas ("host:port") to fail over to
         self.server_address = f"{server_host}:{server_port}"
-        self.channel = grpc.insecure_channel(self.server_address)
-        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+        self.stub = FailoverStub([self.server_address] + list(servers or []))
         self.username = None
         self.login_err = False  # Flag to track login errors
         self.message_thread = None
         self.running = True  # Flag to control the message receiving loop
+        self.logged_off = threading.Event()  # Set to end the current login's subscription
+        self.conversation_cursor = (None, 0)  # Last viewed conversation and its next page
+        self.applied_index = 0  # Newest log index seen, so reads from followers include our own writes
 
     def login(self, username, password):
         # Log in the user if not already logged in
         if self.username is None:
             try:
-                response = self.stub.Login(chat_pb2.LoginRequest(
+                response = self.stub.read("Login", chat_pb2.LoginRequest(
                     username=username,
-                    password=password
+                    password=password,
+                    min_applied_index=self.applied_index
                 ))
                 if response.success:
                     self.username = username
                     print(response.message)
                     # Start thread for receiving messages asynchronously
-                    self.message_thread = threading.Thread(target=self.receive_messages, daemon=True)
+                    self.logged_off = threading.Event()
+                    self.message_thread = threading.Thread(target=self.receive_messages,
+                                                           args=(self.logged_off,), daemon=True)
                     self.message_thread.start()
                 else:
                     self.login_err = True
@@ -54,6 +168,7 @@ class ChatClient:
                 username=username,
                 password=password
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             print(response.message)
         except grpc.RpcError as e:
             eprint(f"RPC Error: {e.details()}")
@@ -70,6 +185,7 @@ class ChatClient:
                 recipient=recipient,
                 content=message
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             print(response.message)
         except grpc.RpcError as e:
             eprint(f"RPC Error: {e.details()}")
@@ -77,12 +193,21 @@ class ChatClient:
     def list_accounts(self, wildcard="*"):
         # Retrieve and display accounts matching the wildcard pattern
         try:
-            response = self.stub.ListAccounts(chat_pb2.ListAccountsRequest(
-                username=self.username,
-                wildcard=wildcard
-            ))
+            usernames = []
+            page_token = ""
+            while True:
+                response = self.stub.read("ListAccounts", chat_pb2.ListAccountsRequest(
+                    username=self.username,
+                    wildcard=wildcard,
+                    page_token=page_token,
+                    min_applied_index=self.applied_index
+                ))
+                usernames.extend(response.usernames)
+                page_token = response.next_page_token
+                if not page_token:
+                    break
             print("Matching accounts:")
-            print(", ".join(response.usernames))
+            print(", ".join(usernames))
         except grpc.RpcError as e:
             eprint(f"RPC Error: {e.details()}")
 
@@ -93,6 +218,7 @@ class ChatClient:
                 username=self.username,
                 limit=int(limit) if limit else 0
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             if response.messages:
                 print("Unread Messages:")
                 for msg in response.messages:
@@ -115,23 +241,33 @@ class ChatClient:
                 username=self.username,
                 message_ids=id_list
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             print(response.message)
         except grpc.RpcError as e:
             eprint(f"RPC Error: {e.details()}")
 
-    def view_conversation(self, other_user):
-        # View the conversation history with another user
+    def view_conversation(self, other_user, before_id=0):
+        # View the most recent page of the conversation with another user,
+        # or the page before before_id when scrolling back
         try:
-            response = self.stub.ViewConversation(chat_pb2.ViewConversationRequest(
+            response = self.stub.read("ViewConversation", chat_pb2.ViewConversationRequest(
                 username=self.username,
-                other_user=other_user
+                other_user=other_user,
+                before_id=before_id,
+                limit=self.CONVERSATION_PAGE_SIZE,
+                min_applied_index=self.applied_index
             ))
+            self.applied_index = max(self.applied_index, response.applied_index)
             if response.messages:
                 print("Conversation:")
                 for msg in response.messages:
                     print(f"[ID {msg.id}] {msg.sender} ({msg.timestamp}): {msg.content}")
             else:
                 print("No conversation history found")
+            # Remember where to continue for "View older messages"
+            self.conversation_cursor = (other_user, response.next_cursor)
+            if response.next_cursor:
+                print("Older messages are available (command 8)")
         except grpc.RpcError as e:
             eprint(f"RPC Error: {e.details()}")
 
@@ -141,8 +277,10 @@ class ChatClient:
             response = self.stub.DeleteAccount(chat_pb2.DeleteAccountRequest(
                 username=self.username
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             print(response.message)
             if response.success:
+                self.logged_off.set()
                 self.username = None
         except grpc.RpcError as e:
             eprint(f"RPC Error: {e.details()}")
@@ -152,6 +290,8 @@ class ChatClient:
         if not self.username:
             return
         
+        # before the call, so the stream it closes is not opened again
+        self.logged_off.set()
         try:
             response = self.stub.LogOff(chat_pb2.LogOffRequest(
                 username=self.username
@@ -161,23 +301,33 @@ class ChatClient:
         except grpc.RpcError as e:
             eprint(f"RPC Error: {e.details()}")
 
-    def receive_messages(self):
-        # Continuously listen for new messages via gRPC streaming
-        try:
-            subscription_request = chat_pb2.SubscribeRequest(username=self.username)
-            for message in self.stub.SubscribeToMessages(subscription_request):
-                print(f"\nNew message from {message.sender}: {message.content}")
-                print("Enter command: ", end="", flush=True)
-        except grpc.RpcError as e:
-            # Only show errors if the client is still running
-            if self.running:
-                eprint(f"Error in message subscription: {e.details()}")
+    def receive_messages(self, logged_off):
+        # Continuously listen for new messages via gRPC streaming, and
+        # subscribe again on the new leader if the server goes away. The
+        # server ends the stream when we log off, and then we are done.
+        subscription_request = chat_pb2.SubscribeRequest(username=self.username)
+        while self.running and not logged_off.is_set():
+            address = self.stub.current
+            try:
+                for message in self.stub.SubscribeToMessages(subscription_request):
+                    print(f"\nNew message from {message.sender}: {message.content}")
+                    print("Enter command: ", end="", flush=True)
+                return
+            except grpc.RpcError as e:
+                # Only show errors if the client is still running
+                if not self.running:
+                    return
+                if e.code() != grpc.StatusCode.UNAVAILABLE:
+                    eprint(f"Error in message subscription: {e.details()}")
+                    return
+                self.stub.failover(address, e)
+            time.sleep(self.stub.retry_interval)
 
     def close(self):
         # Cleanly close the client by logging off and closing the channel
         self.running = False
         self.log_off()
-        self.channel.close()
+        self.stub.close()
         print("Connection closed")
 
 # Function to handle user commands interactively via the terminal
@@ -219,7 +369,8 @@ def handle_user(client):
             print("5. Delete account")
             print("6. Log off")
             print("7. View conversation with a user")
-            choice = input("Enter a command number (1-7): ")
+            print("8. View older messages")
+            choice = input("Enter a command number (1-8): ")
             if choice == "1":
                 recipient = input("Enter the recipient's username: ")
                 message = input("Enter the message: ")
@@ -242,6 +393,12 @@ def handle_user(client):
             elif choice == "7":
                 other_user = input("Enter the username to view conversation with: ")
                 client.view_conversation(other_user)
+            elif choice == "8":
+                other_user, before_id = client.conversation_cursor
+                if before_id:
+                    client.view_conversation(other_user, before_id)
+                else:
+                    print("No older messages to show")
             else:
                 print("Invalid command. Please try again.")
 
@@ -249,7 +406,7 @@ if __name__ == '__main__':
     # Default connection settings for the chat server
     server_host = "localhost"
     server_port = 50051
-    client = ChatClient(server_host, server_port)
+    client = ChatClient(server_host, server_port, servers=["localhost:50052", "localhost:50053"])
 
     try:
         handle_user(client)
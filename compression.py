@@ -0,0 +1,255 @@
+import inspect
+import threading
+import zlib
+
+import grpc
+
+import chat_pb2
+
+
+ALGORITHMS = {
+    "none": None,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+
+def pack_records(records, threshold):
+    """
+    The ReplicationBatch fields for `records`: the records themselves, or,
+    from `threshold` bytes up (None for never), packed_records. gRPC can only compress a
+    client's stream as a whole, so batches are compressed one by one here
+    instead, and the small ones, which most batches are, not at all.
+    """
+    if threshold is None:
+        return {"records": records}
+    batch = chat_pb2.ReplicationBatch(records=records)
+    if batch.ByteSize() < threshold:
+        return {"records": records}
+    return {"packed_records": zlib.compress(batch.SerializeToString())}
+
+
+def unpack_records(batch):
+    """
+    The records of a ReplicationBatch built with pack_records().
+    """
+    if batch.packed_records:
+        return chat_pb2.ReplicationBatch.FromString(zlib.decompress(batch.packed_records)).records
+    return batch.records
+
+
+def compression_algorithm(name):
+    """
+    The grpc.Compression for a config value, None for "none".
+    """
+    if name not in ALGORITHMS:
+        raise ValueError(f"Unknown compression: {name}")
+    return ALGORITHMS[name]
+
+
+class MethodStats:
+    __slots__ = ("calls", "request_bytes", "response_bytes", "compressed", "compressed_bytes",
+                 "sampled_bytes", "sampled_wire_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.compressed = 0          # responses that went out compressed
+        self.compressed_bytes = 0    # their size before compression
+        self.sampled_bytes = 0       # the ones also compressed with zlib to estimate the ratio
+        self.sampled_wire_bytes = 0
+
+    @property
+    def response_wire_bytes(self):
+        """
+        Response bytes after compression, estimated from the sampled ratio.
+        """
+        if not self.sampled_bytes:
+            return self.response_bytes
+        compressed_wire = self.compressed_bytes * self.sampled_wire_bytes / self.sampled_bytes
+        return self.response_bytes - self.compressed_bytes + round(compressed_wire)
+
+
+class CompressionInterceptor(grpc.ServerInterceptor):
+    """
+    Compresses responses of at least `threshold` bytes with `algorithm`
+    and leaves smaller ones (acks, SendMessage replies) alone, since
+    compressing them costs CPU and saves nothing. Counts request and
+    response bytes per method along the way; see report(). Compressing a
+    response again just to measure it would double the CPU spent on
+    compression, so only one compressed response in `sample_every` is
+    measured and the rest are estimated from it.
+    """
+
+    def __init__(self, algorithm=None, threshold=1024, sample_every=16):
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.sample_every = sample_every
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def method_stats(self, method):
+        with self.lock:
+            stats = self.stats.get(method)
+            if stats is None:
+                stats = self.stats[method] = MethodStats()
+            return stats
+
+    def count_request(self, stats, request):
+        size = request.ByteSize()
+        with self.lock:
+            stats.request_bytes += size
+
+    def count_response(self, stats, response, compressed):
+        size = response.ByteSize()
+        sample = False
+        with self.lock:
+            stats.response_bytes += size
+            if compressed:
+                stats.compressed += 1
+                stats.compressed_bytes += size
+                sample = (stats.compressed - 1) % self.sample_every == 0
+        if sample:
+            wire = len(zlib.compress(response.SerializeToString()))
+            with self.lock:
+                stats.sampled_bytes += size
+                stats.sampled_wire_bytes += wire
+
+    def counted(self, stats, request_iterator):
+        for request in request_iterator:
+            self.count_request(stats, request)
+            yield request
+
+    def send_one(self, stats, context, response):
+        compressed = self.algorithm is not None and response.ByteSize() >= self.threshold
+        if compressed:
+            context.set_compression(self.algorithm)
+        self.count_response(stats, response, compressed)
+        return response
+
+    def start_stream(self, stats, context):
+        with self.lock:
+            stats.calls += 1
+        if self.algorithm is not None:
+            context.set_compression(self.algorithm)
+
+    def send_next(self, stats, context, response):
+        compressed = self.algorithm is not None and response.ByteSize() >= self.threshold
+        if self.algorithm is not None and not compressed:
+            context.disable_next_message_compression()
+        self.count_response(stats, response, compressed)
+        return response
+
+    def send_stream(self, stats, context, responses):
+        self.start_stream(stats, context)
+        for response in responses:
+            yield self.send_next(stats, context, response)
+
+    async def send_async_stream(self, stats, context, responses):
+        self.start_stream(stats, context)
+        async for response in responses:
+            yield self.send_next(stats, context, response)
+
+    async def counted_async(self, stats, request_iterator):
+        async for request in request_iterator:
+            self.count_request(stats, request)
+            yield request
+
+    def intercept_service(self, continuation, handler_call_details):
+        return self.wrap(continuation(handler_call_details), handler_call_details.method)
+
+    def wrap(self, handler, method):
+        """
+        The handler with compression and counting around it; async handlers
+        (from the aio server) get async wrappers.
+        """
+        if handler is None:
+            return None
+        stats = self.method_stats(method.rsplit("/", 1)[-1])
+
+        def unary_unary(request, context):
+            with self.lock:
+                stats.calls += 1
+            self.count_request(stats, request)
+            return self.send_one(stats, context, handler.unary_unary(request, context))
+
+        async def async_unary_unary(request, context):
+            with self.lock:
+                stats.calls += 1
+            self.count_request(stats, request)
+            return self.send_one(stats, context, await handler.unary_unary(request, context))
+
+        def unary_stream(request, context):
+            self.count_request(stats, request)
+            yield from self.send_stream(stats, context, handler.unary_stream(request, context))
+
+        async def async_unary_stream(request, context):
+            self.count_request(stats, request)
+            async for response in self.send_async_stream(stats, context, handler.unary_stream(request, context)):
+                yield response
+
+        def stream_unary(request_iterator, context):
+            with self.lock:
+                stats.calls += 1
+            return self.send_one(stats, context, handler.stream_unary(self.counted(stats, request_iterator), context))
+
+        async def async_stream_unary(request_iterator, context):
+            with self.lock:
+                stats.calls += 1
+            response = await handler.stream_unary(self.counted_async(stats, request_iterator), context)
+            return self.send_one(stats, context, response)
+
+        def stream_stream(request_iterator, context):
+            yield from self.send_stream(stats, context,
+                                        handler.stream_stream(self.counted(stats, request_iterator), context))
+
+        async def async_stream_stream(request_iterator, context):
+            responses = handler.stream_stream(self.counted_async(stats, request_iterator), context)
+            async for response in self.send_async_stream(stats, context, responses):
+                yield response
+
+        options = {"request_deserializer": handler.request_deserializer,
+                   "response_serializer": handler.response_serializer}
+        if handler.unary_unary is not None:
+            behavior = async_unary_unary if inspect.iscoroutinefunction(handler.unary_unary) else unary_unary
+            return grpc.unary_unary_rpc_method_handler(behavior, **options)
+        if handler.unary_stream is not None:
+            behavior = async_unary_stream if inspect.isasyncgenfunction(handler.unary_stream) else unary_stream
+            return grpc.unary_stream_rpc_method_handler(behavior, **options)
+        if handler.stream_unary is not None:
+            behavior = async_stream_unary if inspect.iscoroutinefunction(handler.stream_unary) else stream_unary
+            return grpc.stream_unary_rpc_method_handler(behavior, **options)
+        behavior = async_stream_stream if inspect.isasyncgenfunction(handler.stream_stream) else stream_stream
+        return grpc.stream_stream_rpc_method_handler(behavior, **options)
+
+    def aio(self):
+        """
+        The same interceptor, sharing these counters, for a grpc.aio server.
+        """
+        return AsyncCompressionInterceptor(self)
+
+    def report(self):
+        """
+        One line per method: calls, bytes in, bytes out before and after
+        compression, and the ratio between the two.
+        """
+        lines = []
+        with self.lock:
+            for method, stats in sorted(self.stats.items()):
+                if not stats.calls:
+                    continue
+                wire_bytes = stats.response_wire_bytes
+                ratio = stats.response_bytes / wire_bytes if wire_bytes else 1.0
+                lines.append(f"{method}: {stats.calls} calls, {stats.request_bytes} B in, "
+                             f"{stats.response_bytes} B out (~{wire_bytes} B on the wire, "
+                             f"{ratio:.1f}x, {stats.compressed} compressed)")
+        return "\n".join(lines)
+
+
+class AsyncCompressionInterceptor(grpc.aio.ServerInterceptor):
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    async def intercept_service(self, continuation, handler_call_details):
+        return self.compressor.wrap(await continuation(handler_call_details), handler_call_details.method)
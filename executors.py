@@ -0,0 +1,42 @@
+from concurrent import futures
+
+import grpc
+
+
+def run_in(pool, behavior):
+    """
+    The behavior, marked for the threaded gRPC server to run on `pool`
+    instead of its own executor.
+    """
+    def run(*args):
+        return behavior(*args)
+    run.experimental_thread_pool = pool
+    return run
+
+
+class StreamPoolInterceptor(grpc.ServerInterceptor):
+    """
+    Moves every streaming RPC onto a thread pool of its own. A subscription
+    holds its thread for as long as the client stays logged in, so sharing
+    the server's executor with unary calls lets enough logged-in users
+    starve SendMessage; with separate pools, streams only ever wait for
+    other streams.
+    """
+
+    def __init__(self, workers):
+        self.pool = futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stream")
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or not (handler.request_streaming or handler.response_streaming):
+            return handler
+        options = {"request_deserializer": handler.request_deserializer,
+                   "response_serializer": handler.response_serializer}
+        if handler.unary_stream is not None:
+            return grpc.unary_stream_rpc_method_handler(run_in(self.pool, handler.unary_stream), **options)
+        if handler.stream_unary is not None:
+            return grpc.stream_unary_rpc_method_handler(run_in(self.pool, handler.stream_unary), **options)
+        return grpc.stream_stream_rpc_method_handler(run_in(self.pool, handler.stream_stream), **options)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
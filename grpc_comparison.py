@@ -1,5 +1,9 @@
+import base64
+import json
 import time
 import chat_pb2
+from replication import mutation_record
+from storage import message_from_dict
 
 def grpc_encode(data):
     # Create a SendMessageRequest protobuf message from the test data.
@@ -15,6 +19,48 @@ def grpc_decode(data_bytes):
     msg.ParseFromString(data_bytes)
     return msg
 
+# A SEND_MESSAGE mutation as the leader's log holds it.
+MUTATION = {
+    "sender": "Alice",
+    "recipient": "Bob",
+    "message_entry": {
+        "id": 12345,
+        "sender": "Alice",
+        "content": "Hello Bob, let's measure gRPC (protobuf) efficiency!",
+        "timestamp": "2025-03-26T00:32:28.770407"
+    }
+}
+
+def json_mutation_encode(data):
+    # The old replication request: operation type plus a JSON payload.
+    msg = chat_pb2.ReplicateMutationRequest(operation_type="SEND_MESSAGE", payload=json.dumps(data))
+    return msg.SerializeToString()
+
+def json_mutation_decode(data_bytes):
+    msg = chat_pb2.ReplicateMutationRequest.FromString(data_bytes)
+    data = json.loads(msg.payload)
+    return msg.operation_type, data, message_from_dict(data["message_entry"])
+
+def typed_mutation_encode(data):
+    return mutation_record(12345, "SEND_MESSAGE", data).SerializeToString()
+
+def typed_mutation_decode(data_bytes):
+    # A follower applies the record's fields as they are, as apply_record() does.
+    record = chat_pb2.MutationRecord.FromString(data_bytes)
+    message = chat_pb2.ChatMessage()
+    message.CopyFrom(record.send_message.message)
+    return record.WhichOneof("mutation"), record.send_message, message
+
+def json_follower_path(data_bytes):
+    # Decode the old request, then write its JSON data to the follower's log.
+    op_type, data, message = json_mutation_decode(data_bytes)
+    return json.dumps({"index": 12345, "op": op_type, "data": data}, separators=(",", ":"))
+
+def typed_follower_path(data_bytes):
+    # Decode the typed record, then log it as it arrived (MutationLog.append_record).
+    kind, mutation, message = typed_mutation_decode(data_bytes)
+    return b'{"index":%d,"op":"%s","record":"%s"}' % (12345, kind.upper().encode(), base64.b64encode(data_bytes))
+
 def measure_encoding(data, encode_func, iterations=10000):
     total_size = 0
     start = time.time()
@@ -50,5 +96,28 @@ def main():
     print(f"Encoding {iterations} times: {enc_time_grpc:.6f} seconds")
     print(f"Decoding {iterations} times: {dec_time_grpc:.6f} seconds")
 
+    # Replication payloads: JSON string in ReplicateMutationRequest versus
+    # the typed MutationRecord oneof.
+    print("\nReplicated SEND_MESSAGE mutation:")
+    results = {}
+    for name, encode, decode in (("JSON payload", json_mutation_encode, json_mutation_decode),
+                                 ("Typed record", typed_mutation_encode, typed_mutation_decode)):
+        avg_size, enc_time, encoded = measure_encoding(MUTATION, encode, iterations)
+        dec_time = measure_decoding(encoded, decode, iterations)
+        results[name] = (enc_time, dec_time)
+        print(f"{name}: {avg_size:.2f} bytes, "
+              f"encode {enc_time / iterations * 1e6:.2f} us, decode {dec_time / iterations * 1e6:.2f} us per mutation")
+    json_enc, json_dec = results["JSON payload"]
+    typed_enc, typed_dec = results["Typed record"]
+    print(f"Saved per mutation: encode {(json_enc - typed_enc) / iterations * 1e6:.2f} us, "
+          f"decode {(json_dec - typed_dec) / iterations * 1e6:.2f} us")
+
+    # What a follower spends per record before applying it: decoding plus
+    # the line for its own mutation log.
+    for name, encode, follow in (("JSON payload", json_mutation_encode, json_follower_path),
+                                 ("Typed record", typed_mutation_encode, typed_follower_path)):
+        follow_time = measure_decoding(encode(MUTATION), follow, iterations)
+        print(f"{name}: follower decode and log {follow_time / iterations * 1e6:.2f} us per mutation")
+
 if __name__ == "__main__":
     main()
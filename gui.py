@@ -8,25 +8,30 @@ import sys
 
 # Import the generated gRPC code
 import chat_pb2
-import chat_pb2_grpc
+from client import FailoverStub
 
 # -------------------------------
 # gRPC Chat Client (backend)
 # -------------------------------
 class ChatClient:
-    def __init__(self, server_host='localhost', server_port=50051):
+    def __init__(self, server_host='localhost', server_port=50051, servers=None):
         self.server_address = f"{server_host}:{server_port}"
-        self.channel = grpc.insecure_channel(self.server_address)
-        self.stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+        # calls follow the leader across the replicas in `servers`
+        self.stub = FailoverStub([self.server_address] + list(servers or []))
         self.username = None
         self.running = True
+        self.logged_off = threading.Event()  # set to end the current login's subscription
+        self.applied_index = 0  # newest log index seen, so reads from followers include our own writes
 
     def login(self, username, password):
         try:
-            response = self.stub.Login(chat_pb2.LoginRequest(
+            response = self.stub.read("Login", chat_pb2.LoginRequest(
                 username=username,
-                password=password
+                password=password,
+                min_applied_index=self.applied_index
             ))
+            if response.success:
+                self.logged_off = threading.Event()
             return response
         except grpc.RpcError as e:
             print(f"RPC Error during login: {e.details()}", file=sys.stderr)
@@ -41,6 +46,7 @@ class ChatClient:
                 username=username,
                 password=password
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             return response
         except grpc.RpcError as e:
             print(f"RPC Error during account creation: {e.details()}", file=sys.stderr)
@@ -56,6 +62,7 @@ class ChatClient:
                 recipient=recipient,
                 content=message
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             return response
         except grpc.RpcError as e:
             print(f"RPC Error sending message: {e.details()}", file=sys.stderr)
@@ -64,11 +71,14 @@ class ChatClient:
                 message=f"Failed to send: {e.details()}"
             )
 
-    def list_accounts(self, wildcard="*"):
+    def list_accounts(self, wildcard="*", page_size=0, page_token=""):
         try:
-            response = self.stub.ListAccounts(chat_pb2.ListAccountsRequest(
+            response = self.stub.read("ListAccounts", chat_pb2.ListAccountsRequest(
                 username=self.username,
-                wildcard=wildcard
+                wildcard=wildcard,
+                page_size=page_size,
+                page_token=page_token,
+                min_applied_index=self.applied_index
             ))
             return response
         except grpc.RpcError as e:
@@ -81,6 +91,7 @@ class ChatClient:
                 username=self.username,
                 limit=int(limit) if limit else 0
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             return response
         except grpc.RpcError as e:
             print(f"RPC Error reading messages: {e.details()}", file=sys.stderr)
@@ -92,6 +103,7 @@ class ChatClient:
                 username=self.username,
                 message_ids=id_list
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
             return response
         except grpc.RpcError as e:
             print(f"RPC Error deleting messages: {e.details()}", file=sys.stderr)
@@ -100,12 +112,16 @@ class ChatClient:
                 message=f"Failed to delete messages: {e.details()}"
             )
 
-    def view_conversation(self, other_user):
+    def view_conversation(self, other_user, before_id=0, limit=0):
         try:
-            response = self.stub.ViewConversation(chat_pb2.ViewConversationRequest(
+            response = self.stub.read("ViewConversation", chat_pb2.ViewConversationRequest(
                 username=self.username,
-                other_user=other_user
+                other_user=other_user,
+                before_id=before_id,
+                limit=limit,
+                min_applied_index=self.applied_index
             ))
+            self.applied_index = max(self.applied_index, response.applied_index)
             return response
         except grpc.RpcError as e:
             print(f"RPC Error viewing conversation: {e.details()}", file=sys.stderr)
@@ -116,6 +132,9 @@ class ChatClient:
             response = self.stub.DeleteAccount(chat_pb2.DeleteAccountRequest(
                 username=self.username
             ))
+            self.applied_index = max(self.applied_index, response.log_index)
+            if response.success:
+                self.logged_off.set()
             return response
         except grpc.RpcError as e:
             print(f"RPC Error deleting account: {e.details()}", file=sys.stderr)
@@ -127,6 +146,8 @@ class ChatClient:
     def log_off(self):
         if not self.username:
             return chat_pb2.LogOffResponse(success=True, message="Not logged in")
+        # before the call, so the stream it closes is not opened again
+        self.logged_off.set()
         try:
             response = self.stub.LogOff(chat_pb2.LogOffRequest(
                 username=self.username
@@ -141,30 +162,49 @@ class ChatClient:
 
     def subscribe_to_messages(self, callback):
         """Subscribe to incoming messages and call the callback for each one"""
-        try:
-            subscription_request = chat_pb2.SubscribeRequest(username=self.username)
-            for message in self.stub.SubscribeToMessages(subscription_request):
+        subscription_request = chat_pb2.SubscribeRequest(username=self.username)
+        logged_off = self.logged_off
+        while self.running and not logged_off.is_set():
+            address = self.stub.current
+            try:
+                for message in self.stub.SubscribeToMessages(subscription_request):
+                    if not self.running:
+                        return
+                    callback(message)
+                # the server ended the stream: we logged off or were deleted
+                return
+            except grpc.RpcError as e:
                 if not self.running:
-                    break
-                callback(message)
-        except grpc.RpcError as e:
-            if self.running:
-                print(f"Error in message subscription: {e.details()}", file=sys.stderr)
+                    return
+                if e.code() != grpc.StatusCode.UNAVAILABLE:
+                    print(f"Error in message subscription: {e.details()}", file=sys.stderr)
+                    return
+                # the server went away; subscribe again on the new leader
+                self.stub.failover(address, e)
+            time.sleep(self.stub.retry_interval)
 
     def close(self):
         self.running = False
         self.log_off()
-        self.channel.close()
+        self.stub.close()
 
 # -------------------------------
 # Tkinter GUI (refactored layout)
 # -------------------------------
 class ChatGUI:
+    # How many usernames the periodic refresh loads into the recipient menus.
+    MENU_PAGE_SIZE = 100
+    # How many messages View and Older fetch at a time.
+    CONVERSATION_PAGE_SIZE = 50
+    # The other replicas the client fails over to when the leader goes away.
+    BACKUP_PORTS = (50052, 50053)
+
     def __init__(self, master):
         self.master = master
         self.master.title("gRPC Chat Client")
         self.client = None
         self.user_list = []  # available users for dropdowns
+        self.conversation_cursor = (None, 0)  # conversation shown last and where its older page starts
 
         # Create three frames: login, chat, and commands.
         self.login_frame = tk.Frame(master)
@@ -239,6 +279,8 @@ class ChatGUI:
         self.view_conv_menu.grid(row=1, column=1, padx=5, pady=5)
         self.view_conv_button = tk.Button(self.command_frame, text="View", command=self.view_conversation)
         self.view_conv_button.grid(row=1, column=2, padx=5, pady=5)
+        self.older_conv_button = tk.Button(self.command_frame, text="Older", command=self.view_older_messages)
+        self.older_conv_button.grid(row=1, column=5, padx=5, pady=5)
 
         self.delete_acc_button = tk.Button(self.command_frame, text="Delete Account", command=self.delete_account)
         self.delete_acc_button.grid(row=0, column=2, padx=5, pady=5)
@@ -268,7 +310,7 @@ class ChatGUI:
             return
 
         if self.client is None:
-            self.client = ChatClient(server_ip, port)
+            self.client = ChatClient(server_ip, port, servers=[f"{server_ip}:{p}" for p in self.BACKUP_PORTS])
         response = self.client.login(username, password)
         if response.success:
             self.client.username = username
@@ -294,7 +336,7 @@ class ChatGUI:
             return
 
         if self.client is None:
-            self.client = ChatClient(server_ip, port)
+            self.client = ChatClient(server_ip, port, servers=[f"{server_ip}:{p}" for p in self.BACKUP_PORTS])
         response = self.client.create_account(username, password)
         self.status_label.config(text=response.message)
 
@@ -318,12 +360,18 @@ class ChatGUI:
         if not self.client or not self.client.username:
             messagebox.showerror("Error", "Not logged in.")
             return
-        response = self.client.list_accounts("*")
-        if response:
-            self.user_list = response.usernames
-            self.update_recipient_menu()
-            self.update_view_conv_menu()
-            self.append_text("Available users: " + ", ".join(self.user_list))
+        usernames = []
+        page_token = ""
+        while True:
+            response = self.client.list_accounts("*", page_token=page_token)
+            usernames.extend(response.usernames)
+            page_token = response.next_page_token
+            if not page_token:
+                break
+        self.user_list = usernames
+        self.update_recipient_menu()
+        self.update_view_conv_menu()
+        self.append_text("Available users: " + ", ".join(self.user_list))
 
     def delete_messages(self):
         if not self.client or not self.client.username:
@@ -349,12 +397,28 @@ class ChatGUI:
         if other_user == "Select User":
             messagebox.showerror("Error", "Select a valid user.")
             return
-        response = self.client.view_conversation(other_user)
+        self.show_conversation_page(other_user, 0)
+
+    def view_older_messages(self):
+        if not self.client or not self.client.username:
+            return
+        other_user, before_id = self.conversation_cursor
+        if not before_id:
+            messagebox.showinfo("View Conversation", "No older messages.")
+            return
+        self.show_conversation_page(other_user, before_id)
+
+    def show_conversation_page(self, other_user, before_id):
+        response = self.client.view_conversation(other_user, before_id, self.CONVERSATION_PAGE_SIZE)
+        self.conversation_cursor = (other_user, response.next_cursor)
         if response and response.messages:
-            conv_text = f"Conversation with {other_user}:\n"
+            title = "Conversation" if not before_id else "Older messages"
+            conv_text = f"{title} with {other_user}:\n"
             # Display each message with its ID, sender, timestamp (from the message), and content.
             for msg in response.messages:
                 conv_text += f"[ID {msg.id}]({msg.timestamp}): {msg.content}\n"
+            if response.next_cursor:
+                conv_text += "(press Older for earlier messages)\n"
             self.append_text(conv_text)
         else:
             self.append_text(f"No conversation with {other_user}.")
@@ -405,7 +469,8 @@ class ChatGUI:
 
     def refresh_users(self):
         if self.client and self.client.username:
-            response = self.client.list_accounts("*")
+            # Only the first page; the full list is fetched with the List Accounts button.
+            response = self.client.list_accounts("*", page_size=self.MENU_PAGE_SIZE)
             if response:
                 self.user_list = response.usernames
                 self.update_recipient_menu()
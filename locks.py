@@ -0,0 +1,104 @@
+import threading
+from contextlib import ExitStack, contextmanager
+
+
+class SharedLock:
+    """
+    A lock that many threads can hold in shared mode at once, or one thread
+    in exclusive mode (`with lock:`). A waiting exclusive holder keeps new
+    shared holders out, so a snapshot cannot be starved by steady writes.
+    Not reentrant in either mode.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire(self):
+        with self.cond:
+            self.waiting_writers += 1
+            self.cond.wait_for(lambda: not self.writer and self.readers == 0)
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @contextmanager
+    def shared(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.writer and not self.waiting_writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+
+class LockStripes:
+    """
+    A fixed set of locks shared out among keys by hash, so work on
+    different conversations or users rarely waits on the same lock.
+    """
+
+    def __init__(self, count=64):
+        self.locks = [threading.Lock() for _ in range(count)]
+
+    @contextmanager
+    def hold(self, *keys):
+        """
+        Hold the locks for all the keys. They are taken in stripe order, so
+        two threads holding overlapping keys cannot deadlock.
+        """
+        stripes = sorted({hash(key) % len(self.locks) for key in keys})
+        with ExitStack() as stack:
+            for stripe in stripes:
+                stack.enter_context(self.locks[stripe])
+            yield
+
+
+class IdAllocator:
+    """
+    Hands out increasing message ids from any thread. With a stride, only
+    ids equal to `residue` modulo the stride are handed out, so that each
+    shard numbers messages from its own share of the ids.
+    """
+
+    def __init__(self, next_id=1, stride=1, residue=0):
+        self.lock = threading.Lock()
+        self.next_id = next_id
+        self.stride = stride
+        self.residue = residue
+
+    def allocate(self):
+        with self.lock:
+            allocated = self.next_id + (self.residue - self.next_id) % self.stride
+            self.next_id = allocated + 1
+            return allocated
+
+    def advance(self, next_id):
+        """
+        Make sure ids below next_id are never handed out, e.g. after
+        applying a message another server numbered.
+        """
+        with self.lock:
+            if next_id > self.next_id:
+                self.next_id = next_id
+
+    def reset(self, next_id):
+        with self.lock:
+            self.next_id = next_id
@@ -0,0 +1,345 @@
+import functools
+import itertools
+import threading
+import time
+from collections import deque
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+from compression import pack_records
+
+
+def mutation_record(index, op_type, data, term=0):
+    """
+    Build the typed MutationRecord for a mutation log record written in
+    `term`.
+    """
+    if op_type == "CREATE_ACCOUNT":
+        return chat_pb2.MutationRecord(index=index, term=term, create_account=chat_pb2.CreateAccountMutation(
+            username=data["username"], password_hash=data["password_hash"]))
+    elif op_type == "SEND_MESSAGE":
+        return chat_pb2.MutationRecord(index=index, term=term, send_message=chat_pb2.SendMessageMutation(
+            sender=data["sender"], recipient=data["recipient"],
+            message=chat_pb2.ChatMessage(**data["message_entry"]),
+            remote_recipient=data.get("remote_recipient", False), delivered=data.get("delivered", False)))
+    elif op_type == "DELETE_ACCOUNT":
+        return chat_pb2.MutationRecord(index=index, term=term, delete_account=chat_pb2.DeleteAccountMutation(
+            username=data["username"]))
+    elif op_type == "MARK_READ":
+        return chat_pb2.MutationRecord(index=index, term=term, mark_read=chat_pb2.MarkReadMutation(
+            username=data["username"], message_ids=data["message_ids"]))
+    elif op_type == "DELETE_MESSAGES":
+        return chat_pb2.MutationRecord(index=index, term=term, delete_messages=chat_pb2.DeleteMessagesMutation(
+            username=data["username"], message_ids=data["message_ids"]))
+    elif op_type == "DELIVER_MESSAGE":
+        return chat_pb2.MutationRecord(index=index, term=term, deliver_message=chat_pb2.DeliverMessageMutation(
+            recipient=data["recipient"], message=chat_pb2.ChatMessage(**data["message_entry"]),
+            delivered=data.get("delivered", False)))
+    raise ValueError(f"Unknown operation type {op_type}")
+
+
+class ReplicaChannel:
+    """
+    A long-lived channel to one replica. The channel is opened on first use
+    and kept warm with keepalive pings; after a connection failure it is
+    dropped so that the next call reconnects from scratch.
+    """
+
+    def __init__(self, server_id, address, options, compression=None, compression_min_bytes=1024):
+        self.server_id = server_id
+        self.address = address
+        self.options = options
+        self.compression = compression
+        self.compression_min_bytes = compression_min_bytes
+        self.lock = threading.Lock()
+        self.channel = None
+        self._stub = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_error = None
+
+    def stub(self):
+        with self.lock:
+            if self.channel is None:
+                self.channel = grpc.insecure_channel(self.address, options=self.options)
+                self._stub = chat_pb2_grpc.ChatServiceStub(self.channel)
+            return self._stub
+
+    def compression_for(self, request):
+        """
+        The `compression` argument for a call sending `request`: only
+        requests of at least compression_min_bytes are compressed.
+        """
+        if self.compression is None or request.ByteSize() < self.compression_min_bytes:
+            return grpc.Compression.NoCompression
+        return self.compression
+
+    def record_success(self):
+        with self.lock:
+            self.healthy = True
+            self.consecutive_failures = 0
+
+    def record_failure(self, error):
+        with self.lock:
+            self.healthy = False
+            self.consecutive_failures += 1
+            self.last_error = error
+            code = error.code() if isinstance(error, grpc.RpcError) else None
+            if code == grpc.StatusCode.UNAVAILABLE and self.channel is not None:
+                self.channel.close()
+                self.channel = None
+                self._stub = None
+
+    def close(self):
+        with self.lock:
+            if self.channel is not None:
+                self.channel.close()
+                self.channel = None
+                self._stub = None
+
+
+class ReplicaStream:
+    """
+    Ships mutation records to one replica over a long-lived StreamMutations
+    call. Records go out in index order, batched as they queue up, and are
+    kept until the replica acks them so they can be resent on reconnect.
+    """
+
+    def __init__(self, replica, on_ack, leader, max_batch=500, max_buffer=100000, retry_interval=0.5):
+        self.replica = replica
+        self.on_ack = on_ack
+        self.leader = leader    # (term, leader_id, term_start_index, term_start_term) sent with every batch
+        self.max_batch = max_batch
+        self.max_buffer = max_buffer
+        self.retry_interval = retry_interval
+        self.cond = threading.Condition()
+        self.buffer = deque()   # records not acked yet, in index order
+        self.next_send = 1      # index of the next record to send
+        self.acked_index = 0
+        self.stalled = False    # the replica is catching up on records no longer buffered
+        self.generation = 0     # bumped per call so old request iterators stop
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def push(self, record):
+        with self.cond:
+            self.buffer.append(record)
+            if len(self.buffer) > self.max_buffer:
+                self.buffer.popleft()
+            self.cond.notify_all()
+
+    def sendable(self):
+        return self.buffer and self.buffer[-1].index >= self.next_send
+
+    def batches(self, generation):
+        while True:
+            with self.cond:
+                while not (self.closing or generation != self.generation or self.sendable()):
+                    if not self.cond.wait(self.retry_interval if self.stalled else None) and self.buffer:
+                        # a replica catching up only acks what we send it, so
+                        # offer it our last record again until it takes it
+                        self.next_send = self.buffer[-1].index
+                if self.closing or generation != self.generation:
+                    return
+                if self.buffer[0].index > self.next_send:
+                    self.next_send = self.buffer[0].index
+                start = self.next_send - self.buffer[0].index
+                records = list(itertools.islice(self.buffer, start, start + self.max_batch))
+                self.next_send = records[-1].index + 1
+            term, leader_id, term_start_index, term_start_term = self.leader
+            threshold = self.replica.compression_min_bytes if self.replica.compression is not None else None
+            yield chat_pb2.ReplicationBatch(term=term, leader_id=leader_id, term_start_index=term_start_index,
+                                            term_start_term=term_start_term, **pack_records(records, threshold))
+
+    def acked(self, ack):
+        with self.cond:
+            self.acked_index = max(self.acked_index, ack.applied_index)
+            while self.buffer and self.buffer[0].index <= self.acked_index:
+                self.buffer.popleft()
+            if ack.success:
+                self.stalled = False
+            elif self.buffer and self.buffer[0].index == self.acked_index + 1:
+                self.next_send = self.acked_index + 1
+            else:
+                # The replica fetches the missing records from us itself;
+                # keep offering it new ones until it accepts them.
+                if not self.stalled:
+                    print(f"[LEADER] s{self.replica.server_id} is catching up: {ack.message}")
+                self.stalled = True
+                if self.buffer:
+                    self.next_send = max(self.next_send, self.buffer[-1].index + 1)
+            self.cond.notify_all()
+        self.on_ack(ack)
+
+    def run(self):
+        while not self.closing:
+            with self.cond:
+                self.generation += 1
+                generation = self.generation
+                self.next_send = self.acked_index + 1
+                self.stalled = False
+                self.cond.notify_all()
+            try:
+                for ack in self.replica.stub().StreamMutations(self.batches(generation)):
+                    self.replica.record_success()
+                    self.acked(ack)
+            except Exception as e:
+                if self.closing:
+                    break
+                if self.replica.healthy:
+                    details = e.details() if isinstance(e, grpc.RpcError) else e
+                    print(f"[LEADER] Replication stream to s{self.replica.server_id} failed: {details}")
+                self.replica.record_failure(e)
+            time.sleep(self.retry_interval)
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+
+
+class ReplicaPool:
+    """
+    Channels to every other replica, keyed by address and created once when
+    the server starts. With `compression` set, what is sent on them
+    (replication batches, forwarded writes) is compressed once it reaches
+    compression_min_bytes; smaller messages go out as they are.
+    """
+
+    def __init__(self, server_id, replicas, keepalive_ms=10000, keepalive_timeout_ms=5000, compression=None,
+                 compression_min_bytes=1024):
+        options = [
+            ("grpc.keepalive_time_ms", keepalive_ms),
+            ("grpc.keepalive_timeout_ms", keepalive_timeout_ms),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+        self.channels = {}
+        for rep in replicas:
+            if rep["server_id"] == server_id:
+                continue  # skip self
+            address = f'{rep["host"]}:{rep["port"]}'
+            self.channels[address] = ReplicaChannel(rep["server_id"], address, options, compression,
+                                                    compression_min_bytes)
+        self.streams = []
+        self.acked = threading.Condition()
+        # called with the term of any ack, so a deposed leader can step down
+        self.on_newer_term = None
+
+    def __iter__(self):
+        return iter(list(self.channels.values()))
+
+    def __len__(self):
+        return len(self.channels)
+
+    def by_id(self, server_id):
+        for replica in self:
+            if replica.server_id == server_id:
+                return replica
+        return None
+
+    def start_streams(self, leader, max_batch=500, max_buffer=100000, retry_interval=0.5):
+        """
+        Open a replication stream to every replica; called by a new leader
+        with its (term, leader_id, term_start_index, term_start_term).
+        """
+        streams = [ReplicaStream(replica, self.notify_acked, leader, max_batch, max_buffer, retry_interval)
+                   for replica in self]
+        with self.acked:
+            self.streams = streams
+        for stream in streams:
+            stream.start()
+
+    def stop_streams(self):
+        with self.acked:
+            streams, self.streams = self.streams, []
+            self.acked.notify_all()
+        for stream in streams:
+            stream.close()
+
+    def call_all(self, method, request, timeout, enough=None):
+        """
+        Call `method` on every replica at once and return the responses
+        (None for a failed call) that arrived before every call finished,
+        the timeout passed, or enough(responses) became true.
+        """
+        replicas = list(self)
+        results = []
+        done = threading.Condition()
+
+        # Runs on the channel's own thread, which cannot close the channel,
+        # so the outcome is recorded on the replica once the caller wakes up.
+        def finished(replica, call):
+            try:
+                result = call.result()
+            except Exception as e:
+                result = e
+            with done:
+                results.append((replica, result))
+                done.notify_all()
+
+        def responses():
+            return [None if isinstance(result, Exception) else result for _, result in results]
+
+        for replica in replicas:
+            try:
+                call = getattr(replica.stub(), method).future(request, timeout=timeout,
+                                                              compression=replica.compression_for(request))
+            except Exception as e:
+                with done:
+                    results.append((replica, e))
+                continue
+            call.add_done_callback(functools.partial(finished, replica))
+        with done:
+            done.wait_for(lambda: len(results) == len(replicas) or (enough is not None and enough(responses())),
+                          timeout=timeout)
+            finished_results = list(results)
+            collected = responses()
+        for replica, result in finished_results:
+            if isinstance(result, Exception):
+                replica.record_failure(result)
+            else:
+                replica.record_success()
+        return collected
+
+    def push(self, record):
+        for stream in self.streams:
+            stream.push(record)
+
+    def notify_acked(self, ack):
+        with self.acked:
+            self.acked.notify_all()
+        if ack.term and self.on_newer_term is not None:
+            self.on_newer_term(ack.term)
+
+    def wait_acked(self, index, wait_for, timeout):
+        """
+        Wait until `wait_for` replicas have acked every record up to `index`,
+        or until the timeout. Returns whether enough of them did.
+        """
+        def enough():
+            return sum(1 for stream in self.streams if stream.acked_index >= index) >= wait_for
+        with self.acked:
+            return self.acked.wait_for(enough, timeout=timeout)
+
+    def close(self):
+        self.stop_streams()
+        for replica in self:
+            replica.close()
+
+
+def server_keepalive_options(keepalive_ms):
+    """
+    Server options that accept the pool's keepalive pings instead of
+    answering them with GOAWAY (too_many_pings).
+    """
+    return [
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.min_recv_ping_interval_without_data_ms", keepalive_ms),
+        ("grpc.http2.max_ping_strikes", 0),
+    ]
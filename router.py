@@ -0,0 +1,169 @@
+import argparse
+import heapq
+import json
+import time
+from concurrent import futures
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+from executors import StreamPoolInterceptor
+from sharding import ShardMap
+
+
+class ChatRouter(chat_pb2_grpc.ChatServiceServicer):
+    """
+    The ChatService in front of a sharded cluster. Holds no data: each call
+    goes to the leader of the shard that owns its user or conversation,
+    and the few calls that span shards are sent to all of them and their
+    answers combined. Clients talk to the router as they would to a server.
+    """
+
+    def __init__(self, shards, config=None):
+        config = config or {}
+        self.shards = ShardMap(shards)
+        self.forward_timeout = config.get("forward_timeout_ms", 5000) / 1000.0
+        self.max_list_page_size = config.get("max_list_page_size", 1000)
+
+    def call(self, shard_id, method, request, context):
+        """
+        Call the shard's leader and return its response, passing any error
+        on to our client with the same code.
+        """
+        # log indexes are per shard, so the client's cannot be checked
+        # against another shard's; the leader is always fresh enough anyway
+        for field in ("min_applied_index", "max_staleness_ms"):
+            if field in request.DESCRIPTOR.fields_by_name:
+                request.ClearField(field)
+        remaining = context.time_remaining()
+        timeout = self.forward_timeout if remaining is None else min(remaining, self.forward_timeout)
+        try:
+            return getattr(self.shards.stub(shard_id), method)(request, timeout=timeout)
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
+
+    def to_user(self, method, request, context, username):
+        return self.call(self.shards.user_shard(username), method, request, context)
+
+    def to_conversation(self, method, request, context, user_a, user_b):
+        return self.call(self.shards.conversation_shard(user_a, user_b), method, request, context)
+
+    def Login(self, request, context):
+        return self.to_user("Login", request, context, request.username)
+
+    def CreateAccount(self, request, context):
+        return self.to_user("CreateAccount", request, context, request.username)
+
+    def LogOff(self, request, context):
+        return self.to_user("LogOff", request, context, request.username)
+
+    def ReadMessages(self, request, context):
+        return self.to_user("ReadMessages", request, context, request.username)
+
+    def SendMessage(self, request, context):
+        # the conversation's shard numbers the message and delivers it to
+        # the recipient's shard itself
+        return self.to_conversation("SendMessage", request, context, request.sender, request.recipient)
+
+    def ViewConversation(self, request, context):
+        return self.to_conversation("ViewConversation", request, context, request.username, request.other_user)
+
+    def DeleteAccount(self, request, context):
+        # the user's own shard first, which knows whether they exist; then
+        # every shard drops the conversations it keeps with them
+        owner = self.shards.user_shard(request.username)
+        response = self.call(owner, "DeleteAccount", request, context)
+        if not response.success:
+            return response
+        for shard_id in self.shards.shard_ids:
+            if shard_id != owner:
+                self.call(shard_id, "DeleteAccount", request, context)
+        return response
+
+    def DeleteMessages(self, request, context):
+        # the messages may be unread on the user's shard and in
+        # conversations on any shard
+        owner = self.shards.user_shard(request.username)
+        responses = [self.call(shard_id, "DeleteMessages", request, context) for shard_id in self.shards.shard_ids]
+        deleted = next((response for response in responses if response.success), None)
+        return deleted or responses[self.shards.shard_ids.index(owner)]
+
+    def ListAccounts(self, request, context):
+        """
+        Ask every shard for a page and merge them. A shard that has more
+        names only answered up to the last name it sent, so the merged page
+        stops there too, and the next page starts after it on every shard.
+        """
+        page_size = request.page_size
+        if page_size <= 0 or page_size > self.max_list_page_size:
+            page_size = self.max_list_page_size
+        request.page_size = page_size
+        pages = [self.call(shard_id, "ListAccounts", request, context) for shard_id in self.shards.shard_ids]
+        bounds = [page.next_page_token for page in pages if page.next_page_token]
+        bound = min(bounds, default=None)
+        merged = [name for name in heapq.merge(*(page.usernames for page in pages))
+                  if bound is None or name <= bound]
+        usernames = merged[:page_size]
+        more = bound is not None or len(merged) > page_size
+        return chat_pb2.ListAccountsResponse(usernames=usernames,
+                                             next_page_token=usernames[-1] if more and usernames else "")
+
+    def SubscribeToMessages(self, request, context):
+        # messages reach a user through their own shard
+        stub = self.shards.stub(self.shards.user_shard(request.username))
+        call = stub.SubscribeToMessages(request)
+        context.add_callback(call.cancel)
+        try:
+            yield from call
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                context.abort(e.code(), e.details())
+
+    def close(self):
+        self.shards.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="router_config.json", help="Path to the config file")
+    return parser.parse_args()
+
+def load_config(config_path):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+def serve():
+    server = None
+    try:
+        args = parse_args()
+        config = load_config(args.config)
+
+        listen_port = config["listen_port"]
+        router = ChatRouter(config["shards"], config)
+
+        # subscriptions are relayed for as long as the client stays logged
+        # in, so they get their own pool, as on the servers
+        stream_pool = StreamPoolInterceptor(config.get("stream_workers", 100))
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=config.get("unary_workers", 10)),
+                             interceptors=[stream_pool])
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(router, server)
+        server.add_insecure_port(f'[::]:{listen_port}')
+        server.start()
+        print(f"Router started on port {listen_port} for {len(router.shards)} shards")
+
+        while True:
+            time.sleep(86400)
+    except KeyboardInterrupt:
+        if server is not None:
+            server.stop(0)
+            stream_pool.close()
+            router.close()
+        print("Router stopped")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"Caught top-level exception: {e}")
+
+if __name__ == '__main__':
+    serve()
@@ -1,139 +1,897 @@
+import asyncio
 import grpc
 import time
 import datetime
 import hashlib
-import fnmatch
+import random
 import threading
-from collections import OrderedDict
+from bisect import insort
+from collections import OrderedDict, deque
 from concurrent import futures
 import os
 import json
 import argparse
+import signal
+from operator import attrgetter
 
 import chat_pb2
 import chat_pb2_grpc
+from compression import CompressionInterceptor, compression_algorithm, unpack_records
+from executors import StreamPoolInterceptor
+from locks import IdAllocator, LockStripes, SharedLock
+from sharding import ShardMap
+from replication import ReplicaPool, mutation_record, server_keepalive_options
+from storage import (ConversationStore, HashTree, MutationLog, TermFile, UsernameIndex, digest_bytes, map_snapshot,
+                     message_from_dict, message_position, migrate_json_snapshot, read_snapshot, user_digest,
+                     write_snapshot)
+
+
+class Subscription:
+    """
+    Messages waiting for one SubscribeToMessages stream. The stream sleeps
+    on the condition until put() or close() wakes it, so an idle subscriber
+    never polls.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.closed = False
+
+    def put(self, message):
+        """
+        Queue a message for the stream; False once the stream has ended, so
+        the caller keeps it as unread instead.
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            self.pending.append(message)
+            self.cond.notify()
+            return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def __iter__(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                messages, self.pending = self.pending, deque()
+            yield from messages
+
 
 class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
-    def __init__(self, server_id, replicas):
+    def __init__(self, server_id, replicas, config=None):
         super().__init__()
 
         self.server_id = server_id
         self.replicas = replicas
+        config = config or {}
+
+        # Each server has its own snapshot file, so no single point of failure.
+        # Mutations since that file was written live in an append-only log.
+        # chat_data_N.json is the original format, migrated on first start.
+        data_dir = config.get("data_dir", ".")
+        self.data_file = os.path.join(data_dir, f"chat_data_{self.server_id}.db")
+        self.legacy_data_file = os.path.join(data_dir, f"chat_data_{self.server_id}.json")
+        # log_sync is "always" (fsync before acknowledging, group-committed),
+        # "interval" (fsync every log_sync_interval_ms) or "os" (no fsync).
+        self.mutation_log = MutationLog(
+            os.path.join(data_dir, f"chat_data_{self.server_id}.log"),
+            sync_policy=config.get("log_sync", "always"),
+            sync_interval_ms=config.get("log_sync_interval_ms", 10)
+        )
 
-        # Each server has its own .json file, so no single point of failure.
-        self.data_file = f"chat_data_{self.server_id}.json"
-
-        # Determine leader as smallest ID among [myself] + replicas
-        all_ids = [r["server_id"] for r in self.replicas] + [self.server_id]
-        self.leader_id = min(all_ids)
-        self.is_leader = (self.server_id == self.leader_id)
-
-        self.data_lock = threading.Lock()
+        # A background snapshot is taken once the log has grown by this many
+        # records or bytes since the previous one.
+        self.snapshot_every_ops = config.get("snapshot_every_ops", 1000)
+        self.snapshot_every_bytes = config.get("snapshot_every_bytes", 4 * 1024 * 1024)
+        self.snapshot_requested = threading.Event()
+        self.snapshot_lock = threading.Lock()
+        # How many conversations unchanged since the last snapshot are kept
+        # in memory; the rest are read from the snapshot when needed.
+        self.conversation_cache_size = config.get("conversation_cache_size", 10000)
+        # Largest page ListAccounts returns, also used when no page size is asked for.
+        self.max_list_page_size = config.get("max_list_page_size", 1000)
+
+        # Leader election: the leader sends a heartbeat every
+        # heartbeat_interval_ms; a follower that hears nothing for a random
+        # 1-2x election_timeout_ms starts an election for the next term.
+        self.term_file = TermFile(os.path.join(data_dir, f"chat_data_{self.server_id}.term"))
+        self.heartbeat_interval = config.get("heartbeat_interval_ms", 50) / 1000.0
+        self.election_timeout = config.get("election_timeout_ms", 300) / 1000.0
+        self.state_lock = threading.RLock()
+        self.role = "follower"
+        self.leader_id = None
+        self.term_start_index = 0
+        self.term_start_term = 0
+        self.resync_requested = False
+        self.last_heartbeat = 0
+        self.reset_election_timer()
+
+        # Replication reuses one keepalive channel per replica for the
+        # lifetime of the server.
+        self.replica_keepalive_ms = config.get("replica_keepalive_ms", 10000)
+        # How many followers a write waits for: "all", "majority" (together
+        # with the leader) or "none", and how long each replica gets.
+        self.replication_ack = config.get("replication_ack", "all")
+        if self.replication_ack not in ("all", "majority", "none"):
+            raise ValueError(f"Unknown replication_ack policy: {self.replication_ack}")
+        self.replication_timeout = config.get("replication_timeout_ms", 1000) / 1000.0
+        # Records per StreamMutations batch, and how many unacked records are
+        # kept per follower for resending after a reconnect.
+        self.replication_batch_size = config.get("replication_batch_size", 500)
+        self.replication_buffer_size = config.get("replication_buffer_size", 100000)
+        self.replica_retry_interval = config.get("replica_retry_interval_ms", 500) / 1000.0
+        # Snapshots sent to a follower catching up go out in chunks this big.
+        self.snapshot_chunk_size = config.get("snapshot_chunk_size", 1024 * 1024)
+        self.catch_up_requested = threading.Event()
+        self.closing = threading.Event()
+        # How long a follower holds a read it is too far behind for before
+        # sending the client to the leader.
+        self.read_wait = config.get("read_wait_ms", 500) / 1000.0
+        # Upper bound on a write a follower passes on to the leader, on top
+        # of the client's own deadline.
+        self.forward_timeout = config.get("forward_timeout_ms", 5000) / 1000.0
+        # How often a follower compares its hash trees with the leader's and
+        # repairs what differs; 0 turns that off.
+        self.anti_entropy_interval = config.get("anti_entropy_interval_ms", 30000) / 1000.0
+        # Notified whenever a follower applies records or hears from the
+        # leader; caught_up_at is when we last had everything the leader had.
+        self.applied = threading.Condition()
+        self.leader_last_index = 0
+        self.caught_up_at = 0
+        # Message compression ("none", "gzip" or "deflate") for responses and
+        # messages to replicas of at least compression_min_bytes.
+        self.compression = compression_algorithm(config.get("compression", "none"))
+        self.compressor = CompressionInterceptor(self.compression, config.get("compression_min_bytes", 1024))
+        # Unary calls and streams (subscriptions, replication) get separate
+        # worker pools, so open streams can never hold up a SendMessage.
+        # max_concurrent_rpcs turns calls past that away with
+        # RESOURCE_EXHAUSTED instead of queueing them; null means no limit.
+        self.unary_workers = config.get("unary_workers", 10)
+        self.stream_workers = config.get("stream_workers", 100)
+        self.max_concurrent_rpcs = config.get("max_concurrent_rpcs")
+        self.stream_pool = StreamPoolInterceptor(self.stream_workers)
+        self.replica_pool = ReplicaPool(self.server_id, self.replicas,
+                                        keepalive_ms=self.replica_keepalive_ms,
+                                        keepalive_timeout_ms=config.get("replica_keepalive_timeout_ms", 5000),
+                                        compression=self.compression,
+                                        compression_min_bytes=config.get("compression_min_bytes", 1024))
+        self.replica_pool.on_newer_term = self.step_down
+
+        # Account changes, snapshots and anything applied from the log take
+        # data_lock exclusively. Sending and reading messages take it shared,
+        # together with the stripes of the conversation and user they touch,
+        # so independent conversations go ahead in parallel.
+        self.data_lock = SharedLock()
+        self.key_locks = LockStripes(config.get("lock_stripes", 64))
+        # keeps log order and the order records reach the followers the same
+        self.log_order_lock = threading.Lock()
 
         # In-memory data
         self.users = OrderedDict()
+        self.user_index = UsernameIndex()
         self.active_subscriptions = {}
-        self.conversations = {}
-        self.next_msg_id = 1
+        self.conversations = ConversationStore(self.conversation_cache_size)
+        self.user_hashes = HashTree()  # conversations keep their own, in self.conversations
+
+        # With a "shards" list in the config this server's group is one of
+        # several shards: it keeps only the users and the conversations that
+        # hash to shard_id, and numbers messages from its own share of the
+        # ids so they stay unique across shards.
+        self.shards = ShardMap(config["shards"]) if config.get("shards") else None
+        self.shard_id = config.get("shard_id")
+        if self.shards is not None:
+            if self.shard_id not in self.shards.shard_ids:
+                raise ValueError(f"shard_id {self.shard_id} is not in the shard map")
+            self.message_ids = IdAllocator(stride=len(self.shards),
+                                           residue=self.shards.shard_ids.index(self.shard_id))
+        else:
+            self.message_ids = IdAllocator()
+        # orders id allocation and history appends within each conversation
+        self.conversation_locks = LockStripes(config.get("lock_stripes", 64))
 
         # Load data from file at startup
         self.load_data()
 
-    def load_data(self):
-        if not os.path.exists(self.data_file):
-            return
+        self.snapshot_thread = threading.Thread(target=self.snapshot_loop, daemon=True)
+        self.snapshot_thread.start()
+
+        # A lone server leads itself, and on a cluster's very first start the
+        # lowest id takes term 1 without waiting for an election. Everyone
+        # else starts as a follower and pulls whatever it missed.
+        all_ids = [r["server_id"] for r in self.replicas] + [self.server_id]
+        with self.state_lock:
+            if len(self.replica_pool) == 0:
+                self.term_file.save(self.term_file.term + 1, self.server_id)
+                self.become_leader()
+            elif self.term_file.term == 0 and self.server_id == min(all_ids):
+                self.term_file.save(1, self.server_id)
+                self.become_leader()
+            else:
+                self.catch_up_requested.set()
+        self.catch_up_thread = threading.Thread(target=self.catch_up_loop, daemon=True)
+        self.catch_up_thread.start()
+        self.election_thread = threading.Thread(target=self.election_loop, daemon=True)
+        self.election_thread.start()
+        if self.anti_entropy_interval:
+            self.anti_entropy_thread = threading.Thread(target=self.anti_entropy_loop, daemon=True)
+            self.anti_entropy_thread.start()
+
+    def close(self):
+        """
+        Stop taking part in elections and replication.
+        """
+        self.closing.set()
+        self.catch_up_requested.set()
+        self.replica_pool.close()
+        self.stream_pool.close()
+        if self.shards is not None:
+            self.shards.close()
+
+    @property
+    def is_leader(self):
+        return self.role == "leader"
+
+    @property
+    def term(self):
+        return self.term_file.term
+
+    # -------------------------------
+    # Leader election
+    # -------------------------------
+
+    def reset_election_timer(self):
+        self.election_deadline = time.monotonic() + random.uniform(self.election_timeout, 2 * self.election_timeout)
+
+    def become_leader(self):
+        """
+        Take over as leader for the current term. Caller holds state_lock.
+        """
+        self.leader_id = self.server_id
         with self.data_lock:
+            self.term_start_index = self.mutation_log.last_index
+            self.term_start_term = self.mutation_log.last_term
+        self.term_file.save(self.term, self.term_file.voted_for, log_term=self.term)
+        self.replica_pool.start_streams((self.term, self.server_id, self.term_start_index, self.term_start_term),
+                                        self.replication_batch_size, self.replication_buffer_size,
+                                        self.replica_retry_interval)
+        # only now, so that every write we take is queued on the streams
+        self.role = "leader"
+        print(f"[ELECTION] s{self.server_id} is leader for term {self.term}")
+
+    def become_follower(self, term, leader_id=None):
+        """
+        Follow `leader_id` (None while unknown) in `term`. Caller holds
+        state_lock.
+        """
+        if term > self.term:
+            self.term_file.save(term)
+        was_leader = self.is_leader
+        self.role = "follower"
+        self.leader_id = leader_id
+        # Only a leader's heartbeat or a granted vote puts the election off;
+        # just hearing of a newer term must not, or a candidate that cannot
+        # win keeps everyone else from standing.
+        if was_leader:
+            self.reset_election_timer()
+            self.replica_pool.stop_streams()
+            print(f"[ELECTION] s{self.server_id} steps down in term {term}")
+
+    def step_down(self, term):
+        with self.state_lock:
+            if term > self.term:
+                self.become_follower(term)
+
+    def election_loop(self):
+        while not self.closing.wait(self.heartbeat_interval):
             try:
-                with open(self.data_file, "r") as f:
-                    data = json.load(f)
-                self.next_msg_id = data.get("next_msg_id", 1)
-                self.users = OrderedDict(data.get("users", {}))
-
-                loaded_convs = data.get("conversations", {})
-                self.conversations = {}
-                for key_str, msg_list in loaded_convs.items():
-                    key_tuple = tuple(key_str.split("::"))
-                    converted = []
-                    for m in msg_list:
-                        converted.append(chat_pb2.ChatMessage(
-                            id=m["id"],
-                            sender=m["sender"],
-                            content=m["content"],
-                            timestamp=m["timestamp"]
-                        ))
-                    self.conversations[key_tuple] = converted
+                if self.is_leader:
+                    self.send_heartbeats()
+                elif time.monotonic() > self.election_deadline:
+                    self.start_election()
             except Exception as e:
-                print(f"[load_data] Error: {e}")
+                print(f"[ELECTION] Error: {e}")
+
+    def send_heartbeats(self):
+        with self.state_lock:
+            if not self.is_leader:
+                return
+            request = chat_pb2.HeartbeatRequest(term=self.term, leader_id=self.server_id,
+                                                term_start_index=self.term_start_index,
+                                                term_start_term=self.term_start_term,
+                                                last_index=self.mutation_log.last_index)
+        for response in self.replica_pool.call_all("Heartbeat", request, self.heartbeat_interval):
+            if response is not None and response.term > request.term:
+                self.step_down(response.term)
+
+    def start_election(self):
+        """
+        Stand for the next term. A pre-vote round comes first and the term
+        is only bumped if a majority would vote for us, so a server that is
+        cut off from the others does not force a new election every time it
+        gets through again.
+        """
+        # a majority of the cluster, counting our own vote
+        needed = (len(self.replica_pool) + 1) // 2
 
-    def save_data(self):
-        with self.data_lock:
-            data = {}
-            data["next_msg_id"] = self.next_msg_id
-
-            # Convert users to a serializable dict
-            users_dict = {}
-            for username, user_data in self.users.items():
-                msg_list_dicts = []
-                for msg in user_data["messages"]:
-                    msg_list_dicts.append({
-                        "id": msg.id,
-                        "sender": msg.sender,
-                        "content": msg.content,
-                        "timestamp": msg.timestamp
-                    })
-                users_dict[username] = {
-                    "password_hash": user_data["password_hash"],
-                    "messages": msg_list_dicts
-                }
-            data["users"] = users_dict
-
-            # Convert conversations to a serializable dict
-            conv_dict = {}
-            for key_tuple, msg_list in self.conversations.items():
-                key_str = "::".join(key_tuple)
-                msg_list_dicts = []
-                for msg in msg_list:
-                    msg_list_dicts.append({
-                        "id": msg.id,
-                        "sender": msg.sender,
-                        "content": msg.content,
-                        "timestamp": msg.timestamp
-                    })
-                conv_dict[key_str] = msg_list_dicts
-            data["conversations"] = conv_dict
+        def votes(responses):
+            return sum(1 for r in responses if r is not None and r.vote_granted)
+
+        def enough(responses):
+            return votes(responses) >= needed
+
+        with self.state_lock:
+            self.reset_election_timer()
+            request = chat_pb2.VoteRequest(term=self.term + 1, candidate_id=self.server_id,
+                                           last_index=self.mutation_log.last_index,
+                                           last_term=self.mutation_log.last_term, pre_vote=True)
+        if not enough(self.replica_pool.call_all("RequestVote", request, self.election_timeout, enough)):
+            return
 
+        with self.state_lock:
+            if self.is_leader or self.term + 1 != request.term:
+                return
+            term = request.term
+            self.term_file.save(term, self.server_id)
+            self.role = "candidate"
+            self.leader_id = None
+            self.reset_election_timer()
+            request.pre_vote = False
+        responses = self.replica_pool.call_all("RequestVote", request, self.election_timeout, enough)
+        with self.state_lock:
+            newest = max([r.term for r in responses if r is not None] + [term])
+            if newest > self.term:
+                self.become_follower(newest)
+            elif self.role == "candidate" and self.term == term and votes(responses) >= needed:
+                self.become_leader()
+
+    def observe_leader(self, term, leader_id, term_start_index, term_start_term):
+        """
+        Note a heartbeat or replication batch from `leader_id`. Returns False
+        if it comes from an older term. The first time we follow a leader in
+        a new term we compare logs: records we have beyond the index its term
+        started at never reached it, and neither did a record at that index
+        from another term, so we resync from its snapshot. A shorter log is
+        checked by FetchLog when we catch up.
+        """
+        with self.state_lock:
+            if term < self.term:
+                return False
+            if term > self.term or self.role != "follower" or self.leader_id != leader_id:
+                self.become_follower(term, leader_id)
+            self.reset_election_timer()
+            self.last_heartbeat = time.monotonic()
+            if self.term_file.log_term != term:
+                last = (self.mutation_log.last_index, self.mutation_log.last_term)
+                if last[0] > term_start_index or (last[0] == term_start_index and last[1] != term_start_term):
+                    print(f"[FOLLOWER] Records up to {last[0]} are not on the new leader s{leader_id}; resyncing")
+                    self.resync_requested = True
+                    self.catch_up_requested.set()
+                self.term_file.save(term, self.term_file.voted_for, log_term=term)
+            return True
+
+    def leader_replica(self, context):
+        """
+        Return the pooled channel to the current leader, waiting out an
+        election for up to twice the election timeout, or None if we have
+        become the leader ourselves. Without a leader the client is turned
+        away with UNAVAILABLE.
+        """
+        deadline = time.monotonic() + 2 * self.election_timeout
+        while True:
+            if self.is_leader:
+                return None
+            leader = self.replica_pool.by_id(self.leader_id)
+            if leader is not None:
+                return leader
+            if time.monotonic() > deadline:
+                self.redirect_to_leader(context, "No leader to forward to")
+            time.sleep(self.heartbeat_interval)
+
+    def forward_to_leader(self, method, request, context):
+        """
+        Pass a write that reached a follower on to the leader and return the
+        leader's response. We hold the response until we have applied the
+        write ourselves, so the client reads it back from us.
+        """
+        leader = self.leader_replica(context)
+        if leader is None:
+            return getattr(self, method)(request, context)
+        try:
+            # the aio server reports no deadline as None
+            remaining = context.time_remaining()
+            timeout = self.forward_timeout if remaining is None else min(remaining, self.forward_timeout)
+            response = getattr(leader.stub(), method)(request, timeout=timeout,
+                                                      compression=leader.compression_for(request))
+            leader.record_success()
+        except grpc.RpcError as e:
+            leader.record_failure(e)
+            context.set_trailing_metadata(e.trailing_metadata() or ())
+            context.abort(e.code(), e.details())
+        index = getattr(response, "log_index", 0) or getattr(response, "applied_index", 0)
+        with self.applied:
+            self.applied.wait_for(lambda: self.mutation_log.last_index >= index, timeout=self.read_wait)
+        return response
+
+    def forward_stream_to_leader(self, method, request, context):
+        """
+        Relay a server-streaming call from the leader, cancelling it when
+        our client goes away.
+        """
+        leader = self.leader_replica(context)
+        if leader is None:
+            yield from getattr(self, method)(request, context)
+            return
+        call = getattr(leader.stub(), method)(request)
+        context.add_callback(call.cancel)
+        try:
+            yield from call
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                leader.record_failure(e)
+                context.abort(e.code(), e.details())
+
+    def owns_user(self, username):
+        return self.shards is None or self.shards.user_shard(username) == self.shard_id
+
+    def check_shard(self, context, shard_id, what):
+        """
+        Turn away a call the router should have sent to another shard.
+        """
+        if self.shards is not None and shard_id != self.shard_id:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, f"{what} belongs to shard {shard_id}")
+
+    def call_shard(self, shard_id, method, request, context):
+        """
+        Call another shard's leader on behalf of the client's call.
+        """
+        try:
+            return getattr(self.shards.stub(shard_id), method)(request, timeout=self.forward_timeout)
+        except grpc.RpcError as e:
+            context.abort(e.code(), f"Shard {shard_id}: {e.details()}")
+
+    def leader_address(self):
+        leader = next((r for r in self.replicas if r["server_id"] == self.leader_id), None)
+        return f'{leader["host"]}:{leader["port"]}' if leader else ""
+
+    def redirect_to_leader(self, context, reason):
+        # the "leader" key, empty during an election, tells clients the call
+        # was turned away untouched and can be sent again
+        address = self.leader_address()
+        context.set_trailing_metadata((("leader", address),))
+        context.abort(grpc.StatusCode.UNAVAILABLE, f"{reason} (leader: {address or 'being elected'})")
+
+    def note_applied(self, leader_last_index=None):
+        """
+        Wake up reads waiting for this follower to catch up, after applying
+        records or hearing the leader's last index in a heartbeat.
+        """
+        with self.applied:
+            if leader_last_index is not None:
+                self.leader_last_index = leader_last_index
+            if self.mutation_log.last_index >= self.leader_last_index:
+                self.caught_up_at = time.monotonic()
+            self.applied.notify_all()
+
+    def readable(self, request):
+        if self.is_leader:
+            return True
+        if self.mutation_log.last_index < request.min_applied_index:
+            return False
+        staleness = (time.monotonic() - self.caught_up_at) * 1000
+        return not request.max_staleness_ms or staleness <= request.max_staleness_ms
+
+    def wait_readable(self, request, context):
+        """
+        Hold a read until we are as fresh as the request asks, for up to
+        read_wait, and otherwise send the client to the leader.
+        """
+        with self.applied:
+            if self.applied.wait_for(lambda: self.readable(request), timeout=self.read_wait):
+                return
+        self.redirect_to_leader(context, "Replica is behind")
+
+    def RequestVote(self, request, context):
+        with self.state_lock:
+            log_ok = (request.last_term, request.last_index) >= (self.mutation_log.last_term,
+                                                                 self.mutation_log.last_index)
+            if request.pre_vote:
+                # Nothing changes here; a follower that still hears from its
+                # leader says no.
+                leader_alive = (not self.is_leader and self.leader_id is not None and
+                                time.monotonic() - self.last_heartbeat < self.election_timeout)
+                granted = request.term > self.term and log_ok and not leader_alive and not self.is_leader
+                return chat_pb2.VoteResponse(term=self.term, vote_granted=granted)
+            if request.term > self.term:
+                self.become_follower(request.term)
+            granted = (request.term == self.term
+                       and self.term_file.voted_for in (None, request.candidate_id)
+                       and log_ok)
+            if granted:
+                self.term_file.save(request.term, request.candidate_id)
+                self.reset_election_timer()
+            return chat_pb2.VoteResponse(term=self.term, vote_granted=granted)
+
+    def Heartbeat(self, request, context):
+        success = self.observe_leader(request.term, request.leader_id, request.term_start_index,
+                                      request.term_start_term)
+        if success:
+            self.note_applied(request.last_index)
+        return chat_pb2.HeartbeatResponse(term=self.term, success=success)
+
+    def load_data(self):
+        """
+        Restore state from the last snapshot, then replay the part of the
+        mutation log written after it.
+        """
+        with self.data_lock:
+            last_index, last_term = 0, 0
             try:
-                with open(self.data_file, "w") as f:
-                    json.dump(data, f, indent=2)
+                if not os.path.exists(self.data_file) and os.path.exists(self.legacy_data_file):
+                    print(f"[load_data] Migrating {self.legacy_data_file} to {self.data_file}")
+                    migrate_json_snapshot(self.legacy_data_file, self.data_file)
+                last_index, last_term = self.load_snapshot()
             except Exception as e:
-                print(f"[save_data] Error: {e}")
+                print(f"[load_data] Error: {e}")
 
-    def replicate_to_followers(self, operation_type, data_dict):
+            for index, op_type, data in self.mutation_log.replay(after_index=last_index, after_term=last_term):
+                try:
+                    if isinstance(data, bytes):
+                        self.apply_record(chat_pb2.MutationRecord.FromString(data))
+                    else:
+                        self.apply_mutation(op_type, data)
+                except Exception as e:
+                    print(f"[load_data] Error replaying record {index} ({op_type}): {e}")
+            self.hash_users(self.users)
+            self.mutation_log.open()
+
+    def load_snapshot(self):
         """
-        Helper that sends a ReplicateMutation to all replicas if we're leader.
+        Replace the in-memory state with the contents of the snapshot file
+        and return the (log index, term) of the last record it covers.
+        Caller holds data_lock.
         """
-        if not self.is_leader:
+        self.users = OrderedDict()
+        self.conversations = ConversationStore(self.conversation_cache_size)
+        self.message_ids.reset(1)
+        last_index, last_term = 0, 0
+        try:
+            if os.path.exists(self.data_file):
+                (next_msg_id, last_index, last_term, self.users,
+                 index, message_index, digests, segment) = read_snapshot(self.data_file)
+                self.message_ids.reset(next_msg_id)
+                self.conversations.open_snapshot(segment, index, message_index, digests)
+        finally:
+            self.user_index = UsernameIndex(self.users)
+            self.user_hashes = HashTree()
+            self.hash_users(self.users)
+        return last_index, last_term
+
+    @property
+    def next_msg_id(self):
+        return self.message_ids.next_id
+
+    def hash_users(self, usernames):
+        """
+        Bring the users' entries in user_hashes up to date (removing the
+        ones that no longer exist). Caller holds data_lock, or shares it and
+        holds the users' stripes.
+        """
+        for username in usernames:
+            user = self.users.get(username)
+            self.user_hashes.set(username, user and user_digest(user["password_hash"], user["messages"]))
+
+    def log_mutation(self, operation_type, data_dict):
+        """
+        Queue a record of a mutation that has just been applied in memory and
+        return its log index. Callers hold the locks they applied it under
+        (data_lock, or a share of it and the stripes of every key it
+        touched), so the log order matches the apply order for each key, and
+        then call wait_durable() after releasing them.
+        On the leader the record is also queued for the followers, in the
+        same order.
+        """
+        # conversations update their hashes themselves
+        self.hash_users([data_dict["username"] if "username" in data_dict else data_dict["recipient"]])
+        with self.log_order_lock:
+            index = self.mutation_log.append(operation_type, data_dict, self.term)
+            if self.is_leader:
+                self.replica_pool.push(mutation_record(index, operation_type, data_dict, self.term))
+        self.request_snapshot_if_due()
+        return index
+
+    def log_record(self, record):
+        """
+        log_mutation() for a MutationRecord from the leader, which goes into
+        our log as it is. Caller holds data_lock.
+        """
+        kind = record.WhichOneof("mutation")
+        mutation = getattr(record, kind)
+        self.hash_users([mutation.username if "username" in mutation.DESCRIPTOR.fields_by_name
+                         else mutation.recipient])
+        with self.log_order_lock:
+            index = self.mutation_log.append_record(kind.upper(), record.SerializeToString(), record.term)
+        self.request_snapshot_if_due()
+        return index
+
+    def request_snapshot_if_due(self):
+        if (self.mutation_log.ops_since_rotate >= self.snapshot_every_ops or
+                self.mutation_log.bytes_since_rotate >= self.snapshot_every_bytes):
+            self.snapshot_requested.set()
+
+    def wait_durable(self, log_index, context=None):
+        """
+        Block until the given log record is on disk, so an RPC is only
+        acknowledged once its mutation is durable. If it could not be
+        written the RPC fails with INTERNAL; without a context (our own
+        callers) the IOError is raised instead.
+        """
+        if log_index is None:
             return
+        try:
+            self.mutation_log.wait_durable(log_index)
+        except IOError as e:
+            print(f"[wait_durable] Error: {e}")
+            if context is not None:
+                context.abort(grpc.StatusCode.INTERNAL, str(e))
+            raise
+
+    def snapshot_loop(self):
+        while True:
+            self.snapshot_requested.wait()
+            self.snapshot_requested.clear()
+            try:
+                self.take_snapshot()
+            except Exception as e:
+                print(f"[snapshot] Error: {e}")
+
+    def take_snapshot(self):
+        """
+        Write a point-in-time snapshot and drop the log segments it covers.
 
-        import json
-        payload_str = json.dumps(data_dict)
-        for rep in self.replicas:
-            if rep["server_id"] == self.server_id:
-                continue  # skip self
-            target_addr = f'{rep["host"]}:{rep["port"]}'
-            channel = grpc.insecure_channel(target_addr)
-            stub = chat_pb2_grpc.ChatServiceStub(channel)
-
-            req = chat_pb2.ReplicateMutationRequest(
-                operation_type=operation_type,
-                payload=payload_str
+        Only capturing the state and rotating the log happen under data_lock;
+        messages are never modified in place, so copying the lists is enough
+        and the (slow) serialization and write run while RPCs keep going.
+        """
+        with self.snapshot_lock:
+            with self.data_lock:
+                last_index = self.mutation_log.rotate()
+                last_term = self.mutation_log.term_at(last_index)
+                next_msg_id = self.next_msg_id
+                users = [(u, d["password_hash"], list(d["messages"])) for u, d in self.users.items()]
+                conversations, captured = self.conversations.capture()
+                digests = dict(self.conversations.digests)
+
+            index, message_index = write_snapshot(
+                self.data_file, next_msg_id, last_index, users,
+                self.conversations.snapshot_entries(conversations), digests, last_term
             )
+            self.conversations.snapshot_written(map_snapshot(self.data_file), index, message_index, captured)
+            self.mutation_log.truncate_through(last_index)
+
+    def catch_up_loop(self):
+        failures = 0
+        while True:
+            self.catch_up_requested.wait()
+            self.catch_up_requested.clear()
+            if self.closing.is_set():
+                return
+            if self.is_leader:
+                continue
             try:
-                resp = stub.ReplicateMutation(req)
-                if not resp.success:
-                    print(f"[LEADER] Replicate {operation_type} to s{rep['server_id']} failed: {resp.message}")
+                self.catch_up()
+                failures = 0
             except Exception as e:
-                print(f"[LEADER] Error replicating {operation_type} to s{rep['server_id']}: {e}")
+                if not failures:
+                    print(f"[FOLLOWER] Catching up from s{self.leader_id} failed: {e}")
+                failures += 1
+                time.sleep(self.replica_retry_interval)
+                self.catch_up_requested.set()
+
+    def catch_up(self):
+        """
+        Pull what we missed from the leader: the log after our last index,
+        or, if the leader no longer has all of it or has a different record
+        at our last index, its snapshot and then the log after that. A
+        resync after a change of leader always starts from the snapshot.
+        """
+        leader = self.replica_pool.by_id(self.leader_id)
+        if leader is None:
+            if self.resync_requested:
+                raise IOError("No leader to resync from yet")
+            return
+        if self.resync_requested:
+            self.install_snapshot(leader.stub())
+            self.resync_requested = False
+        try:
+            self.fetch_log(leader.stub())
+        except grpc.RpcError as e:
+            if e.code() not in (grpc.StatusCode.OUT_OF_RANGE, grpc.StatusCode.FAILED_PRECONDITION):
+                raise
+            self.install_snapshot(leader.stub())
+            self.fetch_log(leader.stub())
+
+    def fetch_log(self, stub):
+        after_index = self.mutation_log.last_index
+        request = chat_pb2.FetchLogRequest(after_index=after_index, after_term=self.mutation_log.last_term)
+        for batch in stub.FetchLog(request):
+            applied_index, error = self.apply_replicated(batch.records)
+            if error:
+                raise IOError(error)
+        if self.mutation_log.last_index > after_index:
+            print(f"[FOLLOWER] Caught up from record {after_index + 1} to {self.mutation_log.last_index}")
+
+    def install_snapshot(self, stub):
+        """
+        Replace our state with the leader's snapshot, streamed to a temporary
+        file chunk by chunk so it never has to fit in memory.
+        """
+        tmp_path = f"{self.data_file}.install.tmp"
+        received = 0
+        total_size = 0
+        with open(tmp_path, "wb") as f:
+            for chunk in stub.InstallSnapshot(chat_pb2.InstallSnapshotRequest()):
+                f.write(chunk.data)
+                received += len(chunk.data)
+                total_size = chunk.total_size
+            f.flush()
+            os.fsync(f.fileno())
+        if received != total_size:
+            os.remove(tmp_path)
+            raise IOError(f"Snapshot transfer stopped at {received} of {total_size} bytes")
+
+        with self.snapshot_lock:
+            with self.data_lock:
+                os.replace(tmp_path, self.data_file)
+                last_index, last_term = self.load_snapshot()
+                self.mutation_log.reset(last_index, last_term)
+        print(f"[FOLLOWER] Installed snapshot of {received} bytes up to record {last_index}")
+
+    def apply_mutation(self, op_type, data):
+        """
+        Apply one mutation record to the in-memory state. Used for our own
+        writes and for replaying the mutation log.
+        """
+        if op_type == "CREATE_ACCOUNT":
+            self.apply_create_account(data["username"], data["password_hash"])
+
+        elif op_type == "SEND_MESSAGE":
+            self.apply_send_message(data["sender"], data["recipient"], message_from_dict(data["message_entry"]),
+                                    data.get("remote_recipient", False), data)
+
+        elif op_type == "DELIVER_MESSAGE":
+            self.apply_deliver_message(data["recipient"], message_from_dict(data["message_entry"]), data)
+
+        elif op_type == "DELETE_ACCOUNT":
+            self.apply_delete_account(data["username"])
+
+        elif op_type == "MARK_READ":
+            self.apply_mark_read(data["username"], data["message_ids"])
+
+        elif op_type == "DELETE_MESSAGES":
+            self.apply_delete_messages(data["username"], data["message_ids"])
+
+        else:
+            raise ValueError(f"Unknown operation type {op_type}")
+
+    def apply_record(self, record):
+        """
+        apply_mutation() for a typed MutationRecord from the leader, read
+        straight from its fields.
+        """
+        kind = record.WhichOneof("mutation")
+        if kind == "create_account":
+            m = record.create_account
+            self.apply_create_account(m.username, m.password_hash)
+
+        elif kind == "send_message":
+            m = record.send_message
+            chatmsg = chat_pb2.ChatMessage()
+            chatmsg.CopyFrom(m.message)
+            self.apply_send_message(m.sender, m.recipient, chatmsg, m.remote_recipient, {"delivered": m.delivered})
+
+        elif kind == "deliver_message":
+            m = record.deliver_message
+            chatmsg = chat_pb2.ChatMessage()
+            chatmsg.CopyFrom(m.message)
+            self.apply_deliver_message(m.recipient, chatmsg, {"delivered": m.delivered})
+
+        elif kind == "delete_account":
+            self.apply_delete_account(record.delete_account.username)
+
+        elif kind == "mark_read":
+            self.apply_mark_read(record.mark_read.username, list(record.mark_read.message_ids))
+
+        elif kind == "delete_messages":
+            self.apply_delete_messages(record.delete_messages.username, list(record.delete_messages.message_ids))
+
+        else:
+            raise ValueError(f"Unknown mutation {kind}")
+
+    def apply_create_account(self, username, pw_hash):
+        self.users[username] = {
+            "password_hash": pw_hash,
+            "messages": []
+        }
+        self.user_index.add(username)
+
+    def apply_send_message(self, sender, recipient, chatmsg, remote_recipient, data):
+        self.message_ids.advance(chatmsg.id + 1)
+        conv_key = tuple(sorted([sender, recipient]))
+        self.conversations.append(conv_key, chatmsg)
+        # a recipient on another shard gets it through DELIVER_MESSAGE there
+        if not remote_recipient:
+            self.deliver(recipient, chatmsg, data)
+
+    def apply_deliver_message(self, recipient, chatmsg, data):
+        self.message_ids.advance(chatmsg.id + 1)
+        self.deliver(recipient, chatmsg, data)
+
+    def apply_delete_account(self, username):
+        if username in self.users:
+            del self.users[username]
+        self.user_index.remove(username)
+        if username in self.active_subscriptions:
+            self.active_subscriptions.pop(username, Subscription()).close()
+        for k in self.conversations.keys_for(username):
+            del self.conversations[k]
+
+    def apply_mark_read(self, username, msg_ids):
+        self.users[username]["messages"] = [
+            m for m in self.users[username]["messages"] if m.id not in msg_ids
+        ]
+
+    def apply_delete_messages(self, username, msg_ids):
+        # a shard that does not hold the user only has conversations
+        unread = self.users[username]["messages"] if username in self.users else []
+        for msg_id in msg_ids:
+            pos = message_position(unread, msg_id)
+            if pos is not None:
+                del unread[pos]
+        self.conversations.delete_messages(msg_ids, username)
+
+    def deliver(self, recipient, chatmsg, data):
+        """
+        Hand a new message to the recipient's live subscription, or add it
+        to their unread list. Messages from conversations on other shards
+        can arrive out of id order, so the list is kept sorted.
+        """
+        # "delivered" is set on the leader, in its log and in the record it
+        # replicates, for messages that went straight to a live subscriber
+        # and so never sat in the unread list.
+        if data.get("delivered"):
+            return
+        subscription = self.active_subscriptions.get(recipient)
+        if subscription is not None and subscription.put(chatmsg):
+            data["delivered"] = True
+        else:
+            insort(self.users[recipient]["messages"], chatmsg, key=attrgetter("id"))
+
+    def replicate_to_followers(self, log_index):
+        """
+        If we're leader, wait until as many followers as replication_ack asks
+        for have applied the given log record. log_mutation() has already
+        queued it on every follower's replication stream.
+        """
+        if not self.is_leader or log_index is None:
+            return
+
+        followers = len(self.replica_pool)
+        if self.replication_ack == "all":
+            wait_for = followers
+        elif self.replication_ack == "majority":
+            wait_for = (followers + 1) // 2
+        else:
+            return
+        if not self.replica_pool.wait_acked(log_index, wait_for, self.replication_timeout):
+            print(f"[LEADER] Record {log_index} not acked by {wait_for} followers in time")
 
     def hash_password(self, password):
         return hashlib.sha256(password.encode()).hexdigest()
@@ -143,6 +901,7 @@ class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
     # -------------------------------
 
     def Login(self, request, context):
+        self.wait_readable(request, context)
         username = request.username
         password = request.password
         
@@ -163,309 +922,708 @@ class ChatServiceServicer(chat_pb2_grpc.ChatServiceServicer):
         return chat_pb2.LoginResponse(
             success=True,
             message=f"Login successful. Unread messages: {unread_count}",
-            unread_count=unread_count
+            unread_count=unread_count,
+            applied_index=self.mutation_log.last_index
         )
 
     def CreateAccount(self, request, context):
+        if not self.is_leader:
+            return self.forward_to_leader("CreateAccount", request, context)
         username = request.username
         password = request.password
-        
-        if username in self.users:
-            return chat_pb2.CreateAccountResponse(
-                success=False,
-                message="Username already exists"
-            )
-
-        self.users[username] = {
-            "password_hash": self.hash_password(password),
-            "messages": []
-        }
-        self.save_data()
+        if not self.owns_user(username):
+            self.check_shard(context, self.shards.user_shard(username), f"User {username}")
 
-        # replicate if leader
         data_dict = {
             "username": username,
-            "password_hash": self.users[username]["password_hash"]
+            "password_hash": self.hash_password(password)
         }
-        self.replicate_to_followers("CREATE_ACCOUNT", data_dict)
+        with self.data_lock:
+            if username in self.users:
+                return chat_pb2.CreateAccountResponse(
+                    success=False,
+                    message="Username already exists"
+                )
+            self.apply_mutation("CREATE_ACCOUNT", data_dict)
+            log_index = self.log_mutation("CREATE_ACCOUNT", data_dict)
+        self.wait_durable(log_index, context)
+
+        # replicate if leader
+        self.replicate_to_followers(log_index)
 
         return chat_pb2.CreateAccountResponse(
             success=True,
-            message="Account created"
+            message="Account created",
+            log_index=log_index or 0
         )
 
     def LogOff(self, request, context):
+        # the subscription to drop is on the leader
+        if not self.is_leader:
+            return self.forward_to_leader("LogOff", request, context)
         username = request.username
         if username in self.active_subscriptions:
-            del self.active_subscriptions[username]
+            self.active_subscriptions.pop(username, Subscription()).close()
         return chat_pb2.LogOffResponse(success=True, message="User logged off")
 
     def DeleteAccount(self, request, context):
+        if not self.is_leader:
+            return self.forward_to_leader("DeleteAccount", request, context)
         username = request.username
-        if username not in self.users:
-            return chat_pb2.DeleteAccountResponse(success=False, message="User does not exist")
-
-        del self.users[username]
-        if username in self.active_subscriptions:
-            del self.active_subscriptions[username]
-        
-        # remove all conversation history involving this user
-        keys_to_delete = [k for k in self.conversations if username in k]
-        for k in keys_to_delete:
-            del self.conversations[k]
-        
-        self.save_data()
 
+        # removes the user and all conversation history involving them; the
+        # router also sends it to every other shard for their conversations
         data_dict = { "username": username }
-        self.replicate_to_followers("DELETE_ACCOUNT", data_dict)
+        with self.data_lock:
+            if self.owns_user(username) and username not in self.users:
+                return chat_pb2.DeleteAccountResponse(success=False, message="User does not exist")
+            self.apply_mutation("DELETE_ACCOUNT", data_dict)
+            log_index = self.log_mutation("DELETE_ACCOUNT", data_dict)
+        self.wait_durable(log_index, context)
 
-        return chat_pb2.DeleteAccountResponse(success=True, message="Account and conversation deleted")
+        self.replicate_to_followers(log_index)
+
+        return chat_pb2.DeleteAccountResponse(success=True, message="Account and conversation deleted",
+                                              log_index=log_index or 0)
 
     def SendMessage(self, request, context):
+        if not self.is_leader:
+            return self.forward_to_leader("SendMessage", request, context)
         sender = request.sender
         recipient = request.recipient
         content = request.content
         timestamp = datetime.datetime.now().isoformat()
-        
-        if recipient not in self.users:
-            return chat_pb2.SendMessageResponse(success=False, message="Recipient not found")
-
-        msg_id = self.next_msg_id
-        self.next_msg_id += 1
-
-        message_entry = chat_pb2.ChatMessage(
-            id=msg_id,
-            sender=sender,
-            content=content,
-            timestamp=timestamp
-        )
         conv_key = tuple(sorted([sender, recipient]))
-        if conv_key not in self.conversations:
-            self.conversations[conv_key] = []
-        self.conversations[conv_key].append(message_entry)
-
-        if recipient not in self.active_subscriptions:
-            self.users[recipient]["messages"].append(message_entry)
-        else:
-            try:
-                self.active_subscriptions[recipient].put(message_entry)
-            except Exception as e:
-                print(f"Error forwarding message to {recipient}: {e}")
-                self.users[recipient]["messages"].append(message_entry)
+        remote = not self.owns_user(recipient)
+        if self.shards is not None:
+            self.check_shard(context, self.shards.conversation_shard(sender, recipient), "Conversation")
 
-        self.save_data()
-
-        # replicate if leader
+        message_entry = {
+            "id": 0,
+            "sender": sender,
+            "content": content,
+            "timestamp": timestamp
+        }
         data_dict = {
             "sender": sender,
             "recipient": recipient,
-            "message_entry": {
-                "id": msg_id,
-                "sender": sender,
-                "content": content,
-                "timestamp": timestamp
-            }
+            "message_entry": message_entry
         }
-        self.replicate_to_followers("SEND_MESSAGE", data_dict)
+        # the conversation's lock keeps its ids in the order it is logged,
+        # also while a message is out for delivery to another shard
+        with self.conversation_locks.hold(conv_key):
+            # the recipient's stripe guards their unread list
+            with self.data_lock.shared(), self.key_locks.hold(recipient):
+                if not remote and recipient not in self.users:
+                    return chat_pb2.SendMessageResponse(success=False, message="Recipient not found")
+                message_entry["id"] = self.message_ids.allocate()
+                if remote:
+                    data_dict["remote_recipient"] = True
+                # Delivers to the recipient's live subscription if there is one,
+                # otherwise queues the message as unread.
+                log_record = dict(data_dict)
+                self.apply_mutation("SEND_MESSAGE", log_record)
+                log_index = self.log_mutation("SEND_MESSAGE", log_record)
+
+            if remote:
+                # the id has to survive a crash or failover here before
+                # another shard holds a message with it
+                self.wait_durable(log_index, context)
+                self.replicate_to_followers(log_index)
+                delivered = self.call_shard(self.shards.user_shard(recipient), "DeliverMessage",
+                                            chat_pb2.DeliverMessageRequest(
+                                                recipient=recipient, message=message_from_dict(message_entry)),
+                                            context)
+                if not delivered.success:
+                    self.unsend(sender, message_entry["id"], context)
+                    return chat_pb2.SendMessageResponse(success=False, message="Recipient not found")
+                return chat_pb2.SendMessageResponse(success=True, message="Message sent", log_index=log_index or 0)
+        self.wait_durable(log_index, context)
+
+        # replicate if leader
+        self.replicate_to_followers(log_index)
 
-        return chat_pb2.SendMessageResponse(success=True, message="Message sent")
+        return chat_pb2.SendMessageResponse(success=True, message="Message sent", log_index=log_index or 0)
+
+    def unsend(self, sender, msg_id, context):
+        """
+        Take back a message whose recipient turned out not to exist on
+        their shard.
+        """
+        data_dict = {
+            "username": sender,
+            "message_ids": [msg_id]
+        }
+        with self.data_lock:
+            self.apply_mutation("DELETE_MESSAGES", data_dict)
+            log_index = self.log_mutation("DELETE_MESSAGES", data_dict)
+        self.wait_durable(log_index, context)
+
+        self.replicate_to_followers(log_index)
 
     def ReadMessages(self, request, context):
+        if not self.is_leader:
+            return self.forward_to_leader("ReadMessages", request, context)
         username = request.username
-        if username not in self.users:
-            return chat_pb2.ReadMessagesResponse()
-
         limit = request.limit
-        user_messages = self.users[username]["messages"]
-        
-        if limit > 0:
-            messages_to_view = user_messages[:limit]
-            self.users[username]["messages"] = user_messages[limit:]
-        else:
-            messages_to_view = user_messages
-            self.users[username]["messages"] = []
-
-        self.save_data()
+        if not self.owns_user(username):
+            self.check_shard(context, self.shards.user_shard(username), f"User {username}")
+        with self.data_lock.shared(), self.key_locks.hold(username):
+            if username not in self.users:
+                return chat_pb2.ReadMessagesResponse()
+            user_messages = self.users[username]["messages"]
+
+            if limit > 0:
+                messages_to_view = user_messages[:limit]
+                self.users[username]["messages"] = user_messages[limit:]
+            else:
+                messages_to_view = user_messages
+                self.users[username]["messages"] = []
 
-        # replicate removal of these messages from unread
-        removed_ids = [m.id for m in messages_to_view]
-        if removed_ids:
+            # record removal of these messages from unread
+            removed_ids = [m.id for m in messages_to_view]
             data_dict = {
                 "username": username,
                 "message_ids": removed_ids
             }
-            self.replicate_to_followers("DELETE_MESSAGES", data_dict)
+            log_index = None
+            if removed_ids:
+                log_index = self.log_mutation("MARK_READ", data_dict)
+        self.wait_durable(log_index, context)
+
+        if removed_ids:
+            self.replicate_to_followers(log_index)
 
-        return chat_pb2.ReadMessagesResponse(messages=messages_to_view)
+        return chat_pb2.ReadMessagesResponse(messages=messages_to_view, log_index=log_index or 0)
 
     def DeleteMessages(self, request, context):
+        if not self.is_leader:
+            return self.forward_to_leader("DeleteMessages", request, context)
         username = request.username
         message_ids = request.message_ids
 
-        if username not in self.users:
-            return chat_pb2.DeleteMessagesResponse(success=False, message="User not found")
-
         if not message_ids:
             return chat_pb2.DeleteMessagesResponse(success=False, message="No message IDs provided")
 
-        # check existence
-        message_exists = False
-        for msg in self.users[username]["messages"]:
-            if msg.id in message_ids:
-                message_exists = True
-                break
-        if not message_exists:
-            # check conversation history
-            for conv_key in self.conversations:
-                if username in conv_key:
-                    for msg in self.conversations[conv_key]:
-                        if msg.id in message_ids:
-                            message_exists = True
-                            break
-                    if message_exists:
-                        break
-
-        if not message_exists:
-            return chat_pb2.DeleteMessagesResponse(success=False, message="No matching message found to delete")
-
-        # remove from unread
-        self.users[username]["messages"] = [m for m in self.users[username]["messages"] if m.id not in message_ids]
-        # remove from conversation
-        for conv_key in self.conversations:
-            if username in conv_key:
-                self.conversations[conv_key] = [m for m in self.conversations[conv_key] if m.id not in message_ids]
-
-        self.save_data()
-
+        # remove from unread and from conversation history
         data_dict = {
             "username": username,
             "message_ids": list(message_ids)
         }
-        self.replicate_to_followers("DELETE_MESSAGES", data_dict)
+        # exclusive, since the messages may be in any of the user's conversations
+        with self.data_lock:
+            if self.owns_user(username) and username not in self.users:
+                return chat_pb2.DeleteMessagesResponse(success=False, message="User not found")
+
+            # check existence, in unread and then in conversation history
+            unread = self.users[username]["messages"] if username in self.users else []
+            message_exists = (
+                any(message_position(unread, msg_id) is not None for msg_id in message_ids) or
+                self.conversations.has_any(message_ids, username)
+            )
+            if not message_exists:
+                return chat_pb2.DeleteMessagesResponse(success=False,
+                                                       message="No matching message found to delete")
+            self.apply_mutation("DELETE_MESSAGES", data_dict)
+            log_index = self.log_mutation("DELETE_MESSAGES", data_dict)
+        self.wait_durable(log_index, context)
 
-        return chat_pb2.DeleteMessagesResponse(success=True, message="Messages deleted")
+        self.replicate_to_followers(log_index)
+
+        return chat_pb2.DeleteMessagesResponse(success=True, message="Messages deleted", log_index=log_index or 0)
 
     def ViewConversation(self, request, context):
+        self.wait_readable(request, context)
         username = request.username
         other_user = request.other_user
+        applied_index = self.mutation_log.last_index
+        if self.shards is not None:
+            self.check_shard(context, self.shards.conversation_shard(username, other_user), "Conversation")
 
-        if other_user not in self.users:
-            return chat_pb2.ViewConversationResponse()
+        if self.owns_user(other_user) and other_user not in self.users:
+            return chat_pb2.ViewConversationResponse(applied_index=applied_index)
 
         conv_key = tuple(sorted([username, other_user]))
-        conversation = self.conversations.get(conv_key, [])
-
-        # remove from unread
-        current_unread = self.users[username]["messages"]
-        removed_ids = []
-        new_unread = []
-        for msg in current_unread:
-            if msg.sender == other_user:
-                removed_ids.append(msg.id)
-            else:
-                new_unread.append(msg)
-        self.users[username]["messages"] = new_unread
+        response = self.conversations.view(conv_key, request.before_id, request.after_id, request.limit)
+        response.applied_index = applied_index
+        if not response.messages:
+            return response
+        first_id = response.messages[0].id
+        last_id = response.messages[-1].id
+
+        # a follower can show the page only if it has nothing to mark read,
+        # which it cannot tell for a user on another shard
+        if not self.is_leader:
+            unread = True
+            if self.owns_user(username):
+                with self.data_lock.shared(), self.key_locks.hold(username):
+                    user = self.users.get(username)
+                    unread = user is not None and any(msg.sender == other_user and first_id <= msg.id <= last_id
+                                                      for msg in user["messages"])
+            if unread:
+                return self.forward_to_leader("ViewConversation", request, context)
+            return response
+
+        # remove the messages on this page from unread
+        if self.owns_user(username):
+            log_index = self.mark_page_read(username, other_user, first_id, last_id, context)
+            if log_index:
+                response.applied_index = log_index
+        else:
+            self.call_shard(self.shards.user_shard(username), "MarkPageRead",
+                            chat_pb2.MarkPageReadRequest(username=username, other_user=other_user,
+                                                         first_id=first_id, last_id=last_id),
+                            context)
+        return response
 
-        self.save_data()
+    def mark_page_read(self, username, other_user, first_id, last_id, context):
+        """
+        Remove the user's unread messages from other_user with ids from
+        first_id to last_id, and return the log index of that change (None
+        if there was nothing to remove).
+        """
+        with self.data_lock.shared(), self.key_locks.hold(username):
+            user = self.users.get(username)
+            if user is None:
+                return None
+            removed_ids = []
+            new_unread = []
+            for msg in user["messages"]:
+                if msg.sender == other_user and first_id <= msg.id <= last_id:
+                    removed_ids.append(msg.id)
+                else:
+                    new_unread.append(msg)
+            user["messages"] = new_unread
 
-        if removed_ids:
             data_dict = {
                 "username": username,
                 "message_ids": removed_ids
             }
-            self.replicate_to_followers("DELETE_MESSAGES", data_dict)
+            log_index = None
+            if removed_ids:
+                log_index = self.log_mutation("MARK_READ", data_dict)
+        self.wait_durable(log_index, context)
 
-        return chat_pb2.ViewConversationResponse(messages=conversation)
+        if removed_ids:
+            self.replicate_to_followers(log_index)
+        return log_index
+
+    def DeliverMessage(self, request, context):
+        """
+        A message from a conversation on another shard, for a user of ours.
+        """
+        if not self.is_leader:
+            return self.forward_to_leader("DeliverMessage", request, context)
+        recipient = request.recipient
+        if not self.owns_user(recipient):
+            self.check_shard(context, self.shards.user_shard(recipient), f"User {recipient}")
+        msg = request.message
+        data_dict = {
+            "recipient": recipient,
+            "message_entry": {"id": msg.id, "sender": msg.sender, "content": msg.content, "timestamp": msg.timestamp}
+        }
+        with self.data_lock.shared(), self.key_locks.hold(recipient):
+            if recipient not in self.users:
+                return chat_pb2.DeliverMessageResponse(success=False, message="Recipient not found")
+            # a retried delivery that already arrived
+            if message_position(self.users[recipient]["messages"], msg.id) is not None:
+                return chat_pb2.DeliverMessageResponse(success=True, message="Message delivered",
+                                                       log_index=self.mutation_log.last_index)
+            log_record = dict(data_dict)
+            self.apply_mutation("DELIVER_MESSAGE", log_record)
+            log_index = self.log_mutation("DELIVER_MESSAGE", log_record)
+        self.wait_durable(log_index, context)
+
+        self.replicate_to_followers(log_index)
+
+        return chat_pb2.DeliverMessageResponse(success=True, message="Message delivered", log_index=log_index or 0)
+
+    def MarkPageRead(self, request, context):
+        if not self.is_leader:
+            return self.forward_to_leader("MarkPageRead", request, context)
+        log_index = self.mark_page_read(request.username, request.other_user, request.first_id, request.last_id,
+                                        context)
+        return chat_pb2.MarkPageReadResponse(log_index=log_index or 0)
 
     def ListAccounts(self, request, context):
+        self.wait_readable(request, context)
         username = request.username
         wildcard = request.wildcard if request.wildcard else "*"
-        matching_users = fnmatch.filter(list(self.users.keys()), wildcard)
-        return chat_pb2.ListAccountsResponse(usernames=matching_users)
+        page_size = request.page_size
+        if page_size <= 0 or page_size > self.max_list_page_size:
+            page_size = self.max_list_page_size
+        with self.data_lock.shared():
+            matching_users, next_token = self.user_index.match(wildcard, page_size, after=request.page_token)
+            applied_index = self.mutation_log.last_index
+        return chat_pb2.ListAccountsResponse(usernames=matching_users, next_page_token=next_token,
+                                             applied_index=applied_index)
 
     def SubscribeToMessages(self, request, context):
+        # messages are delivered by the leader, so a follower relays its stream
+        if not self.is_leader:
+            yield from self.forward_stream_to_leader("SubscribeToMessages", request, context)
+            return
         username = request.username
-        import queue
-        message_queue = queue.Queue()
-        self.active_subscriptions[username] = message_queue
+        subscription = Subscription()
+        # wakes the stream as soon as the client goes away
+        if not context.add_callback(subscription.close):
+            return
+        self.active_subscriptions[username] = subscription
 
         try:
-            while context.is_active():
-                try:
-                    msg = message_queue.get(block=True, timeout=1.0)
-                    yield msg
-                except queue.Empty:
-                    continue
+            yield from subscription
         except Exception as e:
             print(f"Error in subscription for {username}: {e}")
         finally:
-            if username in self.active_subscriptions:
+            subscription.close()
+            if self.active_subscriptions.get(username) is subscription:
                 del self.active_subscriptions[username]
 
     def ReplicateMutation(self, request, context):
-        import json
         try:
-            op_type = request.operation_type
-            data = json.loads(request.payload)
-
-            if op_type == "CREATE_ACCOUNT":
-                username = data["username"]
-                pw_hash = data["password_hash"]
-                self.users[username] = {
-                    "password_hash": pw_hash,
-                    "messages": []
-                }
-
-            elif op_type == "SEND_MESSAGE":
-                sender = data["sender"]
-                recipient = data["recipient"]
-                msg_obj = data["message_entry"]
-                chatmsg = chat_pb2.ChatMessage(
-                    id=msg_obj["id"],
-                    sender=msg_obj["sender"],
-                    content=msg_obj["content"],
-                    timestamp=msg_obj["timestamp"]
-                )
-                conv_key = tuple(sorted([sender, recipient]))
-                if conv_key not in self.conversations:
-                    self.conversations[conv_key] = []
-                self.conversations[conv_key].append(chatmsg)
+            with self.data_lock:
+                if request.HasField("record"):
+                    self.apply_record(request.record)
+                    log_index = self.log_record(request.record)
+                else:
+                    op_type = request.operation_type
+                    data = json.loads(request.payload)
+                    self.apply_mutation(op_type, data)
+                    log_index = self.log_mutation(op_type, data)
+            self.wait_durable(log_index)
+            return chat_pb2.ReplicateMutationResponse(success=True, message="Replication applied")
+
+        except Exception as e:
+            return chat_pb2.ReplicateMutationResponse(success=False, message=str(e))
 
-                if recipient not in self.active_subscriptions:
-                    self.users[recipient]["messages"].append(chatmsg)
+    def StreamMutations(self, request_iterator, context):
+        """
+        Apply batches of the leader's log strictly in index order. Our own
+        log index follows the leader's, so records we already have are
+        skipped, and a gap is refused until the leader resends from the
+        index we ack.
+        """
+        for batch in request_iterator:
+            if not self.observe_leader(batch.term, batch.leader_id, batch.term_start_index, batch.term_start_term):
+                yield chat_pb2.ReplicationAck(applied_index=self.mutation_log.last_index, success=False,
+                                              message="Stale term", term=self.term)
+                continue
+            if self.resync_requested:
+                yield chat_pb2.ReplicationAck(applied_index=self.mutation_log.last_index, success=False,
+                                              message="Resyncing", term=self.term)
+                continue
+            applied_index, error = self.apply_replicated(unpack_records(batch))
+            if error:
+                # we missed records, e.g. while we were down
+                self.catch_up_requested.set()
+            yield chat_pb2.ReplicationAck(applied_index=applied_index, success=not error, message=error,
+                                          term=self.term)
+
+    def apply_replicated(self, records):
+        """
+        Apply records of the leader's log strictly in index order, skipping
+        the ones we already have. Returns our last applied index and, if
+        the records do not follow on from it, a description of the gap.
+        """
+        error = ""
+        log_index = None
+        with self.data_lock:
+            for record in records:
+                expected = self.mutation_log.last_index + 1
+                if record.index < expected:
+                    continue
+                if record.index > expected:
+                    error = f"Expected record {expected}, got {record.index}"
+                    break
+                try:
+                    self.apply_record(record)
+                except Exception as e:
+                    # Kept in the log anyway so indexes stay aligned;
+                    # replay skips it the same way.
+                    print(f"[FOLLOWER] Error applying record {record.index} ({record.WhichOneof('mutation')}): {e}")
+                log_index = self.log_record(record)
+            applied_index = self.mutation_log.last_index
+        self.wait_durable(log_index)
+        self.note_applied()
+        return applied_index, error
+
+    def FetchLog(self, request, context):
+        """
+        Stream our log after the follower's last record, if that record is
+        the one we have at its index.
+        """
+        after_term = self.mutation_log.term_at(request.after_index)
+        if after_term is None:
+            context.abort(grpc.StatusCode.OUT_OF_RANGE, f"No record {request.after_index} to continue from")
+        if after_term != request.after_term:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION,
+                          f"Record {request.after_index} is from term {after_term}, not {request.after_term}")
+        records = []
+        try:
+            for index, op_type, data in self.mutation_log.read(request.after_index):
+                if isinstance(data, bytes):
+                    records.append(chat_pb2.MutationRecord.FromString(data))
                 else:
-                    try:
-                        self.active_subscriptions[recipient].put(chatmsg)
-                    except:
-                        self.users[recipient]["messages"].append(chatmsg)
+                    records.append(mutation_record(index, op_type, data, self.mutation_log.term_at(index)))
+                if len(records) == self.replication_batch_size:
+                    yield chat_pb2.ReplicationBatch(records=records)
+                    records = []
+        except LookupError as e:
+            context.abort(grpc.StatusCode.OUT_OF_RANGE, str(e))
+        if records:
+            yield chat_pb2.ReplicationBatch(records=records)
+
+    def InstallSnapshot(self, request, context):
+        if not os.path.exists(self.data_file):
+            self.take_snapshot()
+        # an open file keeps its contents even if a newer snapshot replaces it
+        with open(self.data_file, "rb") as f:
+            total_size = os.fstat(f.fileno()).st_size
+            while True:
+                data = f.read(self.snapshot_chunk_size)
+                if not data:
+                    break
+                yield chat_pb2.SnapshotChunk(data=data, total_size=total_size)
 
-            elif op_type == "DELETE_ACCOUNT":
-                username = data["username"]
+    # -------------------------------
+    # Anti-entropy
+    # -------------------------------
+
+    def hash_tree(self, name, context=None):
+        if name == "users":
+            return self.user_hashes
+        if name == "conversations":
+            return self.conversations.hash_tree
+        if context is not None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Unknown hash tree {name}")
+        raise ValueError(f"Unknown hash tree {name}")
+
+    def CompareHashTree(self, request, context):
+        # a share of data_lock keeps out load_snapshot(), which replaces
+        # the trees; writes carry on, updating the tree under its own lock,
+        # which node() holds while it copies the node
+        with self.data_lock.shared():
+            tree = self.hash_tree(request.tree, context)
+            digest, children = tree.node(request.path)
+            return chat_pb2.HashTreeResponse(
+                digest=digest_bytes(digest),
+                children=[chat_pb2.HashNode(path=path, digest=digest_bytes(digest))
+                          for path, digest in children],
+                applied_index=self.mutation_log.last_index)
+
+    def FetchEntries(self, request, context):
+        with self.data_lock.shared(), self.key_locks.hold(*request.usernames):
+            response = chat_pb2.FetchEntriesResponse(applied_index=self.mutation_log.last_index)
+            for username in request.usernames:
+                user = self.users.get(username)
+                if user is not None:
+                    response.users.add(username=username, password_hash=user["password_hash"],
+                                       unread=user["messages"])
+            for key in request.conversations:
+                conv_key = tuple(key.split("::"))
+                if conv_key in self.conversations:
+                    response.conversations.add(key=key, messages=self.conversations.view(conv_key).messages)
+            return response
+
+    def anti_entropy_loop(self):
+        while not self.closing.wait(self.anti_entropy_interval):
+            if self.is_leader:
+                continue
+            try:
+                self.anti_entropy()
+            except Exception as e:
+                print(f"[FOLLOWER] Anti-entropy with s{self.leader_id} failed: {e}")
+
+    def anti_entropy(self):
+        """
+        Compare our hash trees with the leader's and overwrite the users and
+        conversations that differ with the leader's copies. The trees are
+        only comparable while both sides are at the same log index, so the
+        round is dropped if either moves on. Returns how many entries were
+        repaired, or None if there was no leader or the round was dropped.
+        """
+        leader = self.replica_pool.by_id(self.leader_id)
+        if leader is None or self.is_leader:
+            return None
+        stub = leader.stub()
+        usernames = self.diverging_keys(stub, "users")
+        conversations = self.diverging_keys(stub, "conversations")
+        if usernames is None or conversations is None:
+            return None
+        if not usernames and not conversations:
+            return 0
+
+        request = chat_pb2.FetchEntriesRequest(usernames=usernames, conversations=conversations)
+        response = stub.FetchEntries(request, compression=leader.compression_for(request))
+        with self.data_lock:
+            if response.applied_index != self.mutation_log.last_index:
+                return None
+            for username in usernames:
                 if username in self.users:
                     del self.users[username]
-                if username in self.active_subscriptions:
-                    del self.active_subscriptions[username]
-                keys_to_delete = [k for k in self.conversations if username in k]
-                for k in keys_to_delete:
-                    del self.conversations[k]
-
-            elif op_type == "DELETE_MESSAGES":
-                username = data["username"]
-                msg_ids = data["message_ids"]
-                self.users[username]["messages"] = [
-                    m for m in self.users[username]["messages"] if m.id not in msg_ids
-                ]
-                for ckey in self.conversations:
-                    if username in ckey:
-                        self.conversations[ckey] = [
-                            m for m in self.conversations[ckey] if m.id not in msg_ids
-                        ]
-
-            self.save_data()
-            return chat_pb2.ReplicateMutationResponse(success=True, message="Replication applied")
+                    self.user_index.remove(username)
+            for user in response.users:
+                self.users[user.username] = {"password_hash": user.password_hash, "messages": list(user.unread)}
+                self.user_index.add(user.username)
+            self.hash_users(usernames)
+            for key in conversations:
+                conv_key = tuple(key.split("::"))
+                if conv_key in self.conversations:
+                    del self.conversations[conv_key]
+            for conv in response.conversations:
+                self.conversations.replace(tuple(conv.key.split("::")), conv.messages)
+                if conv.messages:
+                    self.message_ids.advance(conv.messages[-1].id + 1)
+        # the repairs are not in the log, so get them into a snapshot
+        self.snapshot_requested.set()
+        repaired = len(usernames) + len(conversations)
+        print(f"[FOLLOWER] Repaired {repaired} entries that differed from s{leader.server_id}")
+        return repaired
+
+    def diverging_keys(self, stub, name):
+        """
+        Walk the leader's hash tree `name` from the root, descending only
+        where it differs from ours, and return the keys that differ. None if
+        either side's log index changed on the way.
+        """
+        keys = []
+        paths = [""]
+        while paths:
+            path = paths.pop()
+            remote = stub.CompareHashTree(chat_pb2.HashTreeRequest(tree=name, path=path))
+            with self.data_lock:
+                if remote.applied_index != self.mutation_log.last_index:
+                    return None
+                tree = self.hash_tree(name)
+                if tree.digest(path) == int.from_bytes(remote.digest, "little"):
+                    continue
+                local = dict(tree.children(path))
+            theirs = {child.path: int.from_bytes(child.digest, "little") for child in remote.children}
+            for child in sorted(set(local) | set(theirs)):
+                if local.get(child, 0) != theirs.get(child, 0):
+                    (paths if len(path) < HashTree.DEPTH else keys).append(child)
+        return keys
+
+
+class AsyncSubscription:
+    """
+    A Subscription for the aio server. The stream awaits an asyncio queue,
+    so it holds no thread while idle; put() and close() may be called from
+    any thread.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def put(self, message):
+        with self.lock:
+            if self.closed:
+                return False
+            try:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+            except RuntimeError:  # the server's event loop is gone
+                return False
+            return True
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+            except RuntimeError:
+                pass
 
-        except Exception as e:
-            return chat_pb2.ReplicateMutationResponse(success=False, message=str(e))
+    async def __aiter__(self):
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            yield message
+
+
+class AioChatServiceServicer(ChatServiceServicer):
+    """
+    The ChatService for a grpc.aio server. Subscriptions are coroutines
+    waiting on asyncio queues, so open streams cost no worker threads; the
+    other handlers are the blocking ones above, run by the server's thread
+    pool.
+    """
+
+    def __init__(self, server_id, replicas, config=None):
+        super().__init__(server_id, replicas, config)
+        # aio channels to the leader for relaying subscriptions, by address
+        self.leader_channels = {}
+
+    async def wait_for_leader(self, context):
+        """
+        leader_replica() without blocking the event loop.
+        """
+        deadline = time.monotonic() + 2 * self.election_timeout
+        while True:
+            if self.is_leader:
+                return None
+            leader = self.replica_pool.by_id(self.leader_id)
+            if leader is not None:
+                return leader
+            if time.monotonic() > deadline:
+                address = self.leader_address()
+                if address:
+                    context.set_trailing_metadata((("leader", address),))
+                await context.abort(grpc.StatusCode.UNAVAILABLE,
+                                    f"No leader to forward to (leader: {address or 'being elected'})")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def relay_from_leader(self, method, request, context):
+        leader = await self.wait_for_leader(context)
+        if leader is None:
+            async for response in getattr(self, method)(request, context):
+                yield response
+            return
+        channel = self.leader_channels.get(leader.address)
+        if channel is None:
+            channel = self.leader_channels[leader.address] = grpc.aio.insecure_channel(leader.address)
+        call = getattr(chat_pb2_grpc.ChatServiceStub(channel), method)(request)
+        try:
+            async for response in call:
+                yield response
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                leader.record_failure(e)
+                # reconnect from scratch next time rather than wait out backoff
+                if e.code() == grpc.StatusCode.UNAVAILABLE and self.leader_channels.get(leader.address) is channel:
+                    del self.leader_channels[leader.address]
+                    await channel.close()
+                await context.abort(e.code(), e.details())
+        finally:
+            call.cancel()
+
+    async def SubscribeToMessages(self, request, context):
+        if not self.is_leader:
+            async for message in self.relay_from_leader("SubscribeToMessages", request, context):
+                yield message
+            return
+        username = request.username
+        subscription = AsyncSubscription(asyncio.get_running_loop())
+        context.add_done_callback(lambda _: subscription.close())
+        self.active_subscriptions[username] = subscription
+
+        try:
+            async for message in subscription:
+                yield message
+        finally:
+            subscription.close()
+            if self.active_subscriptions.get(username) is subscription:
+                del self.active_subscriptions[username]
+
+    async def close_channels(self):
+        channels, self.leader_channels = list(self.leader_channels.values()), {}
+        for channel in channels:
+            await channel.close()
 
 
 def parse_args():
@@ -477,7 +1635,40 @@ def load_config(config_path):
     with open(config_path, "r") as f:
         return json.load(f)
 
+def threaded_server(service):
+    """
+    The threaded gRPC server for a ChatServiceServicer: unary calls on
+    unary_workers threads, streams on a pool of stream_workers.
+    """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=service.unary_workers),
+                         options=server_keepalive_options(service.replica_keepalive_ms),
+                         interceptors=[service.stream_pool, service.compressor],
+                         maximum_concurrent_rpcs=service.max_concurrent_rpcs)
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(service, server)
+    return server
+
+async def serve_aio(service, listen_port):
+    # Subscriptions run on the event loop here; the unary pool also runs the
+    # few replication streams, which are blocking code.
+    server = grpc.aio.server(futures.ThreadPoolExecutor(max_workers=service.unary_workers),
+                             options=server_keepalive_options(service.replica_keepalive_ms),
+                             interceptors=[service.compressor.aio()],
+                             maximum_concurrent_rpcs=service.max_concurrent_rpcs)
+    chat_pb2_grpc.add_ChatServiceServicer_to_server(service, server)
+    server.add_insecure_port(f'[::]:{listen_port}')
+    await server.start()
+    print(f"Server #{service.server_id} started on port {listen_port} (aio)")
+    # stop on Ctrl-C from inside the loop, so the server shuts down cleanly
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+    await server.stop(0)
+    await service.close_channels()
+
 def serve():
+    server = None
     try:
         args = parse_args()
         config = load_config(args.config)
@@ -485,11 +1676,23 @@ def serve():
         server_id = config["server_id"]
         listen_port = config["listen_port"]
         replicas = config["replicas"]
+        # "threads" serves every call on a worker thread; "aio" runs an
+        # asyncio server where open subscriptions hold no thread.
+        server_mode = config.get("server_mode", "threads")
+        if server_mode not in ("threads", "aio"):
+            raise ValueError(f"Unknown server_mode: {server_mode}")
+
+        if server_mode == "aio":
+            service = AioChatServiceServicer(server_id=server_id, replicas=replicas, config=config)
+            asyncio.run(serve_aio(service, listen_port))
+            service.close()
+            print(f"Server #{server_id} stopped")
+            print(service.compressor.report())
+            return
 
-        service = ChatServiceServicer(server_id=server_id, replicas=replicas)
+        service = ChatServiceServicer(server_id=server_id, replicas=replicas, config=config)
 
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-        chat_pb2_grpc.add_ChatServiceServicer_to_server(service, server)
+        server = threaded_server(service)
         server.add_insecure_port(f'[::]:{listen_port}')
         server.start()
         print(f"Server #{server_id} started on port {listen_port}")
@@ -497,8 +1700,11 @@ def serve():
         while True:
             time.sleep(86400)
     except KeyboardInterrupt:
-        server.stop(0)
+        if server is not None:
+            server.stop(0)
+        service.close()
         print(f"Server #{server_id} stopped")
+        print(service.compressor.report())
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+from bisect import bisect
+
+from client import FailoverStub
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def conversation_key(user_a, user_b):
+    return "::".join(sorted([user_a, user_b]))
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto shards. Every shard is placed at
+    `points` positions on a ring of 64-bit hashes and owns the keys that
+    hash to just before its positions, so adding or removing a shard only
+    moves the keys next to its own positions.
+    """
+
+    def __init__(self, shard_ids, points=64):
+        self.ring = sorted((ring_hash(f"shard-{shard_id}#{i}"), shard_id)
+                           for shard_id in shard_ids for i in range(points))
+        self.positions = [position for position, _ in self.ring]
+
+    def owner(self, key):
+        return self.ring[bisect(self.positions, ring_hash(key)) % len(self.ring)][1]
+
+
+class ShardMap:
+    """
+    The "shards" list of a config: which servers make up each shard, and
+    which shard owns a user or a conversation. Users are placed by
+    username and conversations by their "a::b" key, so both participants'
+    shards may differ from the conversation's.
+    """
+
+    def __init__(self, shards, points=64):
+        self.servers = {shard["shard_id"]: list(shard["servers"]) for shard in shards}
+        self.shard_ids = sorted(self.servers)
+        self.ring = HashRing(self.shard_ids, points)
+        self.lock = threading.Lock()
+        self.stubs = {}
+
+    def __len__(self):
+        return len(self.shard_ids)
+
+    def user_shard(self, username):
+        return self.ring.owner(username)
+
+    def conversation_shard(self, user_a, user_b):
+        return self.ring.owner(conversation_key(user_a, user_b))
+
+    def stub(self, shard_id):
+        """
+        A FailoverStub to the shard's servers, following its leader.
+        """
+        with self.lock:
+            if shard_id not in self.stubs:
+                self.stubs[shard_id] = FailoverStub(self.servers[shard_id])
+            return self.stubs[shard_id]
+
+    def close(self):
+        with self.lock:
+            stubs, self.stubs = list(self.stubs.values()), {}
+        for stub in stubs:
+            stub.close()
@@ -0,0 +1,1365 @@
+import base64
+import fnmatch
+import glob
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import attrgetter, itemgetter
+
+import chat_pb2
+
+
+def record_data(record):
+    """
+    The data of a parsed log line: a dict, or MutationRecord bytes.
+    """
+    if "record" in record:
+        return base64.b64decode(record["record"])
+    return record["data"]
+
+
+class MutationLog:
+    """
+    Durable, append-only log of mutations.
+
+    Every record is one JSON object on its own line, with the term of the
+    leader that wrote it:
+        {"index": 7, "term": 2, "op": "SEND_MESSAGE", "data": {...}}
+    or, for a record a follower received from its leader, the typed
+    MutationRecord as it arrived, base64-encoded:
+        {"index": 7, "term": 2, "op": "SEND_MESSAGE", "record": "..."}
+    so appending costs O(size of the record) no matter how much history the
+    server holds. On startup the records are replayed on top of the last
+    snapshot.
+
+    New records go to `path`. When a snapshot is started the active file is
+    rotated to `path.<last index>`; once the snapshot is safely on disk every
+    rotated segment it covers is deleted.
+
+    Appends are group-committed: append() only queues the record, and a
+    flusher thread writes everything queued so far with a single fsync.
+    sync_policy picks the trade-off between latency and durability:
+        "always"   - flush and fsync as soon as records are queued; records
+                     queued while an fsync is running share the next one
+        "interval" - flush and fsync at most every sync_interval_ms
+        "os"       - write through to the OS on append, never fsync
+    """
+
+    SYNC_POLICIES = ("always", "interval", "os")
+    WRITE_RETRY_INTERVAL = 0.1
+
+    def __init__(self, path, sync_policy="always", sync_interval_ms=10):
+        if sync_policy not in self.SYNC_POLICIES:
+            raise ValueError(f"Unknown log sync policy {sync_policy}")
+        self.path = path
+        self.sync_policy = sync_policy
+        self.sync_interval = sync_interval_ms / 1000.0
+
+        # lock guards the counters and the queue of unwritten records;
+        # io_lock serializes everything that touches the file itself.
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.has_pending = threading.Condition(self.lock)
+        self.synced = threading.Condition(self.lock)
+        self.pending = []
+        self.last_index = 0
+        # [(index, term)]: the records from index on, up to the next entry's
+        # index, were written in term
+        self.term_starts = [(0, 0)]
+        self.synced_index = 0
+        # the last failed write, and the last index it left unwritten
+        self.sync_error = None
+        self.error_index = 0
+        self.closing = False
+        self.flusher = None
+        self.file = None
+        # Growth since the last rotation, used to decide when to snapshot.
+        self.ops_since_rotate = 0
+        self.bytes_since_rotate = 0
+
+    def segments(self):
+        """
+        Return [(last_index, path)] for every rotated segment, oldest first.
+        """
+        found = []
+        for seg_path in glob.glob(glob.escape(self.path) + ".*"):
+            suffix = seg_path[len(self.path) + 1:]
+            if suffix.isdigit():
+                found.append((int(suffix), seg_path))
+        return sorted(found)
+
+    @property
+    def last_term(self):
+        return self.term_starts[-1][1]
+
+    def term_at(self, index):
+        """
+        The term of the record at `index`, or None if we do not know it:
+        the record is older than the snapshot we started from, or newer
+        than our last one.
+        """
+        with self.lock:
+            if index > self.last_index or index < self.term_starts[0][0]:
+                return None
+            return self.term_starts[bisect_right(self.term_starts, index, key=itemgetter(0)) - 1][1]
+
+    def note_term(self, index, term):
+        """
+        Record that the record at `index` has `term`. Caller holds lock.
+        """
+        if term != self.term_starts[-1][1]:
+            self.term_starts.append((index, term))
+
+    def replay(self, after_index=0, after_term=0):
+        """
+        Yield (index, op_type, data) for every complete record newer than
+        after_index, the snapshot's last record, written in after_term.
+        The rotated segments are read before the active file.
+        data is the dict the record was appended with, or the serialized
+        MutationRecord given to append_record().
+
+        A crash in the middle of an append can leave a torn last line behind;
+        it is dropped (and cut off the file) instead of failing the whole load.
+        """
+        self.last_index = max(self.last_index, after_index)
+        self.term_starts = [(after_index, after_term)]
+        paths = [seg_path for _, seg_path in self.segments()] + [self.path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            good_size = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    good_size += len(line)
+                    if record["index"] <= after_index:
+                        continue
+                    self.last_index = max(self.last_index, record["index"])
+                    self.note_term(record["index"], record.get("term", 0))
+                    yield record["index"], record["op"], record_data(record)
+            if good_size != os.path.getsize(path):
+                print(f"[MutationLog] Dropping torn tail of {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(good_size)
+
+    def read(self, after_index):
+        """
+        Yield (index, op_type, data), as replay() does, for every durable
+        record newer than after_index while the log is in use, e.g. to send
+        to a follower.
+        Raises LookupError if some of those records have already been
+        deleted by truncate_through().
+
+        A rotate() while we read moves records we have not reached yet into
+        a segment we did not list, so on a gap or a missing file the
+        segments are listed again, and the read only fails if none were
+        added since the last listing.
+        """
+        with self.lock:
+            upto = self.synced_index
+        expected = after_index + 1
+        listed = None
+        while expected <= upto:
+            segments = self.segments()
+            if segments == listed:
+                raise LookupError(f"Log records from {expected} are no longer available")
+            listed = segments
+            paths = [seg_path for last_index, seg_path in segments if last_index >= expected] + [self.path]
+            for path in paths:
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    break
+                with f:
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break
+                        if record["index"] < expected:
+                            continue
+                        if record["index"] > upto:
+                            return
+                        if record["index"] > expected:
+                            break
+                        yield record["index"], record["op"], record_data(record)
+                        expected += 1
+
+    def reset(self, index, term=0):
+        """
+        Drop every record and continue numbering after `index`, written in
+        `term`. Used when a snapshot of index records received from the
+        leader replaces our state.
+        """
+        with self.io_lock:
+            with self.lock:
+                self.pending = []
+                self.last_index = index
+                self.term_starts = [(index, term)]
+                self.sync_error = None
+            self.file.close()
+            for _, seg_path in self.segments():
+                os.remove(seg_path)
+            open(self.path, "wb").close()
+            self.open()
+            with self.lock:
+                self.synced.notify_all()
+
+    def open(self):
+        # unbuffered, so a failed write leaves nothing behind to be
+        # written twice
+        self.file = open(self.path, "ab", buffering=0)
+        self.ops_since_rotate = 0
+        self.bytes_since_rotate = self.file.tell()
+        self.synced_index = self.last_index
+        if self.sync_policy != "os" and self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flusher.start()
+
+    def append(self, op_type, data, term=0):
+        """
+        Queue one record, written in `term`, and return its log index. The
+        record is not necessarily on disk yet; see wait_durable().
+        """
+        return self.enqueue(term, lambda index: (json.dumps({"index": index, "term": term, "op": op_type, "data": data},
+                                                            separators=(",", ":")) + "\n").encode())
+
+    def append_record(self, op_type, record_bytes, term=0):
+        """
+        append() for a serialized MutationRecord from the leader, which is
+        kept as it is instead of being turned back into JSON data.
+        """
+        encoded = base64.b64encode(record_bytes)
+        return self.enqueue(term, lambda index: b'{"index":%d,"term":%d,"op":"%s","record":"%s"}\n' % (
+            index, term, op_type.encode(), encoded))
+
+    def enqueue(self, term, encode):
+        """
+        Queue the line that encode(index) returns for the next index.
+        """
+        with self.lock:
+            index = self.last_index + 1
+            line = encode(index)
+            self.pending.append(line)
+            self.last_index = index
+            self.note_term(index, term)
+            self.ops_since_rotate += 1
+            self.bytes_since_rotate += len(line)
+            self.has_pending.notify()
+        if self.sync_policy == "os":
+            with self.io_lock:
+                try:
+                    self.write_pending(fsync=False)
+                except Exception as e:
+                    # reported to wait_durable(); retried with the next append
+                    print(f"[MutationLog] Error writing {self.path}: {e}")
+        return index
+
+    def wait_durable(self, index):
+        """
+        Block until the record at `index` has been written according to the
+        sync policy. Raises IOError if the write that should have taken it
+        failed; the record stays queued and is retried, so records queued
+        after the failure wait for the retry.
+        """
+        with self.lock:
+            while self.synced_index < index:
+                if self.sync_error is not None and index <= self.error_index:
+                    raise IOError(f"Mutation log write failed: {self.sync_error}")
+                self.synced.wait()
+
+    def write_pending(self, fsync):
+        """
+        Write every queued record as one batch. Caller holds io_lock.
+        If the write or the fsync fails the file is cut back to where the
+        batch started and the batch is queued again, ahead of newer records.
+        """
+        with self.lock:
+            batch, self.pending = self.pending, []
+            batch_index = self.last_index
+        if not batch:
+            return
+        start = self.file.tell()
+        try:
+            data = memoryview(b"".join(batch))
+            while data:
+                data = data[self.file.write(data):]
+            if fsync:
+                os.fsync(self.file.fileno())
+        except Exception as e:
+            try:
+                os.ftruncate(self.file.fileno(), start)
+                self.file.seek(start)
+            except OSError:
+                pass
+            with self.lock:
+                self.pending[:0] = batch
+                self.sync_error = e
+                self.error_index = batch_index
+                self.synced.notify_all()
+            raise
+        with self.lock:
+            self.synced_index = max(self.synced_index, batch_index)
+            self.sync_error = None
+            self.synced.notify_all()
+
+    def flush_loop(self):
+        failing = False
+        while True:
+            with self.lock:
+                while not self.pending and not self.closing:
+                    self.has_pending.wait()
+                if self.closing:
+                    return
+            if self.sync_policy == "interval":
+                # let more records pile up behind the first one
+                time.sleep(self.sync_interval)
+            with self.io_lock:
+                if self.file is None:
+                    return
+                try:
+                    self.write_pending(fsync=True)
+                    failing = False
+                except Exception as e:
+                    if not failing:
+                        print(f"[MutationLog] Error writing {self.path}: {e}")
+                    failing = True
+            if failing:
+                # the batch is queued again; give the disk a moment
+                time.sleep(self.WRITE_RETRY_INTERVAL)
+
+    def rotate(self):
+        """
+        Close the active file as a segment and start a fresh one.
+        Returns the index of the last record in the closed segment.
+        """
+        with self.io_lock:
+            self.write_pending(fsync=self.sync_policy != "os")
+            self.file.close()
+            if os.path.getsize(self.path) > 0:
+                os.replace(self.path, f"{self.path}.{self.last_index}")
+            self.open()
+            return self.last_index
+
+    def truncate_through(self, index):
+        """
+        Delete every rotated segment whose records are all <= index.
+        """
+        for last_index, seg_path in self.segments():
+            if last_index <= index:
+                os.remove(seg_path)
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+            self.has_pending.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        with self.io_lock:
+            if self.file is not None:
+                self.write_pending(fsync=self.sync_policy != "os")
+                self.file.close()
+                self.file = None
+
+
+class TermFile:
+    """
+    Election state that has to survive a restart: the current term, who we
+    voted for in it, and the term of the leader our log follows. The file
+    is replaced atomically on every change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.term = 0
+        self.voted_for = None
+        self.log_term = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.term = state["term"]
+            self.voted_for = state["voted_for"]
+            self.log_term = state["log_term"]
+
+    def save(self, term, voted_for=None, log_term=None):
+        self.term = term
+        self.voted_for = voted_for
+        if log_term is not None:
+            self.log_term = log_term
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"term": self.term, "voted_for": self.voted_for, "log_term": self.log_term}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def message_from_dict(m):
+    return chat_pb2.ChatMessage(
+        id=m["id"],
+        sender=m["sender"],
+        content=m["content"],
+        timestamp=m["timestamp"]
+    )
+
+
+# -------------------------------
+# Replica checksums
+# -------------------------------
+
+DIGEST_SIZE = 16
+
+
+def digest_of(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest(), "little")
+
+
+def digest_bytes(digest):
+    return digest.to_bytes(DIGEST_SIZE, "little")
+
+
+def message_digest(message):
+    """
+    Digest of one message in the wire form a snapshot segment stores.
+    """
+    return digest_of(chat_pb2.ViewConversationResponse(messages=[message]).SerializeToString())
+
+
+def user_digest(password_hash, unread):
+    return digest_of(password_hash.encode() + b"".join(m.SerializeToString() for m in unread))
+
+
+class HashTree:
+    """
+    A hash tree over (key, digest) pairs, for comparing replicas.
+
+    Keys are spread over 16 ** DEPTH buckets by a hash of the key, and each
+    node at depth d is named by the first d hex digits of its buckets'
+    names. A node's hash is the XOR of the hashes of every key under it, so
+    setting or removing a key only updates the DEPTH + 1 nodes on its path.
+    Two replicas find the keys they disagree on by descending only into
+    the nodes whose hashes differ.
+    """
+
+    DEPTH = 3
+    DIGITS = "0123456789abcdef"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = {}    # path -> XOR of the leaf hashes below it
+        self.buckets = {}  # full-depth path -> {key: leaf hash}
+
+    @classmethod
+    def bucket(cls, key):
+        return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()[:cls.DEPTH]
+
+    def set(self, key, digest):
+        """
+        Record the digest of key's contents; None removes the key.
+        """
+        path = self.bucket(key)
+        new = 0 if digest is None else digest_of(key.encode() + b"\0" + digest_bytes(digest))
+        with self.lock:
+            bucket = self.buckets.setdefault(path, {})
+            old = bucket.pop(key, 0)
+            if new:
+                bucket[key] = new
+            elif not bucket:
+                del self.buckets[path]
+            change = old ^ new
+            if change:
+                for depth in range(self.DEPTH + 1):
+                    node = path[:depth]
+                    value = self.nodes.get(node, 0) ^ change
+                    if value:
+                        self.nodes[node] = value
+                    else:
+                        self.nodes.pop(node, None)
+
+    def digest(self, path=""):
+        with self.lock:
+            return self.nodes.get(path, 0)
+
+    def children(self, path):
+        """
+        (path, hash) of each child of an inner node, or (key, hash) of each
+        key in a bucket.
+        """
+        with self.lock:
+            return self.children_of(path)
+
+    def node(self, path):
+        """
+        (hash, children) of a node, read together so that they agree while
+        keys are being set.
+        """
+        with self.lock:
+            return self.nodes.get(path, 0), self.children_of(path)
+
+    def children_of(self, path):
+        """
+        children() for a caller that holds lock.
+        """
+        if len(path) < self.DEPTH:
+            return [(path + d, self.nodes.get(path + d, 0)) for d in self.DIGITS]
+        return sorted(self.buckets.get(path, {}).items())
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets.values())
+
+
+# -------------------------------
+# Snapshot files
+# -------------------------------
+#
+# A snapshot file is laid out as:
+#
+#   SNAPSHOT_MAGIC, then a fixed header of two little-endian uint64s: where
+#   the message segment starts and where the index record starts
+#   length-prefixed (little-endian uint32) SnapshotRecords: header, users
+#   the message segment: for each conversation, its messages back to back,
+#   then a table of their ids (int32) and a table of their offsets (uint32,
+#   one more than the number of messages, relative to the first message)
+#   the length-prefixed SnapshotRecord holding the conversation index
+#
+# Every message in the segment is stored exactly as it appears on the wire
+# inside a ViewConversationResponse (field tag, length, ChatMessage bytes),
+# so a conversation can be served by parsing a slice of the file straight
+# into the response. The file is memory-mapped; startup only parses the
+# header, the users and the index.
+
+SNAPSHOT_MAGIC = b"CHATDB03"
+FIXED_HEADER = struct.Struct("<QQ")
+RECORD_LENGTH = struct.Struct("<I")
+MESSAGE_TAG = b"\x0a"  # ViewConversationResponse.messages, length-delimited
+
+
+def message_position(messages, msg_id):
+    """
+    Position of msg_id in a list of ChatMessages ordered by id, or None.
+    """
+    pos = bisect_left(messages, msg_id, key=attrgetter("id"))
+    if pos < len(messages) and messages[pos].id == msg_id:
+        return pos
+    return None
+
+
+def varint_size(value):
+    return max(1, (value.bit_length() + 6) // 7)
+
+
+def table_to_bytes(table):
+    if sys.byteorder == "big":
+        table = array(table.typecode, table)
+        table.byteswap()
+    return table.tobytes()
+
+
+def table_from_bytes(typecode, data):
+    table = array(typecode)
+    table.frombytes(data)
+    if sys.byteorder == "big":
+        table.byteswap()
+    return table
+
+
+def encode_messages(messages):
+    """
+    Encode ChatMessages into segment form.
+    Returns (message bytes, ids, offsets).
+    """
+    data = chat_pb2.ViewConversationResponse(messages=messages).SerializeToString()
+    ids = array("i")
+    offsets = array("I", [0])
+    pos = 0
+    for msg in messages:
+        size = msg.ByteSize()
+        pos += len(MESSAGE_TAG) + varint_size(size) + size
+        ids.append(msg.id)
+        offsets.append(pos)
+    return data, ids, offsets
+
+
+def encode_chunk(data, ids, offsets):
+    """
+    Lay out one conversation's messages and tables as stored in the segment.
+    Returns (chunk bytes, length of the message bytes, message count).
+    """
+    return data + table_to_bytes(ids) + table_to_bytes(offsets), len(data), len(ids)
+
+
+def chunk_size(length, count):
+    return length + 4 * count + 4 * (count + 1)
+
+
+class Conversation:
+    """
+    The history of one conversation.
+
+    Messages that were in the snapshot stay as bytes in the memory-mapped
+    segment and are only referenced by position; messages added since then
+    are kept as ChatMessages in `tail`. Deleting an older message just
+    marks its position as removed. Ids only grow along a conversation, so
+    both parts are searched by bisection.
+    """
+
+    __slots__ = ("segment", "origin", "base_ids", "offsets", "removed", "tail")
+
+    def __init__(self, segment=None, origin=0, base_ids=None, offsets=None):
+        self.segment = segment
+        self.origin = origin
+        self.base_ids = base_ids if base_ids is not None else array("i")
+        self.offsets = offsets if offsets is not None else array("I", [0])
+        self.removed = set()
+        self.tail = []
+
+    def copy(self):
+        # base_ids and offsets are never modified, so they can be shared
+        conv = Conversation(self.segment, self.origin, self.base_ids, self.offsets)
+        conv.removed = set(self.removed)
+        conv.tail = list(self.tail)
+        return conv
+
+    def __len__(self):
+        return len(self.base_ids) - len(self.removed) + len(self.tail)
+
+    def ids(self):
+        removed = self.removed
+        for pos, msg_id in enumerate(self.base_ids):
+            if pos not in removed:
+                yield msg_id
+        for msg in self.tail:
+            yield msg.id
+
+    def position(self, msg_id):
+        """
+        Return ("base", position) or ("tail", position) for msg_id, or None
+        if it is not in this conversation.
+        """
+        base_ids = self.base_ids
+        pos = bisect_left(base_ids, msg_id)
+        if pos < len(base_ids) and base_ids[pos] == msg_id:
+            return None if pos in self.removed else ("base", pos)
+        pos = message_position(self.tail, msg_id)
+        if pos is not None:
+            return ("tail", pos)
+        return None
+
+    def has_any(self, msg_ids):
+        return any(self.position(msg_id) is not None for msg_id in msg_ids)
+
+    def delete(self, msg_ids):
+        """
+        Remove the messages with the given ids. Returns how many were removed.
+        """
+        removed = 0
+        for msg_id in msg_ids:
+            found = self.position(msg_id)
+            if found is None:
+                continue
+            kind, pos = found
+            if kind == "base":
+                self.removed.add(pos)
+            else:
+                del self.tail[pos]
+            removed += 1
+        return removed
+
+    def append(self, message):
+        self.tail.append(message)
+
+    def entry_digest(self, found):
+        """
+        message_digest() of the message at a position() result.
+        """
+        kind, pos = found
+        if kind == "tail":
+            return message_digest(self.tail[pos])
+        start = self.origin + self.offsets[pos]
+        return digest_of(self.segment[start:self.origin + self.offsets[pos + 1]])
+
+    def digest(self):
+        """
+        XOR of the digests of every message, so that appending or deleting
+        one only needs that message's digest.
+        """
+        digest = 0
+        for pos in range(len(self.base_ids)):
+            if pos not in self.removed:
+                digest ^= self.entry_digest(("base", pos))
+        for msg in self.tail:
+            digest ^= message_digest(msg)
+        return digest
+
+    def base_bytes(self, start=0, stop=None):
+        """
+        The wire bytes of the snapshot messages between positions start and
+        stop that have not been removed.
+        """
+        if stop is None:
+            stop = len(self.base_ids)
+        if start >= stop:
+            return b""
+        offsets, origin = self.offsets, self.origin
+        if not self.removed:
+            return self.segment[origin + offsets[start]:origin + offsets[stop]]
+        parts = []
+        run_start = None
+        for pos in range(start, stop + 1):
+            alive = pos < stop and pos not in self.removed
+            if alive and run_start is None:
+                run_start = pos
+            elif not alive and run_start is not None:
+                parts.append(self.segment[origin + offsets[run_start]:origin + offsets[pos]])
+                run_start = None
+        return b"".join(parts)
+
+    def response(self):
+        """
+        Build a ViewConversationResponse by parsing the stored bytes directly.
+        """
+        response = chat_pb2.ViewConversationResponse.FromString(self.base_bytes())
+        response.messages.extend(self.tail)
+        return response
+
+    def page(self, before_id=0, after_id=0, limit=0):
+        """
+        Build the ViewConversationResponse for one page of the history. See
+        ViewConversationRequest for how before_id, after_id and limit select it.
+        """
+        if not (before_id or after_id or limit):
+            return self.response()
+        base_ids = self.base_ids
+        tail_ids = [msg.id for msg in self.tail]
+        base = range(bisect_right(base_ids, after_id) if after_id else 0,
+                     bisect_left(base_ids, before_id) if before_id else len(base_ids))
+        tail = range(bisect_right(tail_ids, after_id) if after_id else 0,
+                     bisect_left(tail_ids, before_id) if before_id else len(tail_ids))
+
+        more = False
+        if limit:
+            # Walk from the end the page starts at, skipping removed messages,
+            # and narrow both ranges to the first `limit` found.
+            forward = bool(after_id)
+            if forward:
+                slots = [("base", base), ("tail", tail)]
+            else:
+                slots = [("tail", reversed(tail)), ("base", reversed(base))]
+            chosen = {"base": [], "tail": []}
+            found = 0
+            for kind, positions in slots:
+                for pos in positions:
+                    if kind == "base" and pos in self.removed:
+                        continue
+                    if found == limit:
+                        more = True
+                        break
+                    chosen[kind].append(pos)
+                    found += 1
+                if more:
+                    break
+            base, tail = [range(min(p), max(p) + 1) if p else range(0)
+                          for p in (chosen["base"], chosen["tail"])]
+
+        response = chat_pb2.ViewConversationResponse.FromString(self.base_bytes(base.start, base.stop))
+        response.messages.extend(self.tail[tail.start:tail.stop])
+        if more:
+            response.next_cursor = response.messages[-1].id if after_id else response.messages[0].id
+        return response
+
+    def __iter__(self):
+        return iter(list(self.response().messages))
+
+    def encode(self):
+        """
+        Encode the current history as a segment chunk for a new snapshot.
+        """
+        base = self.base_bytes()
+        if not self.removed:
+            ids = array("i", self.base_ids)
+            offsets = array("I", self.offsets)
+            pos = offsets[-1]
+        else:
+            ids = array("i")
+            offsets = array("I", [0])
+            pos = 0
+            for p, msg_id in enumerate(self.base_ids):
+                if p not in self.removed:
+                    pos += self.offsets[p + 1] - self.offsets[p]
+                    ids.append(msg_id)
+                    offsets.append(pos)
+        tail, tail_ids, tail_offsets = encode_messages(self.tail)
+        ids.extend(tail_ids)
+        offsets.extend(pos + off for off in tail_offsets[1:])
+        return encode_chunk(base + tail, ids, offsets)
+
+
+def write_snapshot(path, next_msg_id, last_index, users, conversations, digests=None, last_term=0):
+    """
+    Atomically write a snapshot of the state up to log record last_index,
+    which was written in last_term.
+
+    users is an iterable of (username, password_hash, unread messages) and
+    conversations an iterable of (key tuple, chunk) where chunk is what
+    encode_chunk() returns. digests optionally maps key tuples to their
+    Conversation.digest(), kept in the index. The file is written next to `path`, fsynced and
+    renamed over it, so a crash leaves either the old snapshot or the new
+    one, never a partial one.
+
+    Returns (conversation index, message index): {key tuple: (offset,
+    length, count)} and the id tables described in read_snapshot().
+    """
+    tmp_path = path + ".tmp"
+    index = {}
+    all_ids = array("i")
+    all_owners = array("I")
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(FIXED_HEADER.pack(0, 0))
+
+        def write_record(record):
+            data = record.SerializeToString()
+            f.write(RECORD_LENGTH.pack(len(data)))
+            f.write(data)
+
+        write_record(chat_pb2.SnapshotRecord(header=chat_pb2.SnapshotHeader(
+            next_msg_id=next_msg_id,
+            last_index=last_index,
+            last_term=last_term
+        )))
+        for username, password_hash, unread in users:
+            write_record(chat_pb2.SnapshotRecord(user=chat_pb2.UserRecord(
+                username=username,
+                password_hash=password_hash,
+                unread=unread
+            )))
+
+        segment_offset = f.tell()
+        for key_tuple, (chunk, length, count) in conversations:
+            all_owners.extend(array("I", [len(index)]) * count)
+            index[key_tuple] = (f.tell(), length, count)
+            f.write(chunk)
+            all_ids.extend(table_from_bytes("i", chunk[length:length + 4 * count]))
+
+        order = sorted(range(len(all_ids)), key=all_ids.__getitem__)
+        message_index = (
+            array("i", [all_ids[i] for i in order]),
+            array("I", [all_owners[i] for i in order]),
+            list(index)
+        )
+        index_offset = f.tell()
+        write_record(chat_pb2.SnapshotRecord(index=chat_pb2.SnapshotIndex(
+            conversations=[
+                chat_pb2.ConversationIndexEntry(
+                    key="::".join(k), offset=offset, length=length, count=count,
+                    digest=digest_bytes(digests[k]) if digests and k in digests else b"")
+                for k, (offset, length, count) in index.items()
+            ],
+            message_ids=table_to_bytes(message_index[0]),
+            message_conversations=table_to_bytes(message_index[1])
+        )))
+        f.seek(len(SNAPSHOT_MAGIC))
+        f.write(FIXED_HEADER.pack(segment_offset, index_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return index, message_index
+
+
+def read_records(data, pos, end):
+    """
+    Yield every length-prefixed SnapshotRecord in data[pos:end].
+    """
+    view = memoryview(data)
+    while pos < end:
+        (length,) = RECORD_LENGTH.unpack_from(data, pos)
+        pos += RECORD_LENGTH.size
+        yield chat_pb2.SnapshotRecord.FromString(view[pos:pos + length])
+        pos += length
+
+
+def map_snapshot(path):
+    """
+    Memory-map a snapshot file read-only. The mapping stays valid after the
+    file is replaced by a newer snapshot.
+    """
+    with open(path, "rb") as f:
+        segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if segment[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a chat snapshot")
+    return segment
+
+
+def read_snapshot(path):
+    """
+    Map a snapshot written by write_snapshot() and load its header, users
+    and indexes; conversation messages stay in the mapping.
+
+    Returns (next_msg_id, last_index, last_term, users, conversation index,
+    message index, digests, mapping). The message index is (ids, owners, keys):
+    every id in the snapshot in ascending order, and for each the position
+    in `keys` of the conversation holding it. digests maps keys to their
+    Conversation.digest(), for the conversations the index has one for.
+    """
+    segment = map_snapshot(path)
+    segment_offset, index_offset = FIXED_HEADER.unpack_from(segment, len(SNAPSHOT_MAGIC))
+
+    next_msg_id, last_index, last_term = 1, 0, 0
+    users = OrderedDict()
+    for record in read_records(segment, len(SNAPSHOT_MAGIC) + FIXED_HEADER.size, segment_offset):
+        kind = record.WhichOneof("record")
+        if kind == "user":
+            users[record.user.username] = {
+                "password_hash": record.user.password_hash,
+                "messages": list(record.user.unread)
+            }
+        elif kind == "header":
+            next_msg_id = record.header.next_msg_id
+            last_index = record.header.last_index
+            last_term = record.header.last_term
+
+    index_record = next(read_records(segment, index_offset, len(segment))).index
+    index = {
+        tuple(entry.key.split("::")): (entry.offset, entry.length, entry.count)
+        for entry in index_record.conversations
+    }
+    message_index = (
+        table_from_bytes("i", index_record.message_ids),
+        table_from_bytes("I", index_record.message_conversations),
+        list(index)
+    )
+    digests = {
+        tuple(entry.key.split("::")): int.from_bytes(entry.digest, "little")
+        for entry in index_record.conversations if entry.digest
+    }
+    return next_msg_id, last_index, last_term, users, index, message_index, digests, segment
+
+
+class ConversationStore:
+    """
+    Conversation histories keyed by a sorted (user, user) tuple.
+
+    Conversations that have not changed since the last snapshot are read
+    from its memory-mapped segment when first touched. At most cache_size
+    of them are kept in memory, least recently used evicted first.
+    Conversations changed since the snapshot have messages that are only in
+    memory (and the mutation log), so they are pinned until the next
+    snapshot has written them out.
+
+    Look conversations up like a dict; change them only through append(),
+    delete_messages() and __delitem__ so changes are tracked.
+
+    locate() maps a message id to the conversation holding it: ids in the
+    snapshot through its sorted id table, newer ids through recent_ids.
+    keys_for() gives the conversations a user takes part in.
+
+    Every conversation's digest is kept up to date in `digests` and in
+    `hash_tree` (keyed "a::b"), without paging anything in.
+    """
+
+    def __init__(self, cache_size=10000):
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.segment = None
+        self.on_disk = {}              # key -> (offset, length, count) in segment
+        self.resident = OrderedDict()  # key -> Conversation, LRU order
+        # key -> generation of its last change, for keys not yet in a snapshot
+        self.dirty = {}
+        self.generation = 0
+        self.message_index = (array("i"), array("I"), [])
+        self.recent_ids = {}           # msg id -> key, for ids newer than the snapshot
+        self.by_user = {}              # username -> set of keys they take part in
+        self.digests = {}              # key -> Conversation.digest()
+        self.hash_tree = HashTree()
+
+    def open_snapshot(self, segment, index, message_index, digests=None):
+        """
+        Start from a snapshot. Digests missing from `digests` (snapshots
+        written before they were kept) are computed from the segment.
+        """
+        with self.lock:
+            self.segment = segment
+            self.on_disk = dict(index)
+            self.message_index = message_index
+            self.resident.clear()
+            self.dirty.clear()
+            self.recent_ids.clear()
+            self.by_user.clear()
+            self.digests = {}
+            self.hash_tree = HashTree()
+            for key in self.on_disk:
+                self.add_key(key)
+                if digests and key in digests:
+                    self.set_digest(key, digests[key])
+                else:
+                    self.set_digest(key, self.read_conversation(self.on_disk[key]).digest())
+
+    def set_digest(self, key, digest):
+        if digest is None:
+            self.digests.pop(key, None)
+        else:
+            self.digests[key] = digest
+        self.hash_tree.set("::".join(key), digest)
+
+    def add_key(self, key):
+        for username in key:
+            self.by_user.setdefault(username, set()).add(key)
+
+    def remove_key(self, key):
+        for username in key:
+            keys = self.by_user.get(username)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_user[username]
+
+    def keys_for(self, username):
+        """
+        Keys of every conversation `username` takes part in.
+        """
+        with self.lock:
+            return list(self.by_user.get(username, ()))
+
+    def locate(self, msg_id):
+        """
+        Return the key of the conversation holding msg_id, or None.
+        The message itself may since have been deleted from it.
+        """
+        key = self.recent_ids.get(msg_id)
+        if key is None:
+            ids, owners, keys = self.message_index
+            pos = bisect_left(ids, msg_id)
+            if pos < len(ids) and ids[pos] == msg_id:
+                key = keys[owners[pos]]
+        if key is not None and key in self:
+            return key
+        return None
+
+    def read_conversation(self, location):
+        offset, length, count = location
+        ids_start = offset + length
+        offsets_start = ids_start + 4 * count
+        return Conversation(
+            self.segment,
+            offset,
+            table_from_bytes("i", self.segment[ids_start:offsets_start]),
+            table_from_bytes("I", self.segment[offsets_start:offsets_start + 4 * (count + 1)])
+        )
+
+    def load(self, key):
+        """
+        Return the resident Conversation for key, paging it in if needed.
+        Caller holds self.lock and has checked that key exists.
+        """
+        conv = self.resident.get(key)
+        if conv is None:
+            conv = self.read_conversation(self.on_disk[key])
+            self.resident[key] = conv
+            self.evict()
+        else:
+            self.resident.move_to_end(key)
+        return conv
+
+    def evict(self):
+        if len(self.resident) <= self.cache_size:
+            return
+        # never the most recently used entry, which the caller is about to use
+        for key in list(self.resident)[:-1]:
+            if len(self.resident) <= self.cache_size:
+                break
+            if key not in self.dirty:
+                del self.resident[key]
+
+    def mark_dirty(self, key):
+        self.generation += 1
+        self.dirty[key] = self.generation
+
+    def __contains__(self, key):
+        return key in self.resident or key in self.on_disk
+
+    def __iter__(self):
+        with self.lock:
+            keys = list(self.resident)
+            keys.extend(k for k in self.on_disk if k not in self.resident)
+        return iter(keys)
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.resident) + sum(1 for k in self.on_disk if k not in self.resident)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                return default
+            return self.load(key)
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            return self.load(key)
+
+    def items(self):
+        for key in self:
+            conv = self.get(key)
+            if conv is not None:
+                yield key, conv
+
+    def view(self, key, before_id=0, after_id=0, limit=0):
+        """
+        Return a page of the ViewConversationResponse for key (empty if
+        unknown), see Conversation.page().
+        """
+        with self.lock:
+            if key not in self:
+                return chat_pb2.ViewConversationResponse()
+            conv = self.load(key).copy()
+        return conv.page(before_id, after_id, limit)
+
+    def append(self, key, message):
+        digest = message_digest(message)
+        with self.lock:
+            if key in self:
+                self.load(key).append(message)
+            else:
+                conv = Conversation()
+                conv.append(message)
+                self.resident[key] = conv
+                self.add_key(key)
+            self.set_digest(key, self.digests.get(key, 0) ^ digest)
+            self.recent_ids[message.id] = key
+            self.mark_dirty(key)
+            self.evict()
+
+    def delete_messages(self, msg_ids, participant):
+        """
+        Remove the messages with the given ids from whichever conversations
+        of `participant` hold them. Returns how many were removed.
+        """
+        by_key = {}
+        with self.lock:
+            for msg_id in msg_ids:
+                key = self.locate(msg_id)
+                if key is not None and participant in key:
+                    by_key.setdefault(key, []).append(msg_id)
+            removed = 0
+            for key, ids in by_key.items():
+                conv = self.load(key)
+                digest = self.digests.get(key, 0)
+                for msg_id in set(ids):
+                    found = conv.position(msg_id)
+                    if found is not None:
+                        digest ^= conv.entry_digest(found)
+                count = conv.delete(ids)
+                if count:
+                    self.set_digest(key, digest)
+                    self.mark_dirty(key)
+                    removed += count
+                for msg_id in ids:
+                    self.recent_ids.pop(msg_id, None)
+            return removed
+
+    def has_any(self, msg_ids, participant):
+        """
+        Whether any of the ids is a message in one of participant's conversations.
+        """
+        with self.lock:
+            for msg_id in msg_ids:
+                key = self.locate(msg_id)
+                if key is not None and participant in key and self.load(key).has_any([msg_id]):
+                    return True
+            return False
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.resident.pop(key, None)
+            self.on_disk.pop(key, None)
+            self.dirty.pop(key, None)
+            self.remove_key(key)
+            self.set_digest(key, None)
+
+    def replace(self, key, messages):
+        """
+        Overwrite a conversation's whole history with `messages`, e.g. with
+        another replica's copy when repairing a divergence.
+        """
+        with self.lock:
+            conv = Conversation()
+            for message in messages:
+                conv.append(message)
+                self.recent_ids[message.id] = key
+            if key not in self:
+                self.add_key(key)
+            self.resident[key] = conv
+            self.resident.move_to_end(key)
+            self.set_digest(key, conv.digest())
+            self.mark_dirty(key)
+            self.evict()
+
+    def capture(self):
+        """
+        Take the point-in-time view of every conversation a snapshot needs.
+        Call with writers excluded; it only copies small structures.
+        Returns (entries, dirty) to pass to snapshot_entries() and
+        snapshot_written().
+        """
+        with self.lock:
+            entries = []
+            for key in self:
+                if key in self.dirty:
+                    entries.append((key, self.resident[key].copy()))
+                else:
+                    entries.append((key, (self.segment, self.on_disk[key])))
+            return entries, (dict(self.dirty), dict(self.recent_ids))
+
+    def snapshot_entries(self, entries):
+        """
+        Yield (key, chunk) for write_snapshot(). Conversations unchanged since
+        the last snapshot are copied over as raw bytes without being parsed.
+        """
+        for key, value in entries:
+            if isinstance(value, Conversation):
+                yield key, value.encode()
+            else:
+                segment, (offset, length, count) = value
+                yield key, (segment[offset:offset + chunk_size(length, count)], length, count)
+
+    def snapshot_written(self, segment, index, message_index, captured):
+        """
+        Switch to a newly written snapshot. Conversations changed after
+        capture() stay dirty (and keep referencing the old mapping); clean
+        ones are dropped and will be paged in from the new one.
+        """
+        captured_dirty, captured_ids = captured
+        with self.lock:
+            self.segment = segment
+            self.on_disk = {k: loc for k, loc in index.items() if k in self}
+            self.message_index = message_index
+            for msg_id, key in captured_ids.items():
+                if self.recent_ids.get(msg_id) == key:
+                    del self.recent_ids[msg_id]
+            for key, generation in captured_dirty.items():
+                if self.dirty.get(key) == generation:
+                    del self.dirty[key]
+            for key in list(self.resident):
+                if key not in self.dirty:
+                    del self.resident[key]
+
+
+class UsernameIndex:
+    """
+    Usernames kept in sorted order, so wildcard lookups with a literal
+    prefix (the common "abc*") only scan the names starting with it.
+    """
+
+    WILDCARD_CHARS = "*?["
+
+    def __init__(self, usernames=()):
+        self.names = sorted(usernames)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, username):
+        pos = bisect_left(self.names, username)
+        if pos == len(self.names) or self.names[pos] != username:
+            self.names.insert(pos, username)
+
+    def remove(self, username):
+        pos = bisect_left(self.names, username)
+        if pos < len(self.names) and self.names[pos] == username:
+            del self.names[pos]
+
+    def match(self, pattern, limit, after=""):
+        """
+        Return up to `limit` names matching the fnmatch-style pattern, in
+        order, starting after the name `after`, plus the token for the next
+        page ("" if there is none).
+        """
+        prefix_len = len(pattern)
+        for i, ch in enumerate(pattern):
+            if ch in self.WILDCARD_CHARS:
+                prefix_len = i
+                break
+        prefix = pattern[:prefix_len]
+        is_literal = prefix_len == len(pattern)
+        matches = re.compile(fnmatch.translate(pattern)).match
+
+        names = self.names
+        pos = max(bisect_left(names, prefix), bisect_right(names, after) if after else 0)
+        found = []
+        while pos < len(names) and names[pos].startswith(prefix):
+            name = names[pos]
+            pos += 1
+            if is_literal and name != pattern:
+                break
+            if matches(name):
+                if len(found) == limit:
+                    return found, found[-1]
+                found.append(name)
+        return found, ""
+
+
+def read_json_snapshot(path):
+    """
+    Load a data file in the original chat_data_N.json format.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    users = OrderedDict()
+    for username, user_data in data.get("users", {}).items():
+        users[username] = {
+            "password_hash": user_data["password_hash"],
+            "messages": [message_from_dict(m) for m in user_data["messages"]]
+        }
+    conversations = {}
+    for key_str, msg_list in data.get("conversations", {}).items():
+        conversations[tuple(key_str.split("::"))] = [message_from_dict(m) for m in msg_list]
+    return data.get("next_msg_id", 1), data.get("last_index", 0), users, conversations
+
+
+def migrate_json_snapshot(json_path, path):
+    """
+    One-shot conversion of a chat_data_N.json file into a binary snapshot.
+    The JSON file is left in place.
+    """
+    next_msg_id, last_index, users, conversations = read_json_snapshot(json_path)
+    write_snapshot(
+        path, next_msg_id, last_index,
+        [(u, d["password_hash"], d["messages"]) for u, d in users.items()],
+        ((key, encode_chunk(*encode_messages(messages))) for key, messages in conversations.items())
+    )
+
+
+if __name__ == "__main__":
+    # python storage.py chat_data_1.json [chat_data_1.db]
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python storage.py <chat_data_N.json> [output.db]")
+        sys.exit(1)
+    json_path = sys.argv[1]
+    out_path = sys.argv[2] if len(sys.argv) == 3 else os.path.splitext(json_path)[0] + ".db"
+    migrate_json_snapshot(json_path, out_path)
+    print(f"Migrated {json_path} -> {out_path}")
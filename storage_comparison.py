@@ -0,0 +1,82 @@
+import json
+import os
+import sys
+import tempfile
+import time
+
+import chat_pb2
+from storage import ConversationStore, encode_chunk, encode_messages, read_json_snapshot, read_snapshot, write_snapshot
+
+def build_dataset(num_messages, num_users=1000):
+    # Spread messages over conversations between neighbouring users.
+    usernames = [f"user{i}" for i in range(num_users)]
+    conversations = {}
+    for msg_id in range(1, num_messages + 1):
+        a = usernames[msg_id % num_users]
+        b = usernames[(msg_id * 7 + 1) % num_users]
+        key = tuple(sorted([a, b]))
+        conversations.setdefault(key, []).append(chat_pb2.ChatMessage(
+            id=msg_id,
+            sender=a,
+            content=f"Message number {msg_id}, let's measure startup time!",
+            timestamp="2025-03-26T00:32:28.770407"
+        ))
+    users = [(u, "ef72e8cef6e3cbf2be92e845b736a5859a001082f02c87362acbdce59a3f0b7e", []) for u in usernames]
+    return num_messages + 1, users, conversations
+
+def write_json(path, next_msg_id, users, conversations):
+    # Same layout the server used to write with save_data().
+    data = {
+        "next_msg_id": next_msg_id,
+        "users": {u: {"password_hash": h, "messages": []} for u, h, _ in users},
+        "conversations": {
+            "::".join(key): [
+                {"id": m.id, "sender": m.sender, "content": m.content, "timestamp": m.timestamp}
+                for m in msgs
+            ]
+            for key, msgs in conversations.items()
+        }
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+def load_everything(path):
+    # Startup plus paging in every conversation, i.e. the eager worst case.
+    _, _, _, users, index, message_index, digests, segment = read_snapshot(path)
+    store = ConversationStore(cache_size=len(index))
+    store.open_snapshot(segment, index, message_index, digests)
+    return users, {key: list(conv) for key, conv in store.items()}
+
+def measure(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    next_msg_id, users, conversations = build_dataset(num_messages)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "chat_data.json")
+        db_path = os.path.join(tmp, "chat_data.db")
+
+        json_save, _ = measure(write_json, json_path, next_msg_id, users, conversations)
+        chunks = ((key, encode_chunk(*encode_messages(msgs))) for key, msgs in conversations.items())
+        db_save, _ = measure(write_snapshot, db_path, next_msg_id, 0, users, chunks)
+        json_load, json_state = measure(read_json_snapshot, json_path)
+        db_startup, db_state = measure(read_snapshot, db_path)
+        db_load, (_, db_conversations) = measure(load_everything, db_path)
+        _, _, _, _, db_index, _, _, _ = db_state
+        _, _, _, json_conversations = json_state
+        assert len(db_index) == len(conversations)
+        assert sum(len(v) for v in db_conversations.values()) == num_messages
+        assert sum(len(v) for v in json_conversations.values()) == num_messages
+
+        print(f"Startup load with {num_messages} messages:")
+        print(f"JSON   : {os.path.getsize(json_path)} bytes, save {json_save:.3f}s, load {json_load:.3f}s")
+        print(f"Binary : {os.path.getsize(db_path)} bytes, save {db_save:.3f}s, load {db_load:.3f}s")
+        print(f"Binary, users and index only (lazy startup): {db_startup:.3f}s")
+        print(f"Load speedup: {json_load / db_load:.1f}x, lazy startup speedup: {json_load / db_startup:.1f}x")
+
+if __name__ == "__main__":
+    main()
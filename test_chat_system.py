@@ -1,14 +1,26 @@
 import unittest
+import asyncio
 import grpc
 import threading
 import time
 import os
 import sys
+import json
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
 from concurrent import futures
 
 # Import the client and server code
 import client as chat_client
+import compression
 import server as chat_server
+import replication
+import router
+import sharding
+import storage
 
 # Import the generated protocol buffer code
 try:
@@ -22,6 +34,49 @@ except ImportError:
         print("Error: Protocol buffer modules not found. Make sure to generate them first.")
         sys.exit(1)
 
+
+def mutation_from_record(record):
+    """
+    Return the (op_type, data) log record for a MutationRecord.
+    """
+    kind = record.WhichOneof("mutation")
+    if kind == "create_account":
+        m = record.create_account
+        return "CREATE_ACCOUNT", {"username": m.username, "password_hash": m.password_hash}
+    elif kind == "send_message":
+        m = record.send_message
+        msg = m.message
+        data = {
+            "sender": m.sender,
+            "recipient": m.recipient,
+            "message_entry": {"id": msg.id, "sender": msg.sender, "content": msg.content, "timestamp": msg.timestamp}
+        }
+        if m.remote_recipient:
+            data["remote_recipient"] = True
+        if m.delivered:
+            data["delivered"] = True
+        return "SEND_MESSAGE", data
+    elif kind == "delete_account":
+        return "DELETE_ACCOUNT", {"username": record.delete_account.username}
+    elif kind == "mark_read":
+        m = record.mark_read
+        return "MARK_READ", {"username": m.username, "message_ids": list(m.message_ids)}
+    elif kind == "delete_messages":
+        m = record.delete_messages
+        return "DELETE_MESSAGES", {"username": m.username, "message_ids": list(m.message_ids)}
+    elif kind == "deliver_message":
+        m = record.deliver_message
+        msg = m.message
+        data = {
+            "recipient": m.recipient,
+            "message_entry": {"id": msg.id, "sender": msg.sender, "content": msg.content, "timestamp": msg.timestamp}
+        }
+        if m.delivered:
+            data["delivered"] = True
+        return "DELIVER_MESSAGE", data
+    raise ValueError(f"Unknown mutation {kind}")
+
+
 class TestChatSystem(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -327,6 +382,7 @@ class TestChatSystem(unittest.TestCase):
             limit=0
         ))
         self.assertEqual(len(read_response.messages), num_messages)
+        self.assertEqual(len({m.id for m in read_response.messages}), num_messages)
     
     def test_view_conversation_order(self):
         # Send messages with delays to enforce ordering and verify conversation order.
@@ -529,5 +585,1398 @@ class TestChatClient(unittest.TestCase):
         client_instance.close()
         self.assertIsNone(client_instance.username)
 
+    def test_messages_after_log_off_stay_unread(self):
+        # A logged-off client must not subscribe again and take the
+        # messages meant for the unread list.
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir, ignore_errors=True)
+        service = chat_server.ChatServiceServicer(1, [], config={"data_dir": data_dir, "log_sync": "os"})
+        self.addCleanup(service.close)
+        server = chat_server.threaded_server(service)
+        port = server.add_insecure_port("localhost:0")
+        server.start()
+        self.addCleanup(server.stop, 0)
+
+        sender = chat_client.ChatClient(server_port=port)
+        receiver = chat_client.ChatClient(server_port=port)
+        import io
+        from contextlib import redirect_stdout
+        with redirect_stdout(io.StringIO()) as output:
+            sender.create_account("sender", "password")
+            receiver.create_account("receiver", "password")
+            receiver.login("receiver", "password")
+            for _ in range(50):
+                if "receiver" in service.active_subscriptions:
+                    break
+                time.sleep(0.05)
+            receiver.log_off()
+            receiver.message_thread.join(timeout=2)
+            self.assertFalse(receiver.message_thread.is_alive())
+            self.assertNotIn("receiver", service.active_subscriptions)
+
+            sender.username = "sender"
+            sender.send_message("receiver", "while away")
+            time.sleep(0.2)
+        self.assertNotIn("while away", output.getvalue())
+        self.assertEqual([m.content for m in service.users["receiver"]["messages"]], ["while away"])
+        sender.close()
+        receiver.close()
+
+class TestPersistence(unittest.TestCase):
+    """
+    Tests for the on-disk state of a single server, driven directly through
+    the servicer without a gRPC server in front of it.
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.config = {"data_dir": self.data_dir}
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def make_server(self):
+        return chat_server.ChatServiceServicer(1, [], config=self.config)
+
+    def populate(self, service):
+        for username in ("alice", "bob", "carol"):
+            service.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        for i in range(5):
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"hi {i}"), None)
+        service.SendMessage(chat_pb2.SendMessageRequest(sender="carol", recipient="alice", content="yo"), None)
+        service.ReadMessages(chat_pb2.ReadMessagesRequest(username="bob", limit=2), None)
+        service.DeleteMessages(chat_pb2.DeleteMessagesRequest(username="bob", message_ids=[3]), None)
+        service.DeleteAccount(chat_pb2.DeleteAccountRequest(username="carol"), None)
+
+    def snapshot_state(self, service):
+        users = {u: (d["password_hash"], [m.id for m in d["messages"]]) for u, d in service.users.items()}
+        convs = {k: [(m.id, m.content) for m in v] for k, v in service.conversations.items()}
+        return users, convs, service.next_msg_id
+
+    def test_restart_replays_mutation_log(self):
+        service = self.make_server()
+        self.populate(service)
+        expected = self.snapshot_state(service)
+        service.mutation_log.close()
+
+        restarted = self.make_server()
+        self.assertEqual(self.snapshot_state(restarted), expected)
+        self.assertEqual([m.id for m in restarted.users["bob"]["messages"]], [4, 5])
+        self.assertNotIn(("alice", "carol"), restarted.conversations)
+
+    def test_send_message_appends_one_record(self):
+        service = self.make_server()
+        self.populate(service)
+        log_path = service.mutation_log.path
+        sizes = []
+        for i in range(3):
+            before = os.path.getsize(log_path)
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="same size"), None)
+            sizes.append(os.path.getsize(log_path) - before)
+        self.assertEqual(len(set(sizes)), 1)
+
+    def test_torn_log_tail_is_ignored(self):
+        service = self.make_server()
+        self.populate(service)
+        expected = self.snapshot_state(service)
+        service.mutation_log.close()
+        with open(service.mutation_log.path, "ab") as f:
+            f.write(b'{"index": 99, "op": "SEND_MES')
+
+        restarted = self.make_server()
+        self.assertEqual(self.snapshot_state(restarted), expected)
+        restarted.SendMessage(chat_pb2.SendMessageRequest(sender="bob", recipient="alice", content="after"), None)
+        restarted.mutation_log.close()
+        self.assertEqual(list(self.make_server().conversations[("alice", "bob")])[-1].content, "after")
+
+    def test_snapshot_truncates_covered_log(self):
+        service = self.make_server()
+        self.populate(service)
+        service.take_snapshot()
+        self.assertEqual(service.mutation_log.segments(), [])
+        self.assertEqual(os.path.getsize(service.mutation_log.path), 0)
+
+        # a short tail after the snapshot is replayed on top of it
+        service.SendMessage(chat_pb2.SendMessageRequest(sender="bob", recipient="alice", content="tail"), None)
+        expected = self.snapshot_state(service)
+        service.mutation_log.close()
+        self.assertEqual(self.snapshot_state(self.make_server()), expected)
+
+    def test_log_read_follows_rotation_after_listing(self):
+        service = self.make_server()
+        self.populate(service)
+        log = service.mutation_log
+        expected = list(log.read(0))
+        segments = log.segments
+        def rotate_after_listing():
+            found = segments()
+            if not found:
+                log.rotate()
+            return found
+        log.segments = rotate_after_listing
+        self.assertEqual(list(log.read(0)), expected)
+        log.segments = segments
+        # records that really are gone are still reported
+        log.truncate_through(log.last_index)
+        with self.assertRaises(LookupError):
+            list(log.read(0))
+        log.close()
+
+    def test_legacy_json_data_is_migrated(self):
+        sample = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_data_1.json")
+        shutil.copy(sample, os.path.join(self.data_dir, "chat_data_1.json"))
+        service = self.make_server()
+        self.assertTrue(os.path.exists(service.data_file))
+        self.assertEqual(list(service.users), ["max", "ivy", "maggie"])
+        self.assertEqual(list(service.conversations[("ivy", "max")])[0].content, "testing11")
+        self.assertEqual(service.next_msg_id, 2)
+
+        # once migrated, the binary snapshot is what gets loaded
+        service.SendMessage(chat_pb2.SendMessageRequest(sender="max", recipient="ivy", content="binary"), None)
+        service.take_snapshot()
+        expected = self.snapshot_state(service)
+        service.mutation_log.close()
+        self.assertEqual(self.snapshot_state(self.make_server()), expected)
+
+    def test_conversations_paged_in_on_demand(self):
+        self.config["conversation_cache_size"] = 2
+        service = self.make_server()
+        for username in ("u0", "u1", "u2", "u3", "u4"):
+            service.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        for i in range(1, 5):
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="u0", recipient=f"u{i}", content=f"to u{i}"), None)
+        # nothing is on disk yet, so every conversation is pinned in memory
+        self.assertEqual(len(service.conversations.resident), 4)
+        service.take_snapshot()
+        self.assertLessEqual(len(service.conversations.resident), 2)
+        service.mutation_log.close()
+
+        restarted = self.make_server()
+        store = restarted.conversations
+        self.assertEqual(len(store.resident), 0)
+        self.assertEqual(len(store), 4)
+        response = restarted.ViewConversation(chat_pb2.ViewConversationRequest(username="u0", other_user="u3"), None)
+        self.assertEqual([m.content for m in response.messages], ["to u3"])
+        self.assertEqual(list(store.resident), [("u0", "u3")])
+
+        for i in range(1, 5):
+            restarted.ViewConversation(chat_pb2.ViewConversationRequest(username="u0", other_user=f"u{i}"), None)
+        self.assertEqual(len(store.resident), 2)
+
+        # changed conversations stay resident past the cache size until the next snapshot
+        for i in range(1, 5):
+            restarted.SendMessage(chat_pb2.SendMessageRequest(sender=f"u{i}", recipient="u0", content="back"), None)
+        self.assertEqual(len(store.resident), 4)
+        restarted.take_snapshot()
+        # now everything is clean and is read back from the new snapshot
+        self.assertEqual(len(store.resident), 0)
+        self.assertEqual([m.content for m in store[("u0", "u1")]], ["to u1", "back"])
+
+    def test_view_conversation_served_from_snapshot_segment(self):
+        service = self.make_server()
+        self.populate(service)
+        service.take_snapshot()
+        for content in ("gone", "new"):
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="bob", recipient="alice", content=content), None)
+
+        conv = service.conversations[("alice", "bob")]
+        # snapshot messages stay as bytes in the mapping; only new ones are objects
+        self.assertEqual(len(conv.base_ids), 4)
+        self.assertEqual([m.content for m in conv.tail], ["gone", "new"])
+
+        service.DeleteMessages(chat_pb2.DeleteMessagesRequest(username="alice", message_ids=[2, 7]), None)
+        response = service.ViewConversation(chat_pb2.ViewConversationRequest(username="alice", other_user="bob"), None)
+        self.assertEqual([m.id for m in response.messages], [1, 4, 5, 8])
+        self.assertEqual(response.messages[-1].content, "new")
+
+        # deletions of snapshot messages survive both a restart and the next snapshot
+        expected = self.snapshot_state(service)
+        service.mutation_log.close()
+        restarted = self.make_server()
+        self.assertEqual(self.snapshot_state(restarted), expected)
+        restarted.take_snapshot()
+        restarted.mutation_log.close()
+        self.assertEqual(self.snapshot_state(self.make_server()), expected)
+
+    def test_view_conversation_pages_by_cursor(self):
+        service = self.make_server()
+        self.populate(service)
+        service.take_snapshot()
+        for i in range(3):
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"later {i}"), None)
+        service.DeleteMessages(chat_pb2.DeleteMessagesRequest(username="bob", message_ids=[4]), None)
+
+        def pages(**kwargs):
+            result = []
+            while True:
+                response = service.ViewConversation(chat_pb2.ViewConversationRequest(
+                    username="bob", other_user="alice", limit=2, **kwargs), None)
+                result.append(([m.id for m in response.messages], response.next_cursor))
+                if not response.next_cursor:
+                    return result
+                kwargs = {"after_id": response.next_cursor} if "after_id" in kwargs else {"before_id": response.next_cursor}
+
+        self.assertEqual(pages(), [([8, 9], 8), ([5, 7], 5), ([1, 2], 0)])
+        self.assertEqual(pages(after_id=1), [([2, 5], 5), ([7, 8], 8), ([9], 0)])
+        full = service.ViewConversation(chat_pb2.ViewConversationRequest(username="bob", other_user="alice"), None)
+        self.assertEqual([m.id for m in full.messages], [1, 2, 5, 7, 8, 9])
+        self.assertEqual(full.next_cursor, 0)
+
+    def test_view_conversation_page_marks_only_its_messages_read(self):
+        service = self.make_server()
+        self.populate(service)
+        for i in range(3):
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"later {i}"), None)
+        service.ViewConversation(chat_pb2.ViewConversationRequest(username="bob", other_user="alice", limit=2), None)
+        self.assertEqual([m.id for m in service.users["bob"]["messages"]], [4, 5, 7])
+
+    def test_delete_messages_uses_message_index(self):
+        service = self.make_server()
+        usernames = [f"u{i}" for i in range(20)]
+        for username in usernames:
+            service.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        for username in usernames[1:]:
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="u0", recipient=username, content="hi"), None)
+        service.SendMessage(chat_pb2.SendMessageRequest(sender="u7", recipient="u0", content="reply"), None)
+        service.take_snapshot()
+        store = service.conversations
+        self.assertEqual(store.locate(7), ("u0", "u7"))
+        self.assertEqual(store.locate(20), ("u0", "u7"))
+        self.assertIsNone(store.locate(999))
+        service.SendMessage(chat_pb2.SendMessageRequest(sender="u3", recipient="u0", content="recent"), None)
+        self.assertEqual(store.locate(21), ("u0", "u3"))
+
+        # only the conversation holding the message is paged in
+        self.assertEqual(list(store.resident), [("u0", "u3")])
+        response = service.DeleteMessages(chat_pb2.DeleteMessagesRequest(username="u0", message_ids=[7]), None)
+        self.assertTrue(response.success)
+        self.assertEqual(list(store.resident), [("u0", "u3"), ("u0", "u7")])
+        self.assertEqual([m.id for m in store[("u0", "u7")]], [20])
+
+        # a user cannot delete messages from conversations they are not part of
+        response = service.DeleteMessages(chat_pb2.DeleteMessagesRequest(username="u1", message_ids=[20]), None)
+        self.assertFalse(response.success)
+        self.assertEqual([m.id for m in store[("u0", "u7")]], [20])
+
+    def test_per_user_conversation_index(self):
+        service = self.make_server()
+        self.populate(service)
+        service.SendMessage(chat_pb2.SendMessageRequest(sender="bob", recipient="bob", content="note to self"), None)
+        store = service.conversations
+        self.assertEqual(sorted(store.keys_for("bob")), [("alice", "bob"), ("bob", "bob")])
+        self.assertEqual(store.keys_for("carol"), [])
+
+        service.take_snapshot()
+        service.mutation_log.close()
+        restarted = self.make_server()
+        store = restarted.conversations
+        self.assertEqual(sorted(store.keys_for("bob")), [("alice", "bob"), ("bob", "bob")])
+        self.assertEqual(store.keys_for("alice"), [("alice", "bob")])
+
+        restarted.DeleteAccount(chat_pb2.DeleteAccountRequest(username="bob"), None)
+        self.assertEqual(store.keys_for("bob"), [])
+        self.assertEqual(store.keys_for("alice"), [])
+        self.assertEqual(len(store), 0)
+
+    def test_list_accounts_pages_through_index(self):
+        self.config["max_list_page_size"] = 3
+        service = self.make_server()
+        for username in ("bob", "ann", "abe", "amy", "al", "zed", "carl"):
+            service.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        service.DeleteAccount(chat_pb2.DeleteAccountRequest(username="carl"), None)
+        service.mutation_log.close()
+        service = self.make_server()
+
+        def list_all(wildcard, page_size=0):
+            pages, token = [], ""
+            while True:
+                response = service.ListAccounts(chat_pb2.ListAccountsRequest(
+                    wildcard=wildcard, page_size=page_size, page_token=token), None)
+                pages.append(list(response.usernames))
+                token = response.next_page_token
+                if not token:
+                    return pages
+
+        self.assertEqual(list_all("*"), [["abe", "al", "amy"], ["ann", "bob", "zed"]])
+        self.assertEqual(list_all("a*", page_size=2), [["abe", "al"], ["amy", "ann"]])
+        self.assertEqual(list_all("a?e"), [["abe"]])
+        self.assertEqual(list_all("*e*"), [["abe", "zed"]])
+        self.assertEqual(list_all("bob"), [["bob"]])
+        self.assertEqual(list_all("c*"), [[]])
+
+    def test_hash_trees_follow_every_change(self):
+        service = self.make_server()
+        self.populate(service)
+        service.take_snapshot()
+        service.SendMessage(chat_pb2.SendMessageRequest(sender="bob", recipient="alice", content="tail"), None)
+        service.DeleteMessages(chat_pb2.DeleteMessagesRequest(username="bob", message_ids=[1]), None)
+        roots = (service.user_hashes.digest(), service.conversations.hash_tree.digest())
+
+        # the incrementally kept trees agree with ones built from scratch
+        users, conversations = storage.HashTree(), storage.HashTree()
+        for username, user in service.users.items():
+            users.set(username, storage.user_digest(user["password_hash"], user["messages"]))
+        for key, conv in service.conversations.items():
+            conversations.set("::".join(key), conv.digest())
+        self.assertEqual((users.digest(), conversations.digest()), roots)
+        self.assertEqual(len(conversations), len(service.conversations.hash_tree))
+
+        # and are rebuilt the same from the snapshot digests and the log
+        service.mutation_log.close()
+        restarted = self.make_server()
+        self.assertEqual((restarted.user_hashes.digest(), restarted.conversations.hash_tree.digest()), roots)
+
+    def test_background_snapshot_cadence(self):
+        self.config["snapshot_every_ops"] = 5
+        service = self.make_server()
+        self.populate(service)
+        deadline = time.time() + 5
+        while not os.path.exists(service.data_file) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(os.path.exists(service.data_file))
+        # hold off further background snapshots while restarting
+        with service.snapshot_lock:
+            expected = self.snapshot_state(service)
+            service.mutation_log.close()
+            self.assertEqual(self.snapshot_state(self.make_server()), expected)
+
+class TestGroupCommit(unittest.TestCase):
+    """
+    Tests for batching mutation log writes under each sync policy.
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.fsync_calls = 0
+        self.real_fsync = os.fsync
+        def counting_fsync(fd):
+            self.fsync_calls += 1
+            self.real_fsync(fd)
+        os.fsync = counting_fsync
+
+    def tearDown(self):
+        os.fsync = self.real_fsync
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def send_concurrently(self, service, count):
+        threads = [
+            threading.Thread(target=service.SendMessage, args=(
+                chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"m{i}"), None))
+            for i in range(count)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def run_policy(self, policy):
+        config = {"data_dir": self.data_dir, "log_sync": policy, "log_sync_interval_ms": 20}
+        service = chat_server.ChatServiceServicer(1, [], config=config)
+        for username in ("alice", "bob"):
+            service.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        self.fsync_calls = 0
+        self.send_concurrently(service, 20)
+        fsyncs = self.fsync_calls
+        # every acknowledged write has reached the file
+        with open(service.mutation_log.path) as f:
+            self.assertEqual(len(f.readlines()), 22)
+        service.mutation_log.close()
+        restarted = chat_server.ChatServiceServicer(1, [], config=config)
+        self.assertEqual(len(restarted.conversations[("alice", "bob")]), 20)
+        restarted.mutation_log.close()
+        return fsyncs
+
+    def test_always_policy_is_durable(self):
+        self.assertGreaterEqual(self.run_policy("always"), 1)
+
+    def test_interval_policy_coalesces_fsyncs(self):
+        self.assertLess(self.run_policy("interval"), 20)
+
+    def test_os_policy_skips_fsync(self):
+        self.assertEqual(self.run_policy("os"), 0)
+
+    def test_unknown_policy_rejected(self):
+        with self.assertRaises(ValueError):
+            chat_server.ChatServiceServicer(1, [], config={"data_dir": self.data_dir, "log_sync": "sometimes"})
+
+    def test_failed_fsync_fails_the_write_and_is_retried(self):
+        config = {"data_dir": self.data_dir}
+        service = chat_server.ChatServiceServicer(1, [], config=config)
+        for username in ("alice", "bob"):
+            service.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        def full_disk(fd):
+            raise OSError(28, "No space left on device")
+        os.fsync = full_disk
+        with self.assertRaises(IOError):
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="lost?"), None)
+        with self.assertRaises(IOError):
+            service.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="again"), None)
+
+        # once the disk recovers both records are written, once each, and
+        # later writes wait for the disk again
+        os.fsync = self.real_fsync
+        response = service.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="ok"), None)
+        self.assertTrue(response.success)
+        self.assertEqual(service.mutation_log.synced_index, response.log_index)
+        service.mutation_log.close()
+        restarted = chat_server.ChatServiceServicer(1, [], config=config)
+        self.assertEqual([m.content for m in restarted.conversations[("alice", "bob")]], ["lost?", "again", "ok"])
+        restarted.mutation_log.close()
+
+class TestReplication(unittest.TestCase):
+    """
+    Tests for a leader servicer replicating to follower gRPC servers running
+    in this process.
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.servers = []
+        self.services = []
+        self.port = self.free_port()
+
+    def free_port(self):
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            return s.getsockname()[1]
+
+    def tearDown(self):
+        for service in self.services:
+            service.close()
+        for server in self.servers:
+            server.stop(0)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def start_follower(self, name="follower", port=None, delay=0, batch_sizes=None, leader_port=1):
+        config = {"data_dir": os.path.join(self.data_dir, name), "replica_retry_interval_ms": 100,
+                  "read_wait_ms": 200}
+        os.makedirs(config["data_dir"], exist_ok=True)
+        follower = chat_server.ChatServiceServicer(
+            2, [{"server_id": 1, "host": "localhost", "port": leader_port}], config=config)
+        self.services.append(follower)
+        if delay:
+            apply_record = follower.apply_record
+            def slow_apply(record):
+                time.sleep(delay)
+                apply_record(record)
+            follower.apply_record = slow_apply
+        if batch_sizes is not None:
+            stream = follower.StreamMutations
+            def counting_stream(request_iterator, context):
+                def counted():
+                    for batch in request_iterator:
+                        batch_sizes.append(len(batch.records))
+                        yield batch
+                return stream(counted(), context)
+            follower.StreamMutations = counting_stream
+        return follower, self.serve(follower, port or self.port)
+
+    def serve(self, servicer, port):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=[servicer.compressor])
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+        server.add_insecure_port(f"localhost:{port}")
+        server.start()
+        self.servers.append(server)
+        return server
+
+    def state(self, service):
+        users = {u: (d["password_hash"], [m.id for m in d["messages"]]) for u, d in service.users.items()}
+        convs = {k: [(m.id, m.content) for m in v] for k, v in service.conversations.items()}
+        return users, convs, service.next_msg_id
+
+    def serve_aio(self, servicer, port, workers=2):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        async def start():
+            server = grpc.aio.server(futures.ThreadPoolExecutor(max_workers=workers),
+                                     interceptors=[servicer.compressor.aio()])
+            chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+            server.add_insecure_port(f"localhost:{port}")
+            await server.start()
+            return server
+        server = asyncio.run_coroutine_threadsafe(start(), loop).result()
+        def stop():
+            asyncio.run_coroutine_threadsafe(server.stop(0), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+        self.addCleanup(stop)
+        return server
+
+    def make_leader(self, ports=None, servicer_class=chat_server.ChatServiceServicer, **config):
+        config["data_dir"] = os.path.join(self.data_dir, "leader")
+        config.setdefault("replica_retry_interval_ms", 100)
+        os.makedirs(config["data_dir"], exist_ok=True)
+        replicas = [{"server_id": i + 2, "host": "localhost", "port": port}
+                    for i, port in enumerate(ports or [self.port])]
+        leader = servicer_class(1, replicas, config=config)
+        self.services.append(leader)
+        return leader
+
+    def timed_create(self, leader, username):
+        start = time.time()
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        return time.time() - start
+
+    def wait_until(self, condition, timeout=3):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(condition())
+
+    def test_majority_ack_does_not_wait_for_slow_follower(self):
+        slow_port = self.free_port()
+        fast, _ = self.start_follower("fast")
+        slow, _ = self.start_follower("slow", port=slow_port, delay=1.0)
+        leader = self.make_leader([self.port, slow_port], replication_ack="majority", replication_timeout_ms=3000)
+        self.assertLess(self.timed_create(leader, "alice"), 0.8)
+        self.assertIn("alice", fast.users)
+        self.wait_until(lambda: "alice" in slow.users)
+
+    def test_all_ack_bounded_by_replication_timeout(self):
+        follower, _ = self.start_follower(delay=1.0)
+        leader = self.make_leader(replication_ack="all", replication_timeout_ms=200)
+        self.assertLess(self.timed_create(leader, "alice"), 0.8)
+        self.wait_until(lambda: "alice" in follower.users)
+
+    def test_fire_and_forget_returns_immediately(self):
+        follower, _ = self.start_follower(delay=0.5)
+        leader = self.make_leader(replication_ack="none")
+        self.assertLess(self.timed_create(leader, "alice"), 0.4)
+        self.assertNotIn("alice", follower.users)
+        self.wait_until(lambda: "alice" in follower.users)
+
+    def test_unknown_ack_policy_rejected(self):
+        with self.assertRaises(ValueError):
+            self.make_leader(replication_ack="some")
+
+    def test_replication_reuses_one_channel(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader()
+        replica = leader.replica_pool.channels[f"localhost:{self.port}"]
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        channel = replica.channel
+        self.assertIsNotNone(channel)
+        for i in range(5):
+            leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="alice", content=f"m{i}"), None)
+        self.assertIs(replica.channel, channel)
+        self.assertTrue(replica.healthy)
+        self.assertEqual(len(follower.conversations[("alice", "alice")]), 5)
+
+    def test_replica_reconnects_after_failure(self):
+        leader = self.make_leader()
+        replica = leader.replica_pool.channels[f"localhost:{self.port}"]
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        self.wait_until(lambda: not replica.healthy)
+        self.assertGreaterEqual(replica.consecutive_failures, 1)
+
+        follower, _ = self.start_follower()
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="bob", password="pw"), None)
+        self.wait_until(lambda: replica.healthy)
+        self.assertEqual(replica.consecutive_failures, 0)
+        # records queued while the follower was down are resent in order
+        self.assertEqual(list(follower.users), ["alice", "bob"])
+
+    def test_stream_batches_records_in_order(self):
+        batch_sizes = []
+        follower, _ = self.start_follower(batch_sizes=batch_sizes)
+        leader = self.make_leader(replication_ack="none", log_sync="os")
+        for username in ("alice", "bob"):
+            leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        for i in range(300):
+            leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"m{i}"), None)
+        last_index = leader.mutation_log.last_index
+        self.wait_until(lambda: follower.mutation_log.last_index == last_index)
+        self.assertEqual(sum(batch_sizes), last_index)
+        self.assertLess(len(batch_sizes), last_index)
+        self.assertEqual([m.content for m in follower.conversations[("alice", "bob")]],
+                         [f"m{i}" for i in range(300)])
+
+    def test_restarted_leader_continues_from_log_index(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader()
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        leader.close()
+        leader.mutation_log.close()
+
+        # the restarted server has a term on disk, so it wins an election
+        # before taking writes again
+        leader = self.make_leader()
+        self.wait_until(lambda: leader.is_leader)
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="bob", password="pw"), None)
+        self.assertEqual(list(follower.users), ["alice", "bob"])
+        self.assertEqual(follower.mutation_log.last_index, leader.mutation_log.last_index)
+
+    def test_mutation_records_round_trip(self):
+        mutations = [
+            ("CREATE_ACCOUNT", {"username": "alice", "password_hash": "x"}),
+            ("SEND_MESSAGE", {"sender": "alice", "recipient": "bob", "message_entry": {
+                "id": 7, "sender": "alice", "content": "hi", "timestamp": "2025-03-26T00:32:28"}}),
+            ("DELETE_ACCOUNT", {"username": "alice"}),
+            ("MARK_READ", {"username": "bob", "message_ids": [1, 7]}),
+            ("DELETE_MESSAGES", {"username": "bob", "message_ids": [7]}),
+        ]
+        for index, (op_type, data) in enumerate(mutations, 1):
+            wire = replication.mutation_record(index, op_type, data).SerializeToString()
+            record = chat_pb2.MutationRecord.FromString(wire)
+            self.assertEqual(record.index, index)
+            self.assertEqual(mutation_from_record(record), (op_type, data))
+        # messages that went to a live subscriber stay out of the unread list
+        data = dict(mutations[1][1], delivered=True)
+        record = replication.mutation_record(1, "SEND_MESSAGE", data)
+        self.assertTrue(mutation_from_record(record)[1]["delivered"])
+
+    def test_follower_catches_up_from_log_tail(self):
+        leader_port = self.free_port()
+        leader = self.make_leader(replication_ack="none")
+        self.serve(leader, leader_port)
+        for username in ("alice", "bob"):
+            leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        for i in range(3):
+            leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"m{i}"), None)
+
+        follower, _ = self.start_follower(leader_port=leader_port)
+        self.wait_until(lambda: follower.mutation_log.last_index == leader.mutation_log.last_index)
+        self.assertEqual(self.state(follower), self.state(leader))
+        # and the replication stream carries on from there
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="bob", recipient="alice", content="back"), None)
+        self.wait_until(lambda: follower.mutation_log.last_index == leader.mutation_log.last_index)
+        self.assertEqual(self.state(follower), self.state(leader))
+
+    def test_follower_installs_snapshot_when_log_truncated(self):
+        leader_port = self.free_port()
+        leader = self.make_leader(replication_ack="none", snapshot_chunk_size=64)
+        self.serve(leader, leader_port)
+        follower, server = self.start_follower(leader_port=leader_port)
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        self.wait_until(lambda: "alice" in follower.users)
+        server.stop(0)
+        follower.mutation_log.close()
+
+        # while the follower is down the leader's log is compacted away
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="bob", password="pw"), None)
+        for i in range(20):
+            leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"m{i}"), None)
+        leader.take_snapshot()
+        leader.DeleteMessages(chat_pb2.DeleteMessagesRequest(username="bob", message_ids=[2]), None)
+        self.assertGreater(os.path.getsize(leader.data_file), 64)
+
+        follower, _ = self.start_follower(leader_port=leader_port)
+        self.wait_until(lambda: follower.mutation_log.last_index == leader.mutation_log.last_index)
+        self.assertEqual(self.state(follower), self.state(leader))
+        # the installed snapshot and the fetched tail survive a restart
+        follower.mutation_log.close()
+        restarted = chat_server.ChatServiceServicer(2, [], config={"data_dir": os.path.join(self.data_dir, "follower")})
+        self.assertEqual(self.state(restarted), self.state(leader))
+        restarted.mutation_log.close()
+
+    def lone_server(self, server_id, name, usernames):
+        config = {"data_dir": os.path.join(self.data_dir, name)}
+        os.makedirs(config["data_dir"], exist_ok=True)
+        service = chat_server.ChatServiceServicer(server_id, [], config=config)
+        for username in usernames:
+            service.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        service.close()
+        service.mutation_log.close()
+
+    def test_follower_drops_record_from_another_term_at_leaders_start_index(self):
+        # both logs end at index 2, but with records from different terms
+        self.lone_server(2, "follower", ["alice", "x"])
+        self.lone_server(1, "leader", ["alice"])
+        self.lone_server(1, "leader", ["y"])
+
+        leader_port = self.free_port()
+        follower, _ = self.start_follower(leader_port=leader_port)
+        leader = self.make_leader()
+        self.serve(leader, leader_port)
+        self.wait_until(lambda: leader.is_leader and "y" in follower.users, timeout=5)
+        self.assertEqual(leader.term_start_index, 2)
+        self.assertEqual(self.state(follower), self.state(leader))
+        self.assertNotIn("x", follower.users)
+
+    def test_lagging_follower_does_not_win_votes_by_hearing_a_new_leader(self):
+        self.lone_server(2, "lagging", ["alice"])
+        self.lone_server(3, "ahead", ["alice", "bob", "carol"])
+        nobody = [{"server_id": 1, "host": "localhost", "port": self.free_port()}]
+        def follower(server_id, name):
+            service = chat_server.ChatServiceServicer(server_id, nobody, config={
+                "data_dir": os.path.join(self.data_dir, name), "election_timeout_ms": 60000})
+            self.services.append(service)
+            return service
+        lagging, ahead = follower(2, "lagging"), follower(3, "ahead")
+        # the lagging follower hears from a leader in term 2 before it has caught up
+        lagging.observe_leader(2, 1, 3, 1)
+        requests = []
+        lagging.replica_pool.call_all = lambda method, request, *args: requests.append(request) or []
+        lagging.start_election()
+        self.assertEqual((requests[0].last_index, requests[0].last_term), (1, 1))
+        self.assertFalse(ahead.RequestVote(requests[0], None).vote_granted)
+
+    def test_fetch_log_refuses_follower_with_other_record_at_its_index(self):
+        leader_port = self.free_port()
+        leader = self.make_leader(replication_ack="none")
+        self.serve(leader, leader_port)
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        channel = grpc.insecure_channel(f"localhost:{leader_port}")
+        self.addCleanup(channel.close)
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        with self.assertRaises(grpc.RpcError) as raised:
+            list(stub.FetchLog(chat_pb2.FetchLogRequest(after_index=1, after_term=leader.term + 1)))
+        self.assertEqual(raised.exception.code(), grpc.StatusCode.FAILED_PRECONDITION)
+        self.assertEqual(list(stub.FetchLog(chat_pb2.FetchLogRequest(after_index=1, after_term=leader.term))), [])
+
+    def test_follower_logs_records_as_received(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader()
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="bob", password="pw"), None)
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"), None)
+        leader.ReadMessages(chat_pb2.ReadMessagesRequest(username="bob", limit=0), None)
+        self.wait_until(lambda: follower.mutation_log.last_index == leader.mutation_log.last_index)
+        with open(follower.mutation_log.path) as f:
+            self.assertTrue(all('"record":' in line for line in f))
+
+        # they replay on restart and go out again unchanged
+        sent = [record.SerializeToString() for batch in self.follower_stub().FetchLog(
+            chat_pb2.FetchLogRequest(after_index=0)) for record in batch.records]
+        self.assertEqual(sent, [replication.mutation_record(index, op_type, data, leader.term).SerializeToString()
+                                for index, op_type, data in leader.mutation_log.read(0)])
+        follower.mutation_log.close()
+        restarted = chat_server.ChatServiceServicer(2, [], config={"data_dir": os.path.join(self.data_dir, "follower")})
+        self.assertEqual(self.state(restarted), self.state(leader))
+        restarted.mutation_log.close()
+
+    def test_follower_refuses_gap(self):
+        follower, _ = self.start_follower()
+        stub = self.follower_stub()
+        record = chat_pb2.MutationRecord(index=3, create_account=chat_pb2.CreateAccountMutation(
+            username="alice", password_hash="x"))
+        acks = list(stub.StreamMutations(iter([chat_pb2.ReplicationBatch(records=[record])])))
+        self.assertEqual([(a.applied_index, a.success) for a in acks], [(0, False)])
+        self.assertNotIn("alice", follower.users)
+
+    def follower_stub(self):
+        channel = grpc.insecure_channel(f"localhost:{self.port}")
+        self.addCleanup(channel.close)
+        return chat_pb2_grpc.ChatServiceStub(channel)
+
+    def test_follower_serves_reads_at_min_applied_index(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader()
+        response = leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        stub = self.follower_stub()
+        accounts = stub.ListAccounts(chat_pb2.ListAccountsRequest(min_applied_index=response.log_index))
+        self.assertEqual(list(accounts.usernames), ["alice"])
+        self.assertGreaterEqual(accounts.applied_index, response.log_index)
+        login = stub.Login(chat_pb2.LoginRequest(username="alice", password="pw",
+                                                 min_applied_index=response.log_index))
+        self.assertTrue(login.success)
+
+    def test_lagging_follower_waits_for_min_applied_index(self):
+        follower, _ = self.start_follower(delay=0.1)
+        leader = self.make_leader(replication_ack="none")
+        response = leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        self.assertNotIn("alice", follower.users)
+        accounts = self.follower_stub().ListAccounts(chat_pb2.ListAccountsRequest(
+            min_applied_index=response.log_index))
+        self.assertEqual(list(accounts.usernames), ["alice"])
+
+    def test_follower_redirects_reads_it_cannot_serve(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader()
+        response = leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        stub = self.follower_stub()
+        with self.assertRaises(grpc.RpcError) as raised:
+            stub.ListAccounts(chat_pb2.ListAccountsRequest(min_applied_index=response.log_index + 1))
+        self.assertEqual(raised.exception.code(), grpc.StatusCode.UNAVAILABLE)
+        self.assertEqual(dict(raised.exception.trailing_metadata())["leader"], "localhost:1")
+
+        # without heartbeats the follower soon counts as stale
+        leader.close()
+        time.sleep(0.3)
+        with self.assertRaises(grpc.RpcError):
+            stub.ListAccounts(chat_pb2.ListAccountsRequest(max_staleness_ms=100))
+        self.assertEqual(list(stub.ListAccounts(chat_pb2.ListAccountsRequest()).usernames), ["alice"])
+
+    def test_failover_stub_does_not_resend_writes_that_may_have_applied(self):
+        class LosesResponses(chat_server.ChatServiceServicer):
+            def SendMessage(self, request, context):
+                super().SendMessage(request, context)
+                context.abort(grpc.StatusCode.UNAVAILABLE, "Socket closed")
+
+        leader = self.make_leader(servicer_class=LosesResponses, replication_ack="none")
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        port = self.free_port()
+        self.serve(leader, port)
+        stub = chat_client.FailoverStub([f"localhost:{port}"], retry_window=2, retry_interval=0.01)
+        self.addCleanup(stub.close)
+        with self.assertRaises(grpc.RpcError) as raised:
+            stub.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="alice", content="hi"))
+        self.assertEqual(raised.exception.code(), grpc.StatusCode.UNAVAILABLE)
+        self.assertEqual(len(leader.conversations[("alice", "alice")]), 1)
+        # reads are still retried, and a server that could not be reached
+        # never got the write
+        self.assertEqual(list(stub.ListAccounts(chat_pb2.ListAccountsRequest()).usernames), ["alice"])
+        channel = grpc.insecure_channel(f"localhost:{self.free_port()}")
+        self.addCleanup(channel.close)
+        with self.assertRaises(grpc.RpcError) as raised:
+            chat_pb2_grpc.ChatServiceStub(channel).SendMessage(chat_pb2.SendMessageRequest())
+        self.assertTrue(chat_client.never_applied(raised.exception))
+
+    def start_cluster(self):
+        leader_port = self.free_port()
+        leader = self.make_leader()
+        self.serve(leader, leader_port)
+        follower, _ = self.start_follower(leader_port=leader_port)
+        self.wait_until(lambda: follower.leader_id == 1)
+        return leader, follower, self.follower_stub()
+
+    def test_compresses_large_responses_and_replication(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader(compression="gzip", compression_min_bytes=512)
+        leader_port = self.free_port()
+        self.serve(leader, leader_port)
+        channel = grpc.insecure_channel(f"localhost:{leader_port}")
+        self.addCleanup(channel.close)
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        for username in ("alice", "bob"):
+            stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+        for i in range(50):
+            stub.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"message {i} " * 5))
+        page = stub.ViewConversation(chat_pb2.ViewConversationRequest(username="alice", other_user="bob"))
+        self.assertEqual(len(page.messages), 50)
+        self.wait_until(lambda: self.state(follower) == self.state(leader))
+
+        view = leader.compressor.stats["ViewConversation"]
+        self.assertEqual(view.compressed, 1)
+        self.assertLess(view.response_wire_bytes * 3, view.response_bytes)
+        send = leader.compressor.stats["SendMessage"]
+        self.assertEqual((send.calls, send.compressed), (50, 0))
+        self.assertEqual(send.response_wire_bytes, send.response_bytes)
+        self.assertIn("ViewConversation: 1 calls", leader.compressor.report())
+
+    def test_compressed_size_is_sampled(self):
+        compressor = compression.CompressionInterceptor(grpc.Compression.Gzip, threshold=0, sample_every=4)
+        stats = compressor.method_stats("ViewConversation")
+        page = chat_pb2.ViewConversationResponse(messages=[
+            chat_pb2.ChatMessage(id=i, sender="alice", content="hello " * 20) for i in range(20)])
+        for _ in range(8):
+            compressor.count_response(stats, page, True)
+        self.assertEqual(stats.compressed, 8)
+        self.assertEqual(stats.sampled_bytes, 2 * page.ByteSize())
+        self.assertEqual(stats.response_wire_bytes, 4 * stats.sampled_wire_bytes)
+
+    def test_only_large_replica_traffic_is_compressed(self):
+        channel = replication.ReplicaChannel(2, f"localhost:{self.port}", [], grpc.Compression.Gzip, 512)
+        small = chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi")
+        self.assertEqual(channel.compression_for(small), grpc.Compression.NoCompression)
+        large = chat_pb2.FetchEntriesRequest(usernames=[f"user{i}" for i in range(100)])
+        self.assertEqual(channel.compression_for(large), grpc.Compression.Gzip)
+
+        records = [replication.mutation_record(i, "CREATE_ACCOUNT", {"username": f"user{i}", "password_hash": "x"})
+                   for i in range(1, 51)]
+        self.assertEqual(compression.pack_records(records[:1], 512), {"records": records[:1]})
+        packed = chat_pb2.ReplicationBatch(**compression.pack_records(records, 512))
+        self.assertFalse(packed.records)
+        self.assertLess(packed.ByteSize(), chat_pb2.ReplicationBatch(records=records).ByteSize())
+
+        # a follower applies packed batches like any other
+        follower, _ = self.start_follower()
+        acks = list(self.follower_stub().StreamMutations(iter([packed])))
+        self.assertEqual([(a.applied_index, a.success) for a in acks], [(50, True)])
+        self.assertEqual(len(follower.users), 50)
+
+    def test_unknown_compression_rejected(self):
+        with self.assertRaises(ValueError):
+            self.make_leader(compression="brotli")
+
+    def test_follower_forwards_writes_to_leader(self):
+        leader, follower, stub = self.start_cluster()
+        for username in ("alice", "bob"):
+            response = stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+            self.assertTrue(response.success)
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"))
+        self.assertTrue(response.success)
+        # the follower answers once it has the write itself
+        self.assertEqual(follower.mutation_log.last_index, response.log_index)
+        self.assertEqual(self.state(follower), self.state(leader))
+        self.assertFalse(stub.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw")).success)
+
+    def test_follower_forwards_marking_read_to_leader(self):
+        leader, follower, stub = self.start_cluster()
+        for username in ("alice", "bob"):
+            leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"), None)
+        page = stub.ViewConversation(chat_pb2.ViewConversationRequest(username="bob", other_user="alice"))
+        self.assertEqual([m.content for m in page.messages], ["hi"])
+        self.assertEqual(leader.users["bob"]["messages"], [])
+        self.assertEqual(follower.users["bob"]["messages"], [])
+
+    def test_anti_entropy_repairs_diverged_follower(self):
+        leader, follower, stub = self.start_cluster()
+        for username in ("alice", "bob", "carol"):
+            leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        for i in range(3):
+            leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content=f"m{i}"), None)
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="carol", recipient="alice", content="yo"), None)
+        self.assertEqual(follower.anti_entropy(), 0)
+
+        # drift that never went through the log
+        with follower.data_lock:
+            follower.users["bob"]["messages"] = []
+            follower.users["mallory"] = {"password_hash": "x", "messages": []}
+            follower.hash_users(["bob", "mallory"])
+            del follower.conversations[("alice", "carol")]
+            follower.conversations.replace(("alice", "bob"), [chat_pb2.ChatMessage(id=1, sender="alice", content="?")])
+        self.assertEqual(follower.anti_entropy(), 4)
+        self.assertEqual(self.state(follower), self.state(leader))
+        self.assertEqual(follower.user_hashes.digest(), leader.user_hashes.digest())
+        self.assertEqual(follower.conversations.hash_tree.digest(), leader.conversations.hash_tree.digest())
+        self.assertEqual(follower.anti_entropy(), 0)
+
+    def test_anti_entropy_reads_alongside_writes(self):
+        leader, follower, stub = self.start_cluster()
+        leader.CreateAccount(chat_pb2.CreateAccountRequest(username="alice", password="pw"), None)
+        responses = []
+        def compare():
+            responses.append(leader.CompareHashTree(chat_pb2.HashTreeRequest(tree="users", path=""), None))
+            responses.append(leader.FetchEntries(chat_pb2.FetchEntriesRequest(usernames=["alice"]), None))
+        # a write in progress holds a share of data_lock
+        with leader.data_lock.shared():
+            thread = threading.Thread(target=compare)
+            thread.start()
+            thread.join(timeout=2)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(int.from_bytes(responses[0].digest, "little"), leader.user_hashes.digest())
+        self.assertEqual([user.username for user in responses[1].users], ["alice"])
+        self.assertEqual(responses[1].applied_index, leader.mutation_log.last_index)
+
+    def test_follower_relays_subscription_from_leader(self):
+        leader, follower, stub = self.start_cluster()
+        for username in ("alice", "bob"):
+            stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+        stream = stub.SubscribeToMessages(chat_pb2.SubscribeRequest(username="bob"))
+        self.wait_until(lambda: "bob" in leader.active_subscriptions)
+        stub.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"))
+        self.assertEqual(next(stream).content, "hi")
+        stream.cancel()
+        self.wait_until(lambda: "bob" not in leader.active_subscriptions)
+
+    def test_subscription_wakes_on_message_and_ends_on_log_off(self):
+        leader = self.make_leader(replication_ack="none")
+        leader_port = self.free_port()
+        self.serve(leader, leader_port)
+        channel = grpc.insecure_channel(f"localhost:{leader_port}")
+        self.addCleanup(channel.close)
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        for username in ("alice", "bob"):
+            stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+        stream = stub.SubscribeToMessages(chat_pb2.SubscribeRequest(username="bob"))
+        self.wait_until(lambda: "bob" in leader.active_subscriptions)
+        start = time.time()
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"), None)
+        self.assertEqual(next(stream).content, "hi")
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(leader.users["bob"]["messages"], [])
+
+        stub.LogOff(chat_pb2.LogOffRequest(username="bob"))
+        self.assertEqual(list(stream), [])
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="later"), None)
+        self.assertEqual([m.content for m in leader.users["bob"]["messages"]], ["later"])
+
+    def test_cancelled_subscription_keeps_messages_unread(self):
+        leader = self.make_leader(replication_ack="none")
+        subscription = chat_server.Subscription()
+        leader.active_subscriptions["bob"] = subscription
+        for username in ("alice", "bob"):
+            leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        subscription.close()
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"), None)
+        self.assertEqual([m.content for m in leader.users["bob"]["messages"]], ["hi"])
+        self.assertEqual(list(subscription), [])
+
+    def test_followers_keep_live_delivered_messages_out_of_unread(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader()
+        subscription = chat_server.Subscription()
+        leader.active_subscriptions["bob"] = subscription
+        for username in ("alice", "bob"):
+            leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        leader.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"), None)
+        self.assertEqual(next(iter(subscription)).content, "hi")
+        self.assertEqual(follower.users["bob"]["messages"], [])
+        self.assertEqual(len(follower.conversations[("alice", "bob")]), 1)
+
+    def test_concurrent_sends_get_unique_ids_in_log_order(self):
+        follower, _ = self.start_follower()
+        leader = self.make_leader()
+        usernames = [f"user{i}" for i in range(8)]
+        for username in usernames:
+            leader.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"), None)
+        def send_all(sender):
+            for i in range(25):
+                # everyone also writes to user0, so stripes overlap
+                for recipient in (usernames[(usernames.index(sender) + 1) % 8], "user0"):
+                    leader.SendMessage(chat_pb2.SendMessageRequest(sender=sender, recipient=recipient,
+                                                                   content=f"{sender} {i}"), None)
+        threads = [threading.Thread(target=send_all, args=(u,)) for u in usernames]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        ids = sorted(m.id for _, conv in leader.conversations.items() for m in conv)
+        self.assertEqual(ids, list(range(1, 401)))
+        self.assertEqual(leader.next_msg_id, 401)
+        for _, conv in leader.conversations.items():
+            conv_ids = [m.id for m in conv]
+            self.assertEqual(conv_ids, sorted(conv_ids))
+        self.wait_until(lambda: follower.mutation_log.last_index == leader.mutation_log.last_index)
+        self.assertEqual(self.state(follower), self.state(leader))
+
+    def test_concurrent_creates_of_one_name_admit_one(self):
+        leader = self.make_leader(replication_ack="none")
+        results = []
+        def create():
+            results.append(leader.CreateAccount(
+                chat_pb2.CreateAccountRequest(username="alice", password="pw"), None).success)
+        threads = [threading.Thread(target=create) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(results), [False] * 7 + [True])
+
+    def serve_threaded(self, servicer):
+        port = self.free_port()
+        server = chat_server.threaded_server(servicer)
+        server.add_insecure_port(f"localhost:{port}")
+        server.start()
+        self.servers.append(server)
+        channel = grpc.insecure_channel(f"localhost:{port}")
+        self.addCleanup(channel.close)
+        return chat_pb2_grpc.ChatServiceStub(channel)
+
+    def test_subscriptions_do_not_take_unary_workers(self):
+        leader = self.make_leader(replication_ack="none", unary_workers=2, stream_workers=8)
+        stub = self.serve_threaded(leader)
+        usernames = [f"user{i}" for i in range(6)]
+        for username in usernames:
+            stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+        streams = [stub.SubscribeToMessages(chat_pb2.SubscribeRequest(username=u)) for u in usernames]
+        self.wait_until(lambda: len(leader.active_subscriptions) == len(usernames))
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(sender="user0", recipient="user5", content="hi"),
+                                    timeout=2)
+        self.assertTrue(response.success)
+        self.assertEqual(next(streams[-1]).content, "hi")
+        for stream in streams:
+            stream.cancel()
+
+    def test_calls_past_max_concurrent_rpcs_rejected(self):
+        leader = self.make_leader(replication_ack="none", max_concurrent_rpcs=2)
+        stub = self.serve_threaded(leader)
+        for username in ("alice", "bob"):
+            stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+        streams = [stub.SubscribeToMessages(chat_pb2.SubscribeRequest(username=u)) for u in ("alice", "bob")]
+        self.wait_until(lambda: len(leader.active_subscriptions) == 2)
+        with self.assertRaises(grpc.RpcError) as cm:
+            stub.ListAccounts(chat_pb2.ListAccountsRequest(), timeout=2)
+        self.assertEqual(cm.exception.code(), grpc.StatusCode.RESOURCE_EXHAUSTED)
+        for stream in streams:
+            stream.cancel()
+
+    def test_aio_server_holds_subscribers_without_threads(self):
+        leader = self.make_leader(servicer_class=chat_server.AioChatServiceServicer, replication_ack="none")
+        leader_port = self.free_port()
+        self.serve_aio(leader, leader_port, workers=2)
+        channel = grpc.insecure_channel(f"localhost:{leader_port}")
+        self.addCleanup(channel.close)
+        stub = chat_pb2_grpc.ChatServiceStub(channel)
+        usernames = [f"user{i}" for i in range(200)]
+        for username in usernames:
+            stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+        streams = [stub.SubscribeToMessages(chat_pb2.SubscribeRequest(username=u)) for u in usernames]
+        self.wait_until(lambda: len(leader.active_subscriptions) == len(usernames))
+
+        # far more open streams than workers, and writes still get through
+        response = stub.SendMessage(chat_pb2.SendMessageRequest(sender="user0", recipient="user199", content="hi"),
+                                    timeout=2)
+        self.assertTrue(response.success)
+        self.assertEqual(next(streams[-1]).content, "hi")
+        stub.LogOff(chat_pb2.LogOffRequest(username="user0"))
+        self.assertEqual(list(streams[0]), [])
+        for stream in streams:
+            stream.cancel()
+        self.wait_until(lambda: not leader.active_subscriptions)
+
+    def test_aio_follower_relays_subscription_from_leader(self):
+        leader_port = self.free_port()
+        leader = self.make_leader()
+        self.serve(leader, leader_port)
+        config = {"data_dir": os.path.join(self.data_dir, "follower"), "replica_retry_interval_ms": 100}
+        os.makedirs(config["data_dir"])
+        follower = chat_server.AioChatServiceServicer(
+            2, [{"server_id": 1, "host": "localhost", "port": leader_port}], config=config)
+        self.services.append(follower)
+        self.serve_aio(follower, self.port)
+        self.wait_until(lambda: follower.leader_id == 1)
+        stub = self.follower_stub()
+        for username in ("alice", "bob"):
+            self.assertTrue(stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw")).success)
+        stream = stub.SubscribeToMessages(chat_pb2.SubscribeRequest(username="bob"))
+        self.wait_until(lambda: "bob" in leader.active_subscriptions)
+        stub.SendMessage(chat_pb2.SendMessageRequest(sender="alice", recipient="bob", content="hi"))
+        self.assertEqual(next(stream).content, "hi")
+        stream.cancel()
+        self.wait_until(lambda: "bob" not in leader.active_subscriptions)
+
+class TestFailover(unittest.TestCase):
+    """
+    Runs three server processes, kills the leader and measures how long
+    writes are unavailable before a new leader takes them.
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.ports = []
+        for _ in range(3):
+            with socket.socket() as s:
+                s.bind(("localhost", 0))
+                self.ports.append(s.getsockname()[1])
+        self.processes = {}
+        for server_id, port in enumerate(self.ports, 1):
+            self.processes[server_id] = self.start_server(server_id)
+        self.stub = chat_client.FailoverStub([f"localhost:{port}" for port in self.ports], retry_window=10)
+
+    def tearDown(self):
+        self.stub.close()
+        for process in self.processes.values():
+            process.kill()
+            process.wait()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def start_server(self, server_id):
+        config = {
+            "server_id": server_id,
+            "listen_port": self.ports[server_id - 1],
+            "data_dir": os.path.join(self.data_dir, str(server_id)),
+            "log_sync": "os",
+            "replication_ack": "majority",
+            "replica_retry_interval_ms": 100,
+            "heartbeat_interval_ms": 50,
+            "election_timeout_ms": 300,
+            "read_wait_ms": 100,
+            "replicas": [{"server_id": i, "host": "localhost", "port": port}
+                         for i, port in enumerate(self.ports, 1) if i != server_id],
+        }
+        os.makedirs(config["data_dir"])
+        config_path = os.path.join(self.data_dir, f"server{server_id}_config.json")
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+        server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+        return subprocess.Popen([sys.executable, server_py, "--config", config_path],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def create(self, username):
+        response = self.stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"),
+                                           timeout=2)
+        self.assertTrue(response.success)
+
+    def leader_address(self):
+        # no follower ever reaches this index, so only the leader answers
+        request = chat_pb2.ListAccountsRequest(wildcard="*", min_applied_index=2 ** 62)
+        for port in self.ports:
+            try:
+                self.stub.stub_for(f"localhost:{port}").ListAccounts(request, timeout=2)
+                return f"localhost:{port}"
+            except grpc.RpcError:
+                pass
+        self.fail("No leader")
+
+    def test_writes_resume_on_new_leader_after_leader_crash(self):
+        self.create("alice")
+        # the write may have reached the leader through a follower
+        leader_address = self.leader_address()
+        leader_id = self.ports.index(int(leader_address.rsplit(":", 1)[1])) + 1
+        self.processes[leader_id].send_signal(signal.SIGKILL)
+        self.processes[leader_id].wait()
+
+        start = time.time()
+        self.create("bob")
+        unavailable = time.time() - start
+        print(f"\nWrites unavailable for {unavailable * 1000:.0f}ms after the leader was killed")
+        self.assertNotEqual(self.stub.current, leader_address)
+        self.assertLess(unavailable, 1.0)
+
+        # both accounts survived on the new leader, and the remaining
+        # follower passes writes on to it
+        follower = next(f"localhost:{port}" for port in self.ports
+                        if f"localhost:{port}" not in (leader_address, self.stub.current))
+        self.stub.stub_for(follower).CreateAccount(chat_pb2.CreateAccountRequest(username="carol", password="pw"))
+        response = self.stub.ListAccounts(chat_pb2.ListAccountsRequest(wildcard="*"))
+        self.assertEqual(list(response.usernames), ["alice", "bob", "carol"])
+
+
+class TestSharding(unittest.TestCase):
+    """
+    Two single-server shards and a router in front of them, all in this
+    process.
+    """
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.servers = []
+        self.services = {}
+        ports = []
+        for _ in range(3):
+            with socket.socket() as s:
+                s.bind(("localhost", 0))
+                ports.append(s.getsockname()[1])
+        self.shard_list = [{"shard_id": i, "servers": [f"localhost:{ports[i]}"]} for i in range(2)]
+        for shard_id in range(2):
+            self.services[shard_id] = self.start_shard(shard_id)
+            self.serve(self.services[shard_id], ports[shard_id])
+        self.router = router.ChatRouter(self.shard_list)
+        self.serve(self.router, ports[2])
+        self.stub = chat_client.FailoverStub([f"localhost:{ports[2]}"])
+        self.shards = self.router.shards
+
+    def tearDown(self):
+        self.stub.close()
+        self.router.close()
+        for service in self.services.values():
+            service.close()
+        for server in self.servers:
+            server.stop(0)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def start_shard(self, shard_id):
+        config = {"data_dir": os.path.join(self.data_dir, str(shard_id)), "log_sync": "os",
+                  "shard_id": shard_id, "shards": self.shard_list}
+        os.makedirs(config["data_dir"], exist_ok=True)
+        return chat_server.ChatServiceServicer(1, [], config=config)
+
+    def serve(self, servicer, port):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=8))
+        chat_pb2_grpc.add_ChatServiceServicer_to_server(servicer, server)
+        server.add_insecure_port(f"localhost:{port}")
+        server.start()
+        self.servers.append(server)
+
+    def cross_shard_pair(self):
+        """
+        A sender and recipient whose conversation is kept on another shard
+        than the recipient.
+        """
+        names = [f"user{i}" for i in range(100)]
+        return next((a, b) for a in names for b in names
+                    if a != b and self.shards.conversation_shard(a, b) != self.shards.user_shard(b))
+
+    def create(self, *usernames):
+        for username in usernames:
+            response = self.stub.CreateAccount(chat_pb2.CreateAccountRequest(username=username, password="pw"))
+            self.assertTrue(response.success)
+
+    def send(self, sender, recipient, content):
+        response = self.stub.SendMessage(chat_pb2.SendMessageRequest(
+            sender=sender, recipient=recipient, content=content))
+        self.assertTrue(response.success)
+
+    def test_ring_spreads_keys_and_adding_a_shard_moves_only_its_own(self):
+        keys = [f"user{i}" for i in range(3000)]
+        ring = sharding.HashRing([0, 1, 2])
+        owners = {key: ring.owner(key) for key in keys}
+        for shard_id in range(3):
+            self.assertGreater(list(owners.values()).count(shard_id), 600)
+        grown = sharding.HashRing([0, 1, 2, 3])
+        moved = [key for key in keys if grown.owner(key) != owners[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(grown.owner(key) == 3 for key in moved))
+
+    def test_message_reaches_recipient_on_another_shard(self):
+        sender, recipient = self.cross_shard_pair()
+        self.create(sender, recipient)
+        self.send(sender, recipient, "hello")
+        self.send(sender, recipient, "again")
+
+        # the conversation's shard numbered them from its own share of ids
+        conv_shard = self.shards.conversation_shard(sender, recipient)
+        response = self.stub.ReadMessages(chat_pb2.ReadMessagesRequest(username=recipient))
+        self.assertEqual([m.content for m in response.messages], ["hello", "again"])
+        self.assertTrue(all(m.id % 2 == conv_shard for m in response.messages))
+        self.assertNotIn(recipient, self.services[conv_shard].users)
+
+        # the recipient's shard replays the delivery from its log
+        self.send(sender, recipient, "unread")
+        recipient_shard = self.shards.user_shard(recipient)
+        self.services[recipient_shard].close()
+        restarted = self.start_shard(recipient_shard)
+        self.services["restarted"] = restarted
+        self.assertEqual([m.content for m in restarted.users[recipient]["messages"]], ["unread"])
+
+    def test_unknown_recipient_on_another_shard(self):
+        sender, recipient = self.cross_shard_pair()
+        self.create(sender)
+        response = self.stub.SendMessage(chat_pb2.SendMessageRequest(
+            sender=sender, recipient=recipient, content="hello"))
+        self.assertFalse(response.success)
+        self.assertEqual(response.message, "Recipient not found")
+        conv_shard = self.services[self.shards.conversation_shard(sender, recipient)]
+        self.assertEqual([m.content for _, conv in conv_shard.conversations.items() for m in conv], [])
+
+    def test_message_id_is_logged_before_delivery_to_another_shard(self):
+        sender, recipient = self.cross_shard_pair()
+        self.create(sender, recipient)
+        conv_shard_id = self.shards.conversation_shard(sender, recipient)
+        conv_shard = self.services[conv_shard_id]
+        sent = []
+        def crash_on_delivery(shard_id, method, request, context):
+            sent.append(request.message.id)
+            raise RuntimeError("crashed")
+        conv_shard.call_shard = crash_on_delivery
+        with self.assertRaises(grpc.RpcError):
+            self.stub.SendMessage(chat_pb2.SendMessageRequest(sender=sender, recipient=recipient, content="hi"))
+
+        # a restarted shard never hands out that id again
+        conv_shard.close()
+        restarted = self.start_shard(conv_shard_id)
+        self.services["restarted"] = restarted
+        self.assertGreater(restarted.next_msg_id, sent[0])
+
+    def test_viewing_conversation_marks_read_on_viewers_shard(self):
+        sender, recipient = self.cross_shard_pair()
+        self.create(sender, recipient)
+        for i in range(3):
+            self.send(sender, recipient, f"m{i}")
+        response = self.stub.ViewConversation(chat_pb2.ViewConversationRequest(
+            username=recipient, other_user=sender, limit=2))
+        self.assertEqual([m.content for m in response.messages], ["m1", "m2"])
+        unread = self.services[self.shards.user_shard(recipient)].users[recipient]["messages"]
+        self.assertEqual([m.content for m in unread], ["m0"])
+
+    def test_list_accounts_pages_across_shards(self):
+        names = sorted(f"user{i:02d}" for i in range(25))
+        self.create(*names)
+        for shard_id, service in self.services.items():
+            self.assertTrue(0 < len(service.users) < 25)
+        listed = []
+        token = ""
+        while True:
+            response = self.stub.ListAccounts(chat_pb2.ListAccountsRequest(
+                wildcard="user*", page_size=4, page_token=token))
+            self.assertLessEqual(len(response.usernames), 4)
+            listed.extend(response.usernames)
+            token = response.next_page_token
+            if not token:
+                break
+        self.assertEqual(listed, names)
+
+    def test_delete_account_clears_conversations_on_every_shard(self):
+        sender, recipient = self.cross_shard_pair()
+        self.create(sender, recipient)
+        self.send(sender, recipient, "hello")
+        response = self.stub.DeleteAccount(chat_pb2.DeleteAccountRequest(username=sender))
+        self.assertTrue(response.success)
+        for service in self.services.values():
+            self.assertNotIn(sender, service.users)
+            self.assertEqual(list(service.conversations.keys_for(sender)), [])
+        response = self.stub.DeleteAccount(chat_pb2.DeleteAccountRequest(username=sender))
+        self.assertFalse(response.success)
+
+
 if __name__ == '__main__':
     unittest.main()